@@ -0,0 +1,29 @@
+from app.db import ArchivalGroupActivity
+
+
+class ActivityCoalescer:
+    """
+    Collapses bursts of activities for the same archival group within a batch read from the stream.
+    Every activity still gets a job, in stream order, but a job that has not started by the time a
+    later activity for the same archival group arrives is superseded by it: building the Manifest
+    once, for the latest activity, gives the same result as building it for each in turn.
+    """
+    def __init__(self):
+        self._latest:dict[str, ArchivalGroupActivity] = {}
+
+
+    def new_batch(self):
+        """Call once the previous batch has been drained"""
+        self._latest = {}
+
+
+    def add(self, job:ArchivalGroupActivity):
+        self._latest[job.archival_group_uri] = job
+
+
+    def get_superseding_job(self, job:ArchivalGroupActivity) -> ArchivalGroupActivity | None:
+        """The later job for the same archival group, if there is one"""
+        latest = self._latest.get(job.archival_group_uri, None)
+        if latest is None or latest is job:
+            return None
+        return latest
@@ -0,0 +1,83 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from logzero import logger
+
+from app import metrics
+
+# The summary of the activity being processed by the current task, if any. Tasks started while
+# processing it (e.g. the fetches in gather_results) inherit it, so their stages are counted too.
+_current_summary:ContextVar['ActivitySummary | None'] = ContextVar("current_summary", default=None)
+
+
+class ActivitySummary:
+    """
+    Counts and stage timings gathered while processing one activity, logged as a single
+    INFO record once it has finished, in place of per-file and per-asset detail.
+    Stage timings and the outcome are also recorded in the Prometheus metrics.
+    """
+    def __init__(self):
+        self.counts:dict[str, int] = {}
+        self.timings:dict[str, float] = {}
+        self._started = time.perf_counter()
+
+
+    @contextmanager
+    def activate(self):
+        """Make this the summary that timed_stage records to, for this block"""
+        token = _current_summary.set(self)
+        try:
+            yield self
+        finally:
+            _current_summary.reset(token)
+
+
+    @contextmanager
+    def timed(self, stage:str):
+        """Time the block as `stage` (seconds); a stage timed more than once accumulates"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_timing(stage, time.perf_counter() - started)
+
+
+    def add_timing(self, stage:str, seconds:float):
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+        metrics.observe_stage(stage, seconds)
+
+
+    def count(self, name:str, value:int):
+        self.counts[name] = value
+
+
+    def log(self, status:str):
+        duration = time.perf_counter() - self._started
+        metrics.observe_activity(status, duration)
+        fields = {
+            "status": status,
+            "duration": round(duration, 4),
+            "counts": self.counts,
+            "timings": {stage: round(seconds, 4) for stage, seconds in self.timings.items()}
+        }
+        logger.info("Activity %s in %.3fs; counts %s; timings %s",
+                    status, duration, self.counts, fields["timings"], extra={"fields": fields})
+
+
+@contextmanager
+def timed_stage(stage:str):
+    """
+    Time the block as `stage` of the activity currently being processed.
+    Outside of an activity it is still recorded in the stage duration histogram.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        summary = _current_summary.get()
+        if summary is not None:
+            summary.add_timing(stage, seconds)
+        else:
+            metrics.observe_stage(stage, seconds)
@@ -0,0 +1,293 @@
+import argparse
+import copy
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import logzero
+
+# iiif_cloud_services builds its auth header at import time
+os.environ.setdefault("IIIF_CS_BASIC_CREDENTIALS", "benchmark:benchmark")
+
+from app.iiif_cloud_services import update_ingest_status
+from app.manifest_decorator import add_descriptive_metadata_to_manifest, add_painted_resources
+from app.mets_parser.mets_parser import (get_mets_wrapper_from_file_like_object, get_mets_wrapper_from_string,
+                                         get_mets_wrapper_streaming)
+from app.mets_parser.synthetic_mets import write_synthetic_mets
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mets_parser", "test_fixtures")
+
+fixtures = [
+    "eprints/10315.METS.xml",
+    "dlip/mets.xml",
+    "wc-goobi/b29356350.xml",
+    "wc-archivematica/METS.299eb16f-1e62-4bf6-b259-c82146153711.xml"
+]
+
+# (name, file_count, depth, branching, files_per_directory); see get_synthetic_file_paths
+synthetic_mets = [
+    ("1k-flat", 1000, 0, 10, None),
+    ("10k-flat", 10000, 0, 10, None),
+    ("10k-sibling-folders", 10000, 1, 10000, 1),
+    ("50k-sibling-folders", 50000, 1, 50000, 1),
+    ("100k-flat", 100000, 0, 10, None),
+    ("100k-4x10-folders", 100000, 4, 10, None),
+    ("100k-20-deep", 100000, 20, 2, 1)
+]
+
+# (name, canvas count, fraction of assets added, fraction removed, fraction with a new origin)
+ingest_status_scenarios = [
+    ("20k-unchanged", 20000, 0.0, 0.0, 0.0),
+    ("20k-10pc-new-origins", 20000, 0.0, 0.0, 0.1),
+    ("20k-10pc-added-10pc-removed", 20000, 0.1, 0.1, 0.0),
+    ("20k-all-new", 20000, 1.0, 1.0, 0.0),
+    ("100k-10pc-new-origins", 100000, 0.0, 0.0, 0.1)
+]
+
+# Cases at or below this many files/canvases make up the --quick set
+QUICK_LIMIT = 20000
+
+# The keys add_descriptive_metadata_to_manifest looks for, as the catalogue API returns them
+catalogue_record = {
+    "data": {
+        "Title": "Synthetic catalogue record",
+        "Identifier": "BENCH/0001",
+        "Shelfmark": "BENCH 1",
+        "Object Number": "0001",
+        "Date": "1850",
+        "Description": ["A record with every field the builder reads. " * 20],
+        "Dimensions": "10 x 20 cm",
+        "Weight": "1 kg",
+        "Notes": ["Note one", "Note two"],
+        "Collections": ["Benchmarks"],
+        "Credit Line": "Benchmark credit",
+        "Attribution": "Benchmark attribution",
+        "Extent": "1 item",
+        "Medium": "Paper",
+        "Technique": "Printing",
+        "Support": "Card",
+        "Creators": ["A. Creator", "B. Creator"],
+        "Rights": ["http://rightsstatements.org/vocab/InC/1.0/"],
+        "Homepage": "https://example.org/record/0001"
+    }
+}
+
+parsers = ["from_string", "from_file_like_object", "streaming"]
+
+
+def make_manifest(asset_ids, origin_suffix=None):
+    painted_resources = []
+    for index, asset_id in enumerate(asset_ids):
+        origin = f"s3://bucket/{asset_id}.jpg"
+        if origin_suffix is not None and origin_suffix(index):
+            origin = f"{origin}?v=2"
+        painted_resources.append({
+            "canvasPainting": {"canvasId": f"canvas_{index}", "canvasOrder": index},
+            "asset": {"id": asset_id, "origin": origin}
+        })
+    return {"paintedResources": painted_resources}
+
+
+def make_archival_group(mets_wrapper):
+    """A Preservation API archival group whose storage map has an entry for every file in the METS"""
+    files = {}
+    directories = [mets_wrapper.physical_structure]
+    while directories:
+        directory = directories.pop()
+        for f in directory.files:
+            files[f.local_path.replace('#', '-_-percent-23-_-')] = {"fullPath": f"v1/content/{f.local_path}"}
+        directories.extend(directory.directories)
+    return {"origin": "s3://benchmark-bucket/archival-group", "storageMap": {"files": files}}
+
+
+def setup_parse(parser_name, path):
+    if parser_name == "from_string":
+        # as the builder gets it: already in memory
+        with open(path, encoding="utf-8") as f:
+            xml_string = f.read()
+        return lambda: get_mets_wrapper_from_string(xml_string)
+    if parser_name == "streaming":
+        return lambda: get_mets_wrapper_streaming(path)
+    return lambda: get_mets_wrapper_from_file_like_object(path)
+
+
+def setup_painted_resources(path):
+    mets_wrapper = get_mets_wrapper_streaming(path)
+    archival_group = make_archival_group(mets_wrapper)
+    def run():
+        manifest = {}
+        add_painted_resources(manifest, archival_group, mets_wrapper, "https://iiif.example/canvases/bench_", "bench_")
+        return manifest
+    return run
+
+
+def setup_ingest_status(canvas_count, added, removed, origin_changed):
+    existing_ids = [f"asset_{i:06d}" for i in range(canvas_count)]
+    kept = existing_ids[int(canvas_count * removed):]
+    new_ids = kept + [f"new_{i:06d}" for i in range(int(canvas_count * added))]
+    changed_every = int(1 / origin_changed) if origin_changed > 0 else None
+    existing_manifest = make_manifest(existing_ids)
+    new_manifest = make_manifest(new_ids, (lambda i: i % changed_every == 0) if changed_every else None)
+    # update_ingest_status marks the new manifest, so each run gets a fresh copy (made before timing starts)
+    copies = []
+    def prepare():
+        copies.append(copy.deepcopy(new_manifest))
+    def run():
+        return update_ingest_status(existing_manifest, copies.pop())
+    return run, prepare
+
+
+def setup_descriptive_metadata(calls):
+    def run():
+        for _ in range(calls):
+            add_descriptive_metadata_to_manifest({}, catalogue_record)
+    return run
+
+
+def measure(case, repeat):
+    """
+    Runs in a fresh process, so that the peak RSS belongs to this case alone. The peak is reported
+    as the growth in ru_maxrss over the timed runs, on top of what setup (e.g. parsing the METS
+    that add_painted_resources is given) had already used.
+    Parse cases also report, from one more run under tracemalloc, the Python heap's peak and what
+    the parsed MetsWrapper still holds ("kept"). lxml allocates outside the Python heap, so these
+    are only part of the picture.
+    """
+    # At INFO and below the per-file logging would be part of what is measured
+    logzero.loglevel(logzero.WARNING)
+    kind, args = case["kind"], case["args"]
+    prepare = None
+    if kind == "parse":
+        run = setup_parse(*args)
+    elif kind == "painted_resources":
+        run = setup_painted_resources(*args)
+    elif kind == "ingest_status":
+        run, prepare = setup_ingest_status(*args)
+    elif kind == "descriptive_metadata":
+        run = setup_descriptive_metadata(*args)
+    else:
+        raise ValueError(f"Unknown benchmark kind {kind}")
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    for _ in range(repeat):
+        if prepare is not None:
+            prepare()
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    result = {
+        "best_ms": min(timings) * 1000,
+        "median_ms": statistics.median(timings) * 1000,
+        "rss_peak_kb": rss_peak,     # ru_maxrss is in KB on Linux
+        "rss_total_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+    if kind == "parse":
+        tracemalloc.start()
+        mets_wrapper = run()
+        python_kept, python_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del mets_wrapper
+        result["python_peak_kb"] = python_peak // 1024
+        result["python_kept_kb"] = python_kept // 1024
+    return result
+
+
+def get_cases(temp_dir, quick):
+    """Every benchmark case, writing the synthetic METS it needs to temp_dir"""
+    cases = []
+    for fixture in fixtures:
+        for parser_name in parsers:
+            cases.append({"name": f"parse/{parser_name}/{fixture.split('/')[0]}", "kind": "parse",
+                          "args": (parser_name, os.path.join(fixtures_dir, fixture))})
+
+    for name, file_count, depth, branching, files_per_directory in synthetic_mets:
+        if quick and file_count > QUICK_LIMIT:
+            continue
+        path = os.path.join(temp_dir, f"{name}.xml")
+        with open(path, "wb") as f:
+            write_synthetic_mets(f, file_count, depth, branching, files_per_directory)
+        for parser_name in parsers:
+            cases.append({"name": f"parse/{parser_name}/{name}", "kind": "parse",
+                          "args": (parser_name, path)})
+        cases.append({"name": f"add_painted_resources/{name}", "kind": "painted_resources",
+                      "args": (path,)})
+
+    for name, canvas_count, added, removed, origin_changed in ingest_status_scenarios:
+        if quick and canvas_count > QUICK_LIMIT:
+            continue
+        cases.append({"name": f"update_ingest_status/{name}", "kind": "ingest_status",
+                      "args": (canvas_count, added, removed, origin_changed)})
+
+    cases.append({"name": "add_descriptive_metadata_to_manifest/x1000", "kind": "descriptive_metadata",
+                  "args": (1000,)})
+    return cases
+
+
+def compare(results, baseline, tolerance):
+    """Cases that are slower (best time) or use more memory (peak RSS) than the baseline by more than tolerance"""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name, None)
+        if previous is None:
+            continue
+        if result["best_ms"] > previous["best_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: best {result['best_ms']:.2f} ms, was {previous['best_ms']:.2f} ms")
+        # small peaks are mostly noise from the allocator, so allow at least 1 MB
+        if result["rss_peak_kb"] > max(previous["rss_peak_kb"] * (1 + tolerance), previous["rss_peak_kb"] + 1024):
+            regressions.append(f"{name}: peak RSS {result['rss_peak_kb']} KB, was {previous['rss_peak_kb']} KB")
+    return regressions
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Time the METS-to-manifest hot paths and report their peak memory, each case in a fresh process.")
+    parser.add_argument("--quick", action="store_true", help=f"skip cases of more than {QUICK_LIMIT} files or canvases")
+    parser.add_argument("--filter", help="only cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per case; the best and median are reported")
+    parser.add_argument("--save", help="write the results to this JSON file, to compare later runs against")
+    parser.add_argument("--compare", help="a JSON file written by --save; exits with status 1 on any regression")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="how much slower or bigger than the baseline a case can be before it is a regression")
+    return parser.parse_args(args)
+
+
+def run(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cases = [case for case in get_cases(temp_dir, args.quick) if not args.filter or args.filter in case["name"]]
+        print(f"{'case':<60} {'best ms':>10} {'median ms':>10} {'RSS peak KB':>12} {'RSS total KB':>13} "
+              f"{'py peak KB':>11} {'py kept KB':>11}")
+        for case in cases:
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                result = executor.submit(measure, case, args.repeat).result()
+            results[case["name"]] = result
+            print(f"{case['name']:<60} {result['best_ms']:>10.2f} {result['median_ms']:>10.2f} "
+                  f"{result['rss_peak_kb']:>12} {result['rss_total_kb']:>13} "
+                  f"{result.get('python_peak_kb', ''):>11} {result.get('python_kept_kb', ''):>11}", flush=True)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    # From the iiif-builder directory, e.g.
+    # python -m app.benchmarks --quick --save benchmarks.json
+    # python -m app.benchmarks --quick --compare benchmarks.json
+    run(parse_args())
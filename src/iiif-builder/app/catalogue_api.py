@@ -1,18 +1,34 @@
 from app import settings
+from app.lookup_cache import CacheEntry, LookupCache
+from app.resilience import resilient_request
 from app.result import Result
 
+catalogue_cache = LookupCache("catalogue", settings.CATALOGUE_CACHE_TTL, settings.LOOKUP_CACHE_MAX_ENTRIES,
+                              settings.LOOKUP_CACHE_PERSISTENT)
+
 
 async def read_catalogue_api(session, catalogue_api_uri) -> Result:
 
-    response = await session.get(catalogue_api_uri, headers={
+    cached = await catalogue_cache.get(catalogue_api_uri)
+    if cached is not None and catalogue_cache.is_fresh(cached):
+        return Result.success(cached.value)
+
+    headers = {
         settings.MVP_CATALOGUE_API_KEY_HEADER: settings.MVP_CATALOGUE_API_KEY_VALUE
-    })
-    if response.status == 200:
-        json = await response.json()
-        return Result.success(json)
-    try:
-        json = await response.json()
-        return Result(False, f"Catalogue API returned HTTP status {response.status} and error message: {json.get('error', 'unknown error')}")
-    except:
-        pass
-    return Result(False, f"Catalogue API returned HTTP status {response.status}")
\ No newline at end of file
+    }
+    if cached is not None:
+        headers.update(cached.get_conditional_headers())
+    async with resilient_request(session, "GET", catalogue_api_uri, headers=headers) as response:
+        if response.status == 304 and cached is not None:
+            await catalogue_cache.revalidated(catalogue_api_uri, cached)
+            return Result.success(cached.value)
+        if response.status == 200:
+            json = await response.json()
+            await catalogue_cache.set(catalogue_api_uri, CacheEntry(json, response.headers.get("ETag"), response.headers.get("Last-Modified")))
+            return Result.success(json)
+        try:
+            json = await response.json()
+            return Result(False, f"Catalogue API returned HTTP status {response.status} and error message: {json.get('error', 'unknown error')}")
+        except:
+            pass
+        return Result(False, f"Catalogue API returned HTTP status {response.status}")
\ No newline at end of file
@@ -1,9 +1,94 @@
-from datetime import datetime, timezone
+import asyncio
+from datetime import datetime, timedelta, timezone
 import psycopg
 from logzero import logger
+from psycopg.types.json import Jsonb
+from psycopg_pool import AsyncConnectionPool
 
 from app import settings
 
+# The stages of processing an activity that are timed; each has a <stage>_seconds column,
+# holding how long it took on the job's latest attempt (null if it didn't get that far)
+ACTIVITY_STAGES = ("ag_load", "mets_fetch", "mets_parse", "identity_lookup", "catalogue_read",
+                   "manifest_build", "iiifcs_get", "iiifcs_put")
+STAGE_COLUMNS = tuple(f"{stage}_seconds" for stage in ACTIVITY_STAGES)
+
+ACTIVITY_COLUMNS = ("id, activity_end_time, archival_group_uri, activity_type, "
+                    "id_service_pid, catalogue_api_uri, public_manifest_uri, "
+                    "internal_public_manifest_uri, internal_api_manifest_uri, "
+                    "started, finished, error_message, status, attempts, next_attempt, "
+                    f"{', '.join(STAGE_COLUMNS)}")
+
+UPDATE_ACTIVITY_SQL = ("UPDATE archival_group_activity SET  "
+                       "id_service_pid=%s, catalogue_api_uri=%s, public_manifest_uri=%s, "
+                       "internal_public_manifest_uri=%s, internal_api_manifest_uri=%s, "
+                       "finished=%s, error_message=%s, status=%s, attempts=%s, next_attempt=%s, "
+                       f"{', '.join(f'{column}=%s' for column in STAGE_COLUMNS)} "
+                       "WHERE id = %s")
+
+# Errors that mean Postgres couldn't be reached (or the connection was lost), rather than a problem
+# with what was being written; PoolTimeout is an OperationalError
+CONNECTION_ERRORS = (psycopg.OperationalError, psycopg.InterfaceError)
+
+# Job statuses. A job is RUNNING from when it is created or claimed until it reaches one of the
+# others; its next_attempt is then the end of its lease, which is renewed while it is being processed.
+# Once the lease has expired (the builder that held it has gone) it can be claimed again. A FAILED job
+# is retried at next_attempt until JOB_MAX_ATTEMPTS have been made, when it becomes DEAD; so does a job
+# whose lease expires on its last attempt. SUCCEEDED, SKIPPED and DEAD are final.
+# In coordinated mode the leader creates jobs as QUEUED, for the builder that owns their partition to
+# claim; requeued jobs are QUEUED in either mode.
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_SUCCEEDED = "succeeded"
+STATUS_SKIPPED = "skipped"
+STATUS_FAILED = "failed"
+STATUS_DEAD = "dead"
+
+# Jobs are partitioned between builders by a hash of their archival group URI, so that all the jobs
+# for an archival group are processed, in order, by the same builder
+PARTITION_CONDITION = "mod(abs(hashtext(archival_group_uri)::bigint), %s) = %s"
+
+# Postgres advisory lock keys; see AdvisoryLock
+LEADER_LOCK_KEY = 7_410_000
+PARTITION_LOCK_KEY_BASE = 7_410_100
+MIGRATION_LOCK_KEY = 7_410_001
+
+# Finished jobs that can be moved to archival_group_activity_archive once they are old enough.
+# Failed and dead jobs stay until they have been dealt with.
+ARCHIVABLE_STATUSES = (STATUS_SUCCEEDED, STATUS_SKIPPED)
+
+_pool: AsyncConnectionPool | None = None
+
+
+async def open_pool():
+    """
+    Open the connection pool shared by everything that talks to the iiif-builder DB.
+    Call once at startup, before any ArchivalGroupActivity method.
+    """
+    global _pool
+    if _pool is None:
+        _pool = AsyncConnectionPool(
+            settings.POSTGRES_CONNECTION,
+            min_size=settings.POSTGRES_POOL_MIN_SIZE,
+            max_size=settings.POSTGRES_POOL_MAX_SIZE,
+            open=False)
+        await _pool.open(wait=True)
+        logger.info(f"Opened Postgres connection pool (min {settings.POSTGRES_POOL_MIN_SIZE}, max {settings.POSTGRES_POOL_MAX_SIZE})")
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def get_pool() -> AsyncConnectionPool:
+    if _pool is None:
+        raise Exception("The Postgres connection pool has not been opened")
+    return _pool
+
+
 class ArchivalGroupActivity:
     """
     A row is created for every Activity Stream event read by the system
@@ -20,7 +105,11 @@ class ArchivalGroupActivity:
                  internal_api_manifest_uri:str=None,
                  started:datetime=None,
                  finished:datetime=None,
-                 error_message:str=None
+                 error_message:str=None,
+                 status:str=STATUS_RUNNING,
+                 attempts:int=1,
+                 next_attempt:datetime=None,
+                 stage_timings:dict[str, float]=None
                  ):
         self.id_ = id_
         self.activity_end_time = activity_end_time
@@ -34,10 +123,14 @@ class ArchivalGroupActivity:
         self.started = started
         self.finished = finished
         self.error_message = error_message
+        self.status = status
+        self.attempts = attempts
+        self.next_attempt = next_attempt
+        self.stage_timings = stage_timings or {}
 
 
     @staticmethod
-    def get_latest_end_time() -> datetime:
+    async def get_latest_end_time() -> datetime:
         if settings.ACTIVITY_CUTOFF_DATE is not None:
             if settings.ACTIVITY_CUTOFF_DATE.lower() == "now":
                 logger.info("Found 'now' as activity cutoff date")
@@ -50,97 +143,518 @@ class ArchivalGroupActivity:
                 logger.error(f"Unable to parse {settings.ACTIVITY_CUTOFF_DATE} for activity cutoff date, returning current datetime instead")
                 return datetime.now(tz=timezone.utc)
 
-        with psycopg.connect(settings.POSTGRES_CONNECTION) as conn:
-            with conn.cursor() as cur:
-                next_res = cur.execute("SELECT max(activity_end_time) FROM archival_group_activity").fetchone()
-                if next_res is not None and next_res[0] is not None:
-                    return next_res[0]
+        # The checkpoint is advanced after each batch, but a builder can stop after creating jobs and
+        # before advancing it, so also look for anything recorded after it (a short range of the index).
+        # With no checkpoint yet, max() is read from the end of the activity_end_time index.
+        async with get_pool().connection() as conn:
+            sql = ("SELECT coalesce("
+                   "(SELECT greatest(c.last_end_time, "
+                   "(SELECT max(activity_end_time) FROM archival_group_activity WHERE activity_end_time > c.last_end_time)) "
+                   "FROM activity_stream_checkpoint c WHERE c.id = 1), "
+                   "(SELECT max(activity_end_time) FROM archival_group_activity))")
+            cur = await conn.execute(sql)
+            next_res = await cur.fetchone()
+            if next_res is not None and next_res[0] is not None:
+                return next_res[0]
 
         return datetime(2025, 4, 8, tzinfo=timezone.utc)
 
 
+    @staticmethod
+    async def update_checkpoint(last_end_time:datetime):
+        """
+        Record the end time of the latest activity read from the stream, once the jobs for a batch
+        have been created. The checkpoint only ever moves forward.
+        """
+        async with get_pool().connection() as conn:
+            sql = ("INSERT INTO activity_stream_checkpoint (id, last_end_time) VALUES (1, %s) "
+                   "ON CONFLICT (id) DO UPDATE SET last_end_time = "
+                   "greatest(activity_stream_checkpoint.last_end_time, EXCLUDED.last_end_time)")
+            await conn.execute(sql, [last_end_time])
+
+
     @classmethod
-    def new_activity(cls, activity_end_time_date, archival_group_uri, activity_type)-> 'ArchivalGroupActivity':
-        with psycopg.connect(settings.POSTGRES_CONNECTION) as conn:
-            with conn.cursor() as cur:
-                sql = ("INSERT INTO archival_group_activity "
-                       "(activity_end_time, archival_group_uri, activity_type, started) "
-                       "VALUES (%s, %s, %s, %s) "
-                       "RETURNING id")
-                values = (activity_end_time_date, archival_group_uri, activity_type, datetime.now(tz=timezone.utc))
-                new_id = cur.execute(sql, values).fetchone()[0]
+    async def new_activity(cls, activity_end_time_date, archival_group_uri, activity_type,
+                           status:str=STATUS_RUNNING)-> 'ArchivalGroupActivity':
+        async with get_pool().connection() as conn:
+            sql = ("INSERT INTO archival_group_activity "
+                   "(activity_end_time, archival_group_uri, activity_type, started, status, attempts, next_attempt) "
+                   "VALUES (%s, %s, %s, %s, %s, 1, %s) "
+                   f"RETURNING {ACTIVITY_COLUMNS}")
+            now = datetime.now(tz=timezone.utc)
+            lease_end = now + timedelta(seconds=settings.JOB_LEASE_DURATION) if status == STATUS_RUNNING else None
+            values = (activity_end_time_date, archival_group_uri, activity_type, now, status, lease_end)
+            cur = await conn.execute(sql, values)
+            return ArchivalGroupActivity.from_row(await cur.fetchone())
+
+
+    @staticmethod
+    async def get_from_id(id_:int)-> 'ArchivalGroupActivity | None':
+        async with get_pool().connection() as conn:
+            sql = f"SELECT {ACTIVITY_COLUMNS} FROM archival_group_activity WHERE id = %s"
+            cur = await conn.execute(sql, [id_])
+            result = await cur.fetchone()
+            if result is None:
+                return None
+            return ArchivalGroupActivity.from_row(result)
+
+
+    @staticmethod
+    def from_row(row) -> 'ArchivalGroupActivity':
+        return ArchivalGroupActivity(
+            id_=row[0],
+            activity_end_time=row[1],
+            archival_group_uri=row[2],
+            activity_type=row[3],
+            id_service_pid=row[4],
+            catalogue_api_uri=row[5],
+            public_manifest_uri=row[6],
+            internal_public_manifest_uri=row[7],
+            internal_api_manifest_uri=row[8],
+            started=row[9],
+            finished=row[10],
+            error_message=row[11],
+            status=row[12],
+            attempts=row[13],
+            next_attempt=row[14],
+            stage_timings={stage: seconds for stage, seconds in zip(ACTIVITY_STAGES, row[15:]) if seconds is not None}
+        )
+
+
+    @staticmethod
+    async def claim_queued(limit:int) -> list['ArchivalGroupActivity']:
+        """
+        Claim up to limit of the oldest queued jobs in this builder's partition, leasing them to it.
+        """
+        await job_state_writer.flush()
+        now = datetime.now(tz=timezone.utc)
+        async with get_pool().connection() as conn:
+            sql = ("UPDATE archival_group_activity SET status = %s, next_attempt = %s "
+                   "WHERE id IN (SELECT id FROM archival_group_activity "
+                   f"WHERE status = %s AND {PARTITION_CONDITION} "
+                   "ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED) "
+                   f"RETURNING {ACTIVITY_COLUMNS}")
+            values = (STATUS_RUNNING, now + timedelta(seconds=settings.JOB_LEASE_DURATION), STATUS_QUEUED,
+                      settings.BUILDER_REPLICA_COUNT, settings.BUILDER_REPLICA_INDEX, limit)
+            cur = await conn.execute(sql, values)
+            jobs = [ArchivalGroupActivity.from_row(row) for row in await cur.fetchall()]
+        jobs.sort(key=lambda job: job.id_)
+        return jobs
+
+
+    @staticmethod
+    async def claim_retries(limit:int) -> list['ArchivalGroupActivity']:
+        """
+        Claim up to limit jobs in this builder's partition that are due to be tried again - failed jobs
+        whose next_attempt has come, and running jobs whose lease has expired - leasing them to this builder.
+        SKIP LOCKED means that several builders can do this at once without claiming the same job.
+        Failed jobs for an archival group that has since been built successfully are skipped first, and
+        expired jobs that have already had JOB_MAX_ATTEMPTS are made dead (a job that keeps taking its
+        builder down with it would otherwise be retried forever).
+        Buffered job states are written first, so that this sees every job that has just finished.
+        """
+        await job_state_writer.flush()
+        now = datetime.now(tz=timezone.utc)
+        async with get_pool().connection() as conn:
+            await conn.execute(
+                "UPDATE archival_group_activity a SET status = %s, next_attempt = NULL, finished = %s, "
+                "error_message = 'Skipped retry because a later activity for this archival group has succeeded' "
+                "WHERE a.status = %s AND EXISTS (SELECT 1 FROM archival_group_activity b "
+                "WHERE b.archival_group_uri = a.archival_group_uri AND b.status = %s AND b.id > a.id)",
+                (STATUS_SKIPPED, now, STATUS_FAILED, STATUS_SUCCEEDED))
+            await conn.execute(
+                "UPDATE archival_group_activity SET status = %s, next_attempt = NULL, finished = %s, "
+                "error_message = 'Lease expired on the last attempt; the builder processing it may have stopped' "
+                f"WHERE status = %s AND next_attempt <= %s AND attempts >= %s AND {PARTITION_CONDITION}",
+                (STATUS_DEAD, now, STATUS_RUNNING, now, settings.JOB_MAX_ATTEMPTS,
+                 settings.BUILDER_REPLICA_COUNT, settings.BUILDER_REPLICA_INDEX))
+            sql = ("UPDATE archival_group_activity SET status = %s, attempts = attempts + 1, next_attempt = %s, "
+                   "error_message = NULL, finished = NULL "
+                   "WHERE id IN (SELECT id FROM archival_group_activity "
+                   f"WHERE status IN (%s, %s) AND next_attempt <= %s AND {PARTITION_CONDITION} "
+                   "ORDER BY next_attempt LIMIT %s FOR UPDATE SKIP LOCKED) "
+                   f"RETURNING {ACTIVITY_COLUMNS}")
+            values = (STATUS_RUNNING, now + timedelta(seconds=settings.JOB_LEASE_DURATION),
+                      STATUS_FAILED, STATUS_RUNNING, now,
+                      settings.BUILDER_REPLICA_COUNT, settings.BUILDER_REPLICA_INDEX, limit)
+            cur = await conn.execute(sql, values)
+            jobs = [ArchivalGroupActivity.from_row(row) for row in await cur.fetchall()]
+        # The high-water mark, not this queue, decides which activities are new; keep retries in stream order
+        jobs.sort(key=lambda job: (job.activity_end_time, job.id_))
+        return jobs
+
+
+    @staticmethod
+    async def requeue(uri_prefix:str=None, since:datetime=None, until:datetime=None, include_finished:bool=False) -> int:
+        """
+        Queue jobs to be processed again, with a fresh set of attempts, by the builder whose partition
+        they are in. By default only failed and dead jobs are requeued; include_finished also
+        requeues succeeded and skipped ones.
+        Jobs can be limited to archival group URIs starting with uri_prefix, and to activities that
+        ended in [since, until). Returns the number of jobs requeued.
+        The saved Manifest fingerprints for the archival groups requeued are cleared, so that their
+        Manifests are PUT to IIIF-CS again even if what is built hasn't changed.
+        """
+        statuses = [STATUS_FAILED, STATUS_DEAD]
+        if include_finished:
+            statuses += [STATUS_SUCCEEDED, STATUS_SKIPPED]
+        conditions = ["status = ANY(%s)"]
+        values:list = [statuses]
+        if uri_prefix:
+            conditions.append("starts_with(archival_group_uri, %s)")
+            values.append(uri_prefix)
+        if since is not None:
+            conditions.append("activity_end_time >= %s")
+            values.append(since)
+        if until is not None:
+            conditions.append("activity_end_time < %s")
+            values.append(until)
+        sql = ("WITH requeued AS ("
+               "UPDATE archival_group_activity SET status = %s, attempts = 1, next_attempt = NULL, "
+               "started = %s, error_message = NULL, finished = NULL "
+               f"WHERE {' AND '.join(conditions)} RETURNING archival_group_uri), "
+               "cleared AS (DELETE FROM manifest_fingerprint WHERE id_service_pid IN ("
+               "SELECT id_service_pid FROM archival_group_activity "
+               "WHERE archival_group_uri IN (SELECT archival_group_uri FROM requeued) AND id_service_pid IS NOT NULL)) "
+               "SELECT count(*) FROM requeued")
+        async with get_pool().connection() as conn:
+            cur = await conn.execute(sql, [STATUS_QUEUED, datetime.now(tz=timezone.utc)] + values)
+            return (await cur.fetchone())[0]
+
+
+    @staticmethod
+    async def count_backlog() -> dict[str, int]:
+        """The number of unfinished jobs (queued, running, or failed and waiting to be retried), by status"""
+        await job_state_writer.flush()
+        sql = ("SELECT status, count(*) FROM archival_group_activity "
+               "WHERE status = ANY(%s) GROUP BY status")
+        async with get_pool().connection() as conn:
+            cur = await conn.execute(sql, [[STATUS_QUEUED, STATUS_RUNNING, STATUS_FAILED]])
+            return {status: count for status, count in await cur.fetchall()}
 
-        if new_id != -1:
-            return ArchivalGroupActivity.get_from_id(new_id)
+
+    @staticmethod
+    async def get_queued_by_partition() -> dict[int, tuple[int, datetime]]:
+        """For each partition with queued jobs: how many there are, and when the oldest was queued"""
+        sql = ("SELECT mod(abs(hashtext(archival_group_uri)::bigint), %s) AS partition, count(*), min(started) "
+               "FROM archival_group_activity WHERE status = %s GROUP BY partition")
+        async with get_pool().connection() as conn:
+            cur = await conn.execute(sql, [settings.BUILDER_REPLICA_COUNT, STATUS_QUEUED])
+            return {partition: (count, oldest) for partition, count, oldest in await cur.fetchall()}
 
 
     @staticmethod
-    def get_from_id(id_:int)-> 'ArchivalGroupActivity | None':
-        with psycopg.connect(settings.POSTGRES_CONNECTION) as conn:
-            with conn.cursor() as cur:
-                sql = ("SELECT id, activity_end_time, archival_group_uri, activity_type, "
-                       "id_service_pid, catalogue_api_uri, public_manifest_uri, "
-                       "internal_public_manifest_uri, internal_api_manifest_uri, "
-                       "started, finished, error_message "
-                       "FROM archival_group_activity WHERE id = %s")
-                result = cur.execute(sql, [id_]).fetchone()
-                if result is None:
-                    return None
-                row = result
-                return ArchivalGroupActivity(
-                    id_=row[0],
-                    activity_end_time=row[1],
-                    archival_group_uri=row[2],
-                    activity_type=row[3],
-                    id_service_pid=row[4],
-                    catalogue_api_uri=row[5],
-                    public_manifest_uri=row[6],
-                    internal_public_manifest_uri=row[7],
-                    internal_api_manifest_uri=row[8],
-                    started=row[9],
-                    finished=row[10],
-                    error_message=row[11]
-                )
+    async def archive_finished(before:datetime, batch_size:int) -> int:
+        """
+        Move up to batch_size succeeded and skipped jobs for activities that ended before `before`
+        from archival_group_activity to archival_group_activity_archive, oldest first.
+        The move is a single statement, so a row is never in both tables or neither.
+        Returns the number of jobs moved.
+        """
+        sql = ("WITH moved AS ("
+               "DELETE FROM archival_group_activity WHERE id IN ("
+               "SELECT id FROM archival_group_activity "
+               "WHERE activity_end_time < %s AND status = ANY(%s) "
+               "ORDER BY activity_end_time LIMIT %s) "
+               f"RETURNING {ACTIVITY_COLUMNS}) "
+               f"INSERT INTO archival_group_activity_archive ({ACTIVITY_COLUMNS}) "
+               f"SELECT {ACTIVITY_COLUMNS} FROM moved")
+        async with get_pool().connection() as conn:
+            cur = await conn.execute(sql, [before, list(ARCHIVABLE_STATUSES), batch_size])
+            return cur.rowcount
+
+
+    def succeed(self):
+        self.status = STATUS_SUCCEEDED
+        self.finished = datetime.now(timezone.utc)
+        self.next_attempt = None
+        self.save()
+
+
+    def skip(self, message:str):
+        """Finished, but deliberately not processed (not really an error)"""
+        self.status = STATUS_SKIPPED
+        self.error_message = message
+        self.finished = datetime.now(timezone.utc)
+        self.next_attempt = None
+        self.save()
+
+
+    def fail(self, message:str):
+        """Record a failure; the job is tried again later, unless it has run out of attempts"""
+        self.error_message = message
+        if self.attempts >= settings.JOB_MAX_ATTEMPTS:
+            self.status = STATUS_DEAD
+            self.next_attempt = None
+        else:
+            self.status = STATUS_FAILED
+            delay = min(settings.JOB_RETRY_BASE_DELAY * (2 ** (self.attempts - 1)), settings.JOB_RETRY_MAX_DELAY)
+            self.next_attempt = datetime.now(timezone.utc) + timedelta(seconds=delay)
+        self.save()
+
+
+    async def hold_lease(self):
+        """
+        Renew the lease on this job every third of JOB_LEASE_DURATION for as long as it is running,
+        so that it isn't claimed again however long it takes. Run as a task alongside the processing.
+        """
+        while True:
+            await asyncio.sleep(settings.JOB_LEASE_DURATION / 3)
+            if self.status != STATUS_RUNNING:
+                return
+            self.next_attempt = datetime.now(timezone.utc) + timedelta(seconds=settings.JOB_LEASE_DURATION)
+            self.save()
 
 
     def save(self):
-        with psycopg.connect(settings.POSTGRES_CONNECTION) as conn:
-            with conn.cursor() as cur:
-                sql = ("UPDATE archival_group_activity SET  "
-                       "id_service_pid=%s, catalogue_api_uri=%s, public_manifest_uri=%s, "
-                       "internal_public_manifest_uri=%s, internal_api_manifest_uri=%s, "
-                       "finished=%s, error_message=%s "
-                       "WHERE id = %s")
-                values = (
-                    self.id_service_pid,
-                    self.catalogue_api_uri,
-                    self.public_manifest_uri,
-                    self.internal_public_manifest_uri,
-                    self.internal_api_manifest_uri,
-                    self.finished,
-                    self.error_message,
-                    self.id_
-                )
-                cur.execute(sql, values)
-
-
-
-# create table archival_group_activity
-# (
-#     id                           serial
-#         primary key,
-#     activity_end_time            timestamp with time zone not null,
-#     archival_group_uri           text                     not null,
-#     activity_type                text                     not null,
-#     id_service_pid               text,
-#     catalogue_api_uri            text,
-#     public_manifest_uri          text,
-#     internal_public_manifest_uri text,
-#     internal_api_manifest_uri    text,
-#     started                      timestamp with time zone not null,
-#     finished                     timestamp with time zone,
-#     error_message                text
-# );
-#
-# alter table archival_group_activity
-#     owner to postgres;
+        """
+        Record the current state of this job. The UPDATE is not issued immediately;
+        job_state_writer coalesces changes and writes them in batches.
+        """
+        job_state_writer.save(self)
+
+
+    def get_state_values(self) -> tuple:
+        """The parameters for UPDATE_ACTIVITY_SQL"""
+        return (
+            self.id_service_pid,
+            self.catalogue_api_uri,
+            self.public_manifest_uri,
+            self.internal_public_manifest_uri,
+            self.internal_api_manifest_uri,
+            self.finished,
+            self.error_message,
+            self.status,
+            self.attempts,
+            self.next_attempt,
+            *(self.stage_timings.get(stage, None) for stage in ACTIVITY_STAGES),
+            self.id_
+        )
+
+
+class AdvisoryLock:
+    """
+    A Postgres session-level advisory lock, held on a connection taken out of the pool for as long
+    as the lock is held. If that connection is lost, so is the lock; check with is_held.
+    """
+    def __init__(self, key:int):
+        self.key = key
+        self._conn = None
+
+
+    async def try_acquire(self) -> bool:
+        if self._conn is not None:
+            return True
+        conn = await get_pool().getconn()
+        try:
+            await conn.set_autocommit(True)
+            cur = await conn.execute("SELECT pg_try_advisory_lock(%s)", [self.key])
+            acquired = (await cur.fetchone())[0]
+        except Exception:
+            await self._put_back(conn)
+            raise
+        if acquired:
+            self._conn = conn
+            return True
+        await self._put_back(conn)
+        return False
+
+
+    async def is_held(self) -> bool:
+        if self._conn is None:
+            return False
+        try:
+            await self._conn.execute("SELECT 1")
+            return True
+        except Exception as e:
+            logger.warning(f"Lost the connection holding advisory lock {self.key}: {repr(e)}")
+            conn, self._conn = self._conn, None
+            await get_pool().putconn(conn)
+            return False
+
+
+    async def release(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        try:
+            await conn.execute("SELECT pg_advisory_unlock(%s)", [self.key])
+        except Exception as e:
+            logger.warning(f"Unable to release advisory lock {self.key}: {repr(e)}")
+        await self._put_back(conn)
+
+
+    @staticmethod
+    async def _put_back(conn):
+        try:
+            await conn.set_autocommit(False)
+        except Exception:
+            pass
+        await get_pool().putconn(conn)
+
+
+class ManifestFingerprint:
+    """
+    The fingerprint of the last Manifest successfully PUT to IIIF-CS for each identity service PID,
+    so that an unchanged Manifest can be skipped without any IIIF-CS traffic.
+    """
+
+    @staticmethod
+    async def get(id_service_pid:str) -> str | None:
+        async with get_pool().connection() as conn:
+            cur = await conn.execute("SELECT fingerprint FROM manifest_fingerprint WHERE id_service_pid = %s", [id_service_pid])
+            result = await cur.fetchone()
+            if result is None:
+                return None
+            return result[0]
+
+
+    @staticmethod
+    async def set(id_service_pid:str, fingerprint:str):
+        async with get_pool().connection() as conn:
+            sql = ("INSERT INTO manifest_fingerprint (id_service_pid, fingerprint, updated) "
+                   "VALUES (%s, %s, %s) "
+                   "ON CONFLICT (id_service_pid) DO UPDATE SET fingerprint = EXCLUDED.fingerprint, updated = EXCLUDED.updated")
+            await conn.execute(sql, (id_service_pid, fingerprint, datetime.now(tz=timezone.utc)))
+
+
+class LookupCacheRow:
+    """
+    The persistent tier of a LookupCache: one row per cache name and key,
+    holding the JSON value and the validators the upstream service sent with it.
+    """
+
+    @staticmethod
+    async def get(cache_name:str, cache_key:str) -> tuple | None:
+        """(value, etag, last_modified, stored) or None"""
+        async with get_pool().connection() as conn:
+            sql = ("SELECT value, etag, last_modified, stored FROM lookup_cache "
+                   "WHERE cache_name = %s AND cache_key = %s")
+            cur = await conn.execute(sql, (cache_name, cache_key))
+            return await cur.fetchone()
+
+
+    @staticmethod
+    async def set(cache_name:str, cache_key:str, value, etag:str, last_modified:str, stored:datetime):
+        async with get_pool().connection() as conn:
+            sql = ("INSERT INTO lookup_cache (cache_name, cache_key, value, etag, last_modified, stored) "
+                   "VALUES (%s, %s, %s, %s, %s, %s) "
+                   "ON CONFLICT (cache_name, cache_key) DO UPDATE SET value = EXCLUDED.value, etag = EXCLUDED.etag, "
+                   "last_modified = EXCLUDED.last_modified, stored = EXCLUDED.stored")
+            await conn.execute(sql, (cache_name, cache_key, Jsonb(value), etag, last_modified, stored))
+
+
+class JobStateWriter:
+    """
+    Write-behind buffer for ArchivalGroupActivity state changes.
+    process_activity saves a job after nearly every step; only the latest state of each
+    job is kept here, and the buffer is flushed in a single batch either every
+    flush_interval seconds or as soon as batch_size jobs are waiting.
+    If Postgres can't be reached the whole batch is kept for the next flush. If the batch
+    fails for any other reason its rows are written one at a time, so that one bad row
+    doesn't hold up the rest; a row that fails on its own max_attempts times is dropped.
+    """
+    def __init__(self, batch_size:int, flush_interval:float, max_attempts:int):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_attempts = max(1, max_attempts)
+        self._pending:dict[int, tuple] = {}
+        self._failed_attempts:dict[int, int] = {}
+        self._flush_lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._task:asyncio.Task | None = None
+
+
+    def save(self, job:ArchivalGroupActivity):
+        # Take a copy of the values now - later changes to the job will be saved again
+        self._pending[job.id_] = job.get_state_values()
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+
+
+    async def flush(self):
+        async with self._flush_lock:
+            if len(self._pending) == 0:
+                return
+            batch = self._pending
+            self._pending = {}
+            try:
+                async with get_pool().connection() as conn:
+                    async with conn.cursor() as cur:
+                        await cur.executemany(UPDATE_ACTIVITY_SQL, list(batch.values()))
+                logger.debug(f"Flushed state of {len(batch)} jobs")
+                self._failed_attempts.clear()
+            except CONNECTION_ERRORS as e:
+                logger.error(f"Unable to flush state of {len(batch)} jobs, will retry: {repr(e)}")
+                self._requeue(batch)
+            except Exception as e:
+                logger.warning(f"Unable to flush state of {len(batch)} jobs as a batch, "
+                               f"writing them one at a time: {repr(e)}")
+                await self._flush_rows(batch)
+
+
+    async def _flush_rows(self, batch:dict[int, tuple]):
+        remaining = dict(batch)
+        try:
+            async with get_pool().connection() as conn:
+                for id_, values in batch.items():
+                    try:
+                        async with conn.transaction():
+                            await conn.execute(UPDATE_ACTIVITY_SQL, values)
+                        self._failed_attempts.pop(id_, None)
+                    except CONNECTION_ERRORS:
+                        raise
+                    except Exception as e:
+                        attempts = self._failed_attempts.get(id_, 0) + 1
+                        if attempts >= self.max_attempts:
+                            logger.error(f"Dropping state of job {id_} after {attempts} failed writes: {repr(e)}")
+                            self._failed_attempts.pop(id_, None)
+                        else:
+                            logger.error(f"Unable to write state of job {id_} (attempt {attempts}), will retry: {repr(e)}")
+                            self._failed_attempts[id_] = attempts
+                            self._requeue({id_: values})
+                    del remaining[id_]
+        except CONNECTION_ERRORS as e:
+            logger.error(f"Unable to flush state of {len(remaining)} jobs, will retry: {repr(e)}")
+            self._requeue(remaining)
+
+
+    def _requeue(self, batch:dict[int, tuple]):
+        for id_, values in batch.items():
+            # don't overwrite anything saved while the flush was failing
+            self._pending.setdefault(id_, values)
+
+
+    def start(self, signal_handler):
+        self._stopping = False
+        self._task = asyncio.create_task(self._run(signal_handler))
+
+
+    async def stop(self):
+        """Stop the background flush and write anything still pending"""
+        self._stopping = True
+        self._wake.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+
+
+    async def _run(self, signal_handler):
+        while not (self._stopping or signal_handler.cancellation_requested()):
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+        # Final flush on cancellation
+        await self.flush()
+
+
+job_state_writer = JobStateWriter(settings.JOB_STATE_FLUSH_BATCH_SIZE, settings.JOB_STATE_FLUSH_INTERVAL,
+                                  settings.JOB_STATE_MAX_WRITE_ATTEMPTS)
+
+
+# The schema is in app/migrations, applied at startup (or with python -m app.migrate)
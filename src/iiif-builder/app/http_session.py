@@ -0,0 +1,24 @@
+import aiohttp
+
+from app import settings
+
+
+def create_session() -> aiohttp.ClientSession:
+    """
+    The ClientSession shared by every call iiif-builder makes. Connections to each host
+    (Preservation, the identity service, the catalogue API and IIIF-CS) are pooled and kept alive
+    between requests, up to HTTP_CONNECTIONS_PER_HOST at a time, and DNS lookups are cached.
+    Responses must be used with `async with` so their connections go back to the pool.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=settings.HTTP_CONNECTION_LIMIT,
+        limit_per_host=settings.HTTP_CONNECTIONS_PER_HOST,
+        ttl_dns_cache=settings.HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=settings.HTTP_KEEPALIVE_TIMEOUT
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=settings.HTTP_TOTAL_TIMEOUT,
+        connect=settings.HTTP_CONNECT_TIMEOUT,
+        sock_read=settings.HTTP_READ_TIMEOUT
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
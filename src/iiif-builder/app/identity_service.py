@@ -3,8 +3,14 @@ import urllib
 from aiohttp import ClientSession
 
 from app import settings
+from app.lookup_cache import CacheEntry, LookupCache
+from app.resilience import resilient_request
 from app.result import Result
 
+# The PID and manifest URI for an archival group don't change, so these can be kept for a long time
+identity_cache = LookupCache("identity", settings.IDENTITY_CACHE_TTL, settings.LOOKUP_CACHE_MAX_ENTRIES,
+                             settings.LOOKUP_CACHE_PERSISTENT)
+
 container_aliases = {}
 if settings.PRESERVATION_COLLECTIONS_CONTAINER_ALIASES and not settings.PRESERVATION_COLLECTIONS_CONTAINER_ALIASES.isspace():
     for pairs in settings.PRESERVATION_COLLECTIONS_CONTAINER_ALIASES.split(','):
@@ -44,16 +50,26 @@ def mutate(archival_group_uri):
 async def get_identities_from_archival_group(session: ClientSession, archival_group_uri) -> Result:
 
     for_query = mutate(archival_group_uri)
+    cached = await identity_cache.get(for_query)
+    if cached is not None and identity_cache.is_fresh(cached):
+        return Result.success(cached.value)
 
     headers = {
         settings.IDENTITY_SERVICE_API_HEADER: settings.IDENTITY_SERVICE_API_KEY
     }
+    if cached is not None:
+        headers.update(cached.get_conditional_headers())
     query_url = f"{settings.IDENTITY_SERVICE_BASE_URL}/ids?q={for_query}&s=repositoryuri"
-    response = await session.get(query_url, headers=headers)
-    if response.status != 200:
-        return Result(False, response.status)
-
-    results_page = await response.json()
+    async with resilient_request(session, "GET", query_url, headers=headers) as response:
+        if response.status == 304 and cached is not None:
+            await identity_cache.revalidated(for_query, cached)
+            return Result.success(cached.value)
+        if response.status != 200:
+            return Result(False, response.status)
+
+        results_page = await response.json()
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
     results = results_page.get('results', [])
     if len(results) == 0:
         return Result(False, "No results found")
@@ -62,12 +78,14 @@ async def get_identities_from_archival_group(session: ClientSession, archival_gr
 
     result = results[0]
 
-    return Result.success({
+    identities = {
         "pid": result.get('id'), # should be same as pid
         "manifest_uri": result.get('manifesturi'),
         "catalogue_api_uri": result.get('catalogueapiuri'),
         "catirn": result.get('catirn')
-    })
+    }
+    await identity_cache.set(for_query, CacheEntry(identities, etag, last_modified))
+    return Result.success(identities)
 
 
 def get_internal_iiif_uris(public_manifest_uri):
@@ -1,46 +1,231 @@
 import urllib
+from contextlib import aclosing
 from datetime import datetime, timezone
-import aiohttp
+from functools import partial
 import asyncio
+import time
 import app.settings as settings
 from logzero import logger
 
 from app.signal_handler import SignalHandler
-from app.db import ArchivalGroupActivity
-from app.preservation_api import get_activities, load_archival_group, load_mets
-from app.identity_service import get_identities_from_archival_group, get_internal_iiif_uris
-from app.catalogue_api import read_catalogue_api
+from app.structured_logging import configure_logging, job_log_context
+from app.activity_summary import ActivitySummary, timed_stage
+from app.metrics import MetricsServer, record_queued_partitions, record_stream_position
+from app.http_session import create_session
+from app.migrate import apply_migrations
+from app.db import (ArchivalGroupActivity, AdvisoryLock, ManifestFingerprint, open_pool, close_pool, job_state_writer,
+                    LEADER_LOCK_KEY, PARTITION_LOCK_KEY_BASE, STATUS_QUEUED, STATUS_RUNNING)
+from app.preservation_api import ActivityStreamError, ActivityStreamState, get_activities, load_archival_group, load_mets, open_mets_parse_pool, close_mets_parse_pool, preservation_token_provider
+from app.identity_service import get_identities_from_archival_group, get_internal_iiif_uris, identity_cache
+from app.catalogue_api import read_catalogue_api, catalogue_cache
 from app.boilerplate import get_boilerplate_manifest
 from app.manifest_decorator import add_descriptive_metadata_to_manifest, add_painted_resources
-from app.iiif_cloud_services import put_manifest
+from app.iiif_cloud_services import get_manifest_fingerprint, put_manifest
+from app.poll_interval import AdaptivePollInterval
+from app.worker_pool import ActivityWorkerPool
+from app.activity_coalescer import ActivityCoalescer
+from app.pipeline import gather_results
+from app.result import Result
 
 archival_group_prefixes = settings.ARCHIVAL_GROUP_PREFIXES_TO_PROCESS.split(',')
 
-async def read_stream():
+async def read_stream(signal_handler:SignalHandler=None):
+    configure_logging()
     logger.info("starting iiif-builder...")
-    signal_handler = SignalHandler()
+    if signal_handler is None:
+        signal_handler = SignalHandler()
+    worker_pool = ActivityWorkerPool(settings.ACTIVITY_WORKER_COUNT, settings.ACTIVITY_WORKER_MAX_PENDING)
 
+    await open_pool()
+    if settings.APPLY_MIGRATIONS_ON_STARTUP:
+        await apply_migrations()
+    open_mets_parse_pool()
+    preservation_token_provider.start()
+    job_state_writer.start(signal_handler)
+    metrics_server = MetricsServer(worker_pool)
     try:
-        async with aiohttp.ClientSession() as session:
-            while not signal_handler.cancellation_requested():
-                last_event_time = ArchivalGroupActivity.get_latest_end_time()
-                activities_result = await get_activities(settings.PRESERVATION_ACTIVITY_STREAM, session, last_event_time)
-                if activities_result.success:
-                    for activity in reversed(activities_result.value):
-                        logger.debug(f"Processing activity with endTime={activity["endTime"]}")
-                        await process_activity(activity, session)
+        if settings.METRICS_PORT > 0:
+            await metrics_server.start()
+        async with create_session() as session:
+            try:
+                if settings.BUILDER_MODE == "coordinated":
+                    logger.info(f"Running as builder {settings.BUILDER_REPLICA_INDEX} of {settings.BUILDER_REPLICA_COUNT}")
+                    async with asyncio.TaskGroup() as task_group:
+                        task_group.create_task(lead_stream(signal_handler, session))
+                        task_group.create_task(work_partition(signal_handler, session, worker_pool))
                 else:
-                    logger.error(f"Could not read activities: {activities_result.error}")
-
-                logger.debug(f"Sleeping for {settings.ACTIVITY_STREAM_READ_INTERVAL}s")
-                await asyncio.sleep(settings.ACTIVITY_STREAM_READ_INTERVAL)
+                    await read_and_process_stream(signal_handler, session, worker_pool)
+            finally:
+                # Don't abandon jobs that are already in flight
+                await worker_pool.drain()
     except Exception as e:
         logger.error(f"Fatal error in iiif-builder: {repr(e)}")
         raise e
+    finally:
+        await metrics_server.stop()
+        await job_state_writer.stop()
+        await preservation_token_provider.stop()
+        close_mets_parse_pool()
+        await close_pool()
 
     logger.info("stopping iiif-builder..")
 
 
+async def read_and_process_stream(signal_handler, session, worker_pool:ActivityWorkerPool):
+    """Single mode: read the stream and process each activity as it arrives"""
+    poll_interval = AdaptivePollInterval(settings.ACTIVITY_STREAM_MIN_READ_INTERVAL, settings.ACTIVITY_STREAM_READ_INTERVAL)
+    stream_state = ActivityStreamState()
+    coalescer = ActivityCoalescer()
+    while not signal_handler.cancellation_requested():
+        last_event_time = await ArchivalGroupActivity.get_latest_end_time()
+        record_stream_position(last_event_time)
+        activity_count = 0
+        batch_end_time = None
+        read_failed = False
+        coalescer.new_batch()
+        try:
+            async with aclosing(get_activities(settings.PRESERVATION_ACTIVITY_STREAM, session, last_event_time, stream_state)) as activities:
+                async for activity in activities:
+                    if signal_handler.cancellation_requested():
+                        break
+                    activity_count += 1
+                    logger.debug(f"Processing activity with endTime={activity["endTime"]}")
+                    # The job row is created here, in stream order, rather than by the worker.
+                    # The high-water mark is the latest activity_end_time recorded, so it must
+                    # never get ahead of an activity that is still waiting for a worker.
+                    job = await create_job(activity)
+                    batch_end_time = job.activity_end_time
+                    coalescer.add(job)
+                    await worker_pool.submit(job.archival_group_uri, partial(run_job, job, session, coalescer))
+        except ActivityStreamError as e:
+            logger.error(f"Could not read activities: {e}")
+            read_failed = True
+        if batch_end_time is not None:
+            await ArchivalGroupActivity.update_checkpoint(batch_end_time)
+            record_stream_position(batch_end_time)
+        # Let this batch finish before reading the stream again
+        await worker_pool.drain()
+
+        if not signal_handler.cancellation_requested():
+            # Requeued jobs
+            await process_claimed_jobs(await ArchivalGroupActivity.claim_queued(settings.ACTIVITY_WORKER_MAX_PENDING), session, worker_pool)
+        if not signal_handler.cancellation_requested():
+            await process_claimed_jobs(await ArchivalGroupActivity.claim_retries(settings.JOB_RETRY_BATCH_SIZE), session, worker_pool)
+        if activity_count > 0:
+            logger.debug(f"Identity cache: {identity_cache.get_stats()}, catalogue cache: {catalogue_cache.get_stats()}")
+
+        interval = poll_interval.failed_interval() if read_failed else poll_interval.next_interval(activity_count > 0)
+        if interval > 0:
+            logger.debug(f"Sleeping for {interval}s")
+            await asyncio.sleep(interval)
+
+
+async def lead_stream(signal_handler, session):
+    """
+    Coordinated mode: whichever builder holds the leader lock reads the stream,
+    recording each activity as a queued job for the builder that owns its partition.
+    The leader also keeps an eye on the queued jobs in each partition, as nothing else would
+    notice a partition whose builder isn't running.
+    """
+    leader_lock = AdvisoryLock(LEADER_LOCK_KEY)
+    poll_interval = AdaptivePollInterval(settings.ACTIVITY_STREAM_MIN_READ_INTERVAL, settings.ACTIVITY_STREAM_READ_INTERVAL)
+    stream_state = ActivityStreamState()
+    next_partition_check = 0.0
+    try:
+        while not signal_handler.cancellation_requested():
+            if not await leader_lock.is_held():
+                if not await leader_lock.try_acquire():
+                    await asyncio.sleep(settings.BUILDER_LOCK_RETRY_INTERVAL)
+                    continue
+                logger.info("This builder is now the leader, reading the activity stream")
+                stream_state = ActivityStreamState()
+
+            last_event_time = await ArchivalGroupActivity.get_latest_end_time()
+            record_stream_position(last_event_time)
+            activity_count = 0
+            batch_end_time = None
+            read_failed = False
+            try:
+                async with aclosing(get_activities(settings.PRESERVATION_ACTIVITY_STREAM, session, last_event_time, stream_state)) as activities:
+                    async for activity in activities:
+                        if signal_handler.cancellation_requested():
+                            break
+                        activity_count += 1
+                        job = await create_job(activity, STATUS_QUEUED)
+                        batch_end_time = job.activity_end_time
+            except ActivityStreamError as e:
+                logger.error(f"Could not read activities: {e}")
+                read_failed = True
+            if batch_end_time is not None:
+                await ArchivalGroupActivity.update_checkpoint(batch_end_time)
+                record_stream_position(batch_end_time)
+            if activity_count > 0:
+                logger.debug(f"Queued {activity_count} activities")
+            if time.monotonic() >= next_partition_check:
+                await check_queued_partitions()
+                next_partition_check = time.monotonic() + settings.BUILDER_PARTITION_CHECK_INTERVAL
+
+            interval = poll_interval.failed_interval() if read_failed else poll_interval.next_interval(activity_count > 0)
+            if interval > 0:
+                await asyncio.sleep(interval)
+    finally:
+        await leader_lock.release()
+
+
+async def check_queued_partitions():
+    """Export the queued jobs in each partition, and warn about any partition whose jobs aren't being claimed"""
+    queued = await ArchivalGroupActivity.get_queued_by_partition()
+    now = datetime.now(tz=timezone.utc)
+    record_queued_partitions(queued, now)
+    for partition, (count, oldest) in sorted(queued.items()):
+        waiting = (now - oldest).total_seconds()
+        if waiting >= settings.BUILDER_PARTITION_STALL_AGE:
+            logger.warning(f"Partition {partition} has {count} queued job(s), the oldest waiting {waiting:.0f}s; "
+                           f"is the builder with BUILDER_REPLICA_INDEX={partition} running?")
+
+
+async def work_partition(signal_handler, session, worker_pool:ActivityWorkerPool):
+    """
+    Coordinated mode: claim and process the queued and retryable jobs in this builder's partition.
+    The partition lock stops two builders that have been given the same index from both working on it.
+    """
+    partition_lock = AdvisoryLock(PARTITION_LOCK_KEY_BASE + settings.BUILDER_REPLICA_INDEX)
+    poll_interval = AdaptivePollInterval(settings.ACTIVITY_STREAM_MIN_READ_INTERVAL, settings.ACTIVITY_STREAM_READ_INTERVAL)
+    try:
+        while not signal_handler.cancellation_requested():
+            if not await partition_lock.is_held():
+                if not await partition_lock.try_acquire():
+                    logger.error(f"Partition {settings.BUILDER_REPLICA_INDEX} is held by another builder; check BUILDER_REPLICA_INDEX")
+                    await asyncio.sleep(settings.BUILDER_LOCK_RETRY_INTERVAL)
+                    continue
+
+            jobs = await ArchivalGroupActivity.claim_queued(settings.ACTIVITY_WORKER_MAX_PENDING)
+            await process_claimed_jobs(jobs, session, worker_pool)
+            if not signal_handler.cancellation_requested():
+                await process_claimed_jobs(await ArchivalGroupActivity.claim_retries(settings.JOB_RETRY_BATCH_SIZE), session, worker_pool)
+            if len(jobs) > 0:
+                logger.debug(f"Identity cache: {identity_cache.get_stats()}, catalogue cache: {catalogue_cache.get_stats()}")
+
+            interval = poll_interval.next_interval(len(jobs) > 0)
+            if interval > 0:
+                await asyncio.sleep(interval)
+    finally:
+        await partition_lock.release()
+
+
+async def process_claimed_jobs(jobs:list[ArchivalGroupActivity], session, worker_pool:ActivityWorkerPool):
+    """Process jobs claimed from the DB (in order), coalescing those for the same archival group"""
+    if len(jobs) == 0:
+        return
+    logger.info(f"Processing {len(jobs)} claimed job(s)")
+    coalescer = ActivityCoalescer()
+    for job in jobs:
+        coalescer.add(job)
+    for job in jobs:
+        await worker_pool.submit(job.archival_group_uri, partial(run_job, job, session, coalescer))
+    await worker_pool.drain()
+
+
 def should_process(archival_group_uri):
     ag_path = urllib.parse.urlparse(archival_group_uri).path.lstrip('/').lstrip('repository/')
     for prefix in archival_group_prefixes:
@@ -50,47 +235,132 @@ def should_process(archival_group_uri):
     return False
 
 
-async def process_activity(activity, session):
-
-    job: ArchivalGroupActivity = ArchivalGroupActivity.new_activity(
+async def create_job(activity, status:str=STATUS_RUNNING) -> ArchivalGroupActivity:
+    return await ArchivalGroupActivity.new_activity(
         activity_end_time_date = datetime.fromisoformat(activity["endTime"]),
         archival_group_uri = activity["object"]["id"],
-        activity_type = activity["type"]
+        activity_type = activity["type"],
+        status = status
     )
 
+
+async def run_job(job: ArchivalGroupActivity, session, coalescer: ActivityCoalescer):
+    summary = ActivitySummary()
+    lease_renewal = asyncio.create_task(job.hold_lease())
+    with job_log_context(job.id_, job.archival_group_uri), summary.activate():
+        try:
+            superseding_job = coalescer.get_superseding_job(job)
+            if superseding_job is not None:
+                message = f"Skipping because a later activity for this archival group supersedes it (job {superseding_job.id_})"
+                logger.info(f"{message}: {job.archival_group_uri}")
+                job.skip(message)
+                return
+            await process_activity(job, session, summary)
+        except Exception as e:
+            # Other workers carry on; record the failure against this job only
+            logger.error(f"Unhandled error processing archival group {job.archival_group_uri}: {repr(e)}")
+            job.fail(f"Unhandled error: {repr(e)}")
+        finally:
+            lease_renewal.cancel()
+            # Only this attempt's timings are kept
+            job.stage_timings = dict(summary.timings)
+            job.save()
+            summary.log(job.status)
+
+
+async def process_activity(job: ArchivalGroupActivity, session, summary: ActivitySummary):
+
     if not should_process(job.archival_group_uri):
         # Not really an error though.
         message = "Skipping because AG URI doesn't match configured prefix(es)"
         logger.error(message)
-        job.error_message = message
-        job.finished = datetime.now(timezone.utc)
-        job.save()
+        job.skip(message)
+        return
+
+    # The archival group, its METS and its identities don't depend on each other, so they are
+    # fetched together; the catalogue only needs the identities. The first failure cancels the rest.
+    fetch_result = await gather_results(
+        fetch_archival_group(job, session),
+        fetch_mets(job, session),
+        fetch_identities_and_catalogue(job, session)
+    )
+    if fetch_result.failure:
+        job.fail(fetch_result.error)
+        return
+    archival_group, mets_wrapper, descriptive_metadata = fetch_result.value
+
+    iiif_cs = f"{settings.IIIF_CS_PRESENTATION_HOST}/{settings.IIIF_CS_CUSTOMER_ID}"
+    canvas_id_prefix = f"{iiif_cs}/canvases/{job.id_service_pid}_"
+    asset_prefix = f"{job.id_service_pid}_"
+
+    with summary.timed("manifest_build"):
+        manifest = get_boilerplate_manifest()
+        manifest["publicId"] = job.internal_public_manifest_uri
+        add_descriptive_metadata_result = add_descriptive_metadata_to_manifest(manifest, descriptive_metadata)
+        if add_descriptive_metadata_result.failure:
+            logger.error(f"Failed to parse descriptive metadata from catalogue API: {add_descriptive_metadata_result.error}")
+            job.fail(add_descriptive_metadata_result.error)
+            return
+
+        logger.debug(f"Adding painted resources to manifest {job.internal_public_manifest_uri}")
+        add_painted_resources_result = add_painted_resources(manifest, archival_group, mets_wrapper, canvas_id_prefix, asset_prefix)
+        if add_painted_resources_result.failure:
+            logger.error(f"Failed to add painted resources to Manifest: {add_painted_resources_result.error}")
+            job.fail(add_painted_resources_result.error)
+            return
+        summary.count("painted_resources", len(manifest['paintedResources']))
+        logger.debug(f"Added {len(manifest['paintedResources'])} painted resources to Manifest {job.internal_public_manifest_uri}")
+
+        # Taken before put_manifest marks assets for reingest, so it only reflects what we generated
+        fingerprint = get_manifest_fingerprint(manifest)
+
+    if fingerprint == await ManifestFingerprint.get(job.id_service_pid):
+        logger.debug(f"Manifest {job.internal_public_manifest_uri} is unchanged since it was last saved, not sending to IIIF-CS")
+        summary.count("manifest_unchanged", 1)
+        job.succeed()
         return
 
+    logger.debug(f"Saving Manifest to IIIF-CS: {job.internal_public_manifest_uri}")
+    put_manifest_result = await put_manifest(session, job.internal_api_manifest_uri, manifest)
+    if put_manifest_result.failure:
+        logger.error(f"Failed to PUT Manifest to IIIF-CS: {put_manifest_result.error}")
+        job.fail(put_manifest_result.error)
+        return
+    changes = put_manifest_result.value
+    if changes is not None:
+        summary.count("assets_added", len(changes.added))
+        summary.count("assets_removed", len(changes.removed))
+        summary.count("assets_origin_changed", len(changes.origin_changed))
+        summary.count("assets_unchanged", len(changes.unchanged))
+    await ManifestFingerprint.set(job.id_service_pid, fingerprint)
+
+    job.succeed()
+
+
+async def fetch_archival_group(job: ArchivalGroupActivity, session) -> Result:
     logger.debug(f"Loading archival group from {job.archival_group_uri}")
-    archival_group_result = await load_archival_group(session, job.archival_group_uri)
+    with timed_stage("ag_load"):
+        archival_group_result = await load_archival_group(session, job.archival_group_uri)
     if archival_group_result.failure:
         logger.error(f"Failed to load archival group: {archival_group_result.error}")
-        job.error_message = archival_group_result.error
-        job.save()
-        return
+    return archival_group_result
 
+
+async def fetch_mets(job: ArchivalGroupActivity, session) -> Result:
     logger.debug(f"Loading METS for archival group {job.archival_group_uri}")
     mets_result = await load_mets(session, job.archival_group_uri)
     if mets_result.failure:
         logger.error(f"Failed to load METS for archival group: {mets_result.error}")
-        job.error_message = mets_result.error
-        job.save()
-        return
+    return mets_result
 
-    logger.debug(f"Calling identity service for archival group {job.archival_group_uri}")
 
-    identities_result = await get_identities_from_archival_group(session, job.archival_group_uri)
+async def fetch_identities_and_catalogue(job: ArchivalGroupActivity, session) -> Result:
+    logger.debug(f"Calling identity service for archival group {job.archival_group_uri}")
+    with timed_stage("identity_lookup"):
+        identities_result = await get_identities_from_archival_group(session, job.archival_group_uri)
     if identities_result.failure:
         logger.error(f"Failed to get Identities for archival group{job.archival_group_uri}: {identities_result.error}")
-        job.error_message = identities_result.error
-        job.save()
-        return
+        return identities_result
 
     job.id_service_pid = identities_result.value["pid"]
     if settings.CONSTRUCT_CATALOGUE_API_URI:
@@ -104,47 +374,11 @@ async def process_activity(activity, session):
     iiif_cs = f"{settings.IIIF_CS_PRESENTATION_HOST}/{settings.IIIF_CS_CUSTOMER_ID}"
     job.internal_public_manifest_uri = f"{iiif_cs}/{path_part}"
     job.internal_api_manifest_uri    = f"{iiif_cs}/manifests/{job.id_service_pid}"
-    canvas_id_prefix                 = f"{iiif_cs}/canvases/{job.id_service_pid}_"
-    asset_prefix                     = f"{job.id_service_pid}_"
     job.save()
 
     logger.debug(f"Getting descriptive metadata from catalogue API for {job.catalogue_api_uri}")
-    descriptive_metadata_result = await read_catalogue_api(session, job.catalogue_api_uri)
+    with timed_stage("catalogue_read"):
+        descriptive_metadata_result = await read_catalogue_api(session, job.catalogue_api_uri)
     if descriptive_metadata_result.failure:
         logger.error(f"Failed to load descriptive metadata from catalogue API: {descriptive_metadata_result.error}")
-        job.error_message = descriptive_metadata_result.error
-        job.save()
-        return
-
-    manifest = get_boilerplate_manifest()
-    manifest["publicId"] = job.internal_public_manifest_uri
-    add_descriptive_metadata_result = add_descriptive_metadata_to_manifest(manifest, descriptive_metadata_result.value)
-    if add_descriptive_metadata_result.failure:
-        logger.error(f"Failed to parse descriptive metadata from catalogue API: {add_descriptive_metadata_result.error}")
-        job.error_message = add_descriptive_metadata_result.error
-        job.save()
-        return
-
-    logger.debug(f"Adding painted resources to manifest {job.internal_public_manifest_uri}")
-    add_painted_resources_result = add_painted_resources(manifest, archival_group_result.value, mets_result.value, canvas_id_prefix, asset_prefix)
-    if add_painted_resources_result.failure:
-        logger.error(f"Failed to add painted resources to Manifest: {add_painted_resources_result.error}")
-        job.error_message = add_painted_resources_result.error
-        job.save()
-        return
-    logger.info(f"Added {len(manifest['paintedResources'])} painted resources to Manifest {job.internal_public_manifest_uri}")
-
-    logger.debug(f"Saving Manifest to IIIF-CS: {job.internal_public_manifest_uri}")
-    put_manifest_result = await put_manifest(session, job.internal_api_manifest_uri, manifest)
-    if put_manifest_result.failure:
-        logger.error(f"Failed to PUT Manifest to IIIF-CS: {put_manifest_result.error}")
-        job.error_message = put_manifest_result.error
-        job.save()
-        return
-
-    job.finished = datetime.now(timezone.utc)
-    job.save()
-
-
-
-
+    return descriptive_metadata_result
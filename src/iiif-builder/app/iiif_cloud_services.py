@@ -1,10 +1,14 @@
 import json
+import logging
 import base64
+import hashlib
 
 from aiohttp import ClientSession
 from logzero import logger
 
 from app import settings
+from app.activity_summary import timed_stage
+from app.resilience import resilient_request
 from app.result import Result
 
 headers_show_extras = {
@@ -14,73 +18,116 @@ headers_show_extras = {
 
 
 async def put_manifest(session: ClientSession, api_manifest_uri:str, manifest) -> Result:
+    """PUT the Manifest to IIIF-CS. The result's value is the AssetChanges from the existing Manifest, or None if there wasn't one"""
 
-    logger.info(f"See if a Manifest already exists at {api_manifest_uri}")
-    existing_manifest_response = await session.get(api_manifest_uri, headers=headers_show_extras)
+    logger.debug("See if a Manifest already exists at %s", api_manifest_uri)
     etag = None
-    if existing_manifest_response.status == 404:
-        logger.debug(f"Manifest {api_manifest_uri} does not already exist")
-    elif existing_manifest_response.status == 200:
-        etag = existing_manifest_response.headers["etag"] # check case
-        logger.debug(f"Manifest {api_manifest_uri} already exists, etag is {etag}")
-        existing_manifest = await existing_manifest_response.json()
-        update_ingest_status(existing_manifest, manifest)
-    else:
-        msg = f"Manifest {api_manifest_uri} returned status {existing_manifest_response.status} - cannot process atm"
-        logger.warning(msg)
-        return Result(False, msg)
+    changes = None
+    with timed_stage("iiifcs_get"):
+        async with resilient_request(session, "GET", api_manifest_uri, headers=headers_show_extras) as existing_manifest_response:
+            if existing_manifest_response.status == 404:
+                logger.debug("Manifest %s does not already exist", api_manifest_uri)
+            elif existing_manifest_response.status == 200:
+                etag = existing_manifest_response.headers["etag"] # check case
+                logger.debug("Manifest %s already exists, etag is %s", api_manifest_uri, etag)
+                existing_manifest = await existing_manifest_response.json()
+                changes = update_ingest_status(existing_manifest, manifest)
+            else:
+                msg = f"Manifest {api_manifest_uri} returned status {existing_manifest_response.status} - cannot process atm"
+                logger.warning(msg)
+                return Result(False, msg)
 
     if etag is None:
         headers = headers_show_extras
     else:
+        # Conditional, so resilient_request won't retry it: had a failed attempt been applied, the retry
+        # would get a 412. A PUT that fails fails the job, and its retry starts again from the GET.
         headers = headers_show_extras.copy()
         headers["If-Match"] = etag
 
-    logger.info(f"Sending PUT to {api_manifest_uri}")
-    initial_put_response = await session.put(api_manifest_uri, headers=headers, json=manifest)
-    if not (initial_put_response.status == 202 or initial_put_response.status == 200):
-        msg = f"PUT to {api_manifest_uri} returned status {initial_put_response.status} - cannot continue"
-        logger.warning(msg)
-        logger.debug(json.dumps(manifest, indent=2))
-        return Result(False, msg)
+    logger.debug("Sending PUT to %s", api_manifest_uri)
+    with timed_stage("iiifcs_put"):
+        async with resilient_request(session, "PUT", api_manifest_uri, headers=headers, json=manifest) as initial_put_response:
+            if not (initial_put_response.status == 202 or initial_put_response.status == 200):
+                msg = f"PUT to {api_manifest_uri} returned status {initial_put_response.status} - cannot continue"
+                logger.warning(msg)
+                # Serialising the whole Manifest is expensive, so only done if it will be logged
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(json.dumps(manifest, indent=2))
+                return Result(False, msg)
+
+    logger.debug("PUT to %s has been sent", api_manifest_uri)
+    return Result.success(changes)
+
+def get_manifest_fingerprint(manifest) -> str:
+    """
+    A stable hash of the Manifest we generate: the same content always gives the same
+    fingerprint, whatever order its keys were added in.
+    """
+    canonical = json.dumps(manifest, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
 
-    logger.debug(f"PUT to {api_manifest_uri} has been sent")
-    return Result.success(manifest)
 
 def painted_resources_have_same_asset(p1, p2)->bool:
     return p1["asset"]["id"] == p2["asset"]["id"]
 
 
-def update_ingest_status(existing_manifest, new_manifest):
+class AssetChanges:
+    """
+    How the assets of a new Manifest differ from those of the existing one, as lists of asset ids.
+    An asset that appears more than once is only counted once.
+    """
+    def __init__(self):
+        self.added:list[str] = []
+        self.removed:list[str] = []
+        self.origin_changed:list[str] = []
+        self.unchanged:list[str] = []
+
+    def has_changes(self) -> bool:
+        return len(self.added) > 0 or len(self.removed) > 0 or len(self.origin_changed) > 0
+
+
+def update_ingest_status(existing_manifest, new_manifest) -> AssetChanges:
     # You could leave the IIIF-CS to decide whether or not to reingest a re-supplied asset.
     # But it plays it quite safe and may reingest things that haven't changed.
     # This is true for IIIF-CS but these requests won't make it "past" IIIF-P for that to kick in.
     # If an asset is repeated (appears more than once)
     # we only need to tell it to reingest once.
-    logger.info("Checking for assets that have changed")
-    logger.info(f"Existing manifest has {len(existing_manifest.get('paintedResources', []))} painted resources")
-    logger.info(f"New manifest has {len(new_manifest.get('paintedResources', []))} painted resources")
-    seen_ids = []
+    # Per-asset detail is only logged at DEBUG; the totals go in the activity summary
+    logger.debug("Existing manifest has %d painted resources, new manifest has %d",
+                 len(existing_manifest.get('paintedResources', [])), len(new_manifest.get('paintedResources', [])))
+    existing_by_asset_id = {}
+    for pr in existing_manifest.get("paintedResources", []):
+        # the first painted resource for an asset is the one that counts
+        existing_by_asset_id.setdefault(pr["asset"]["id"], pr)
+
+    changes = AssetChanges()
+    seen_ids = set()
     for new_painted_resource in new_manifest.get("paintedResources", []):
         asset_id = new_painted_resource["asset"]["id"]
         if asset_id in seen_ids:
-            logger.info(f"Asset {asset_id} has already been seen, skipping")
+            logger.debug("Asset %s has already been seen, skipping", asset_id)
             continue
-        seen_ids.append(asset_id)
-        existing_painted_resource = None
-        for pr in existing_manifest.get("paintedResources", []):
-            if pr["asset"]["id"] == asset_id:
-                logger.info(f"Found painted resource for asset {asset_id} in existing Manifest")
-                existing_painted_resource = pr
-                break
+        seen_ids.add(asset_id)
+        existing_painted_resource = existing_by_asset_id.get(asset_id, None)
 
         if existing_painted_resource is None:
-            logger.info(f"No existing painted resource for asset {asset_id}, so set reingest:true")
+            logger.debug("No existing painted resource for asset %s, so set reingest:true", asset_id)
             new_painted_resource["reingest"] = True
+            changes.added.append(asset_id)
             continue
 
         existing_origin = existing_painted_resource["asset"]["origin"]
         new_origin = new_painted_resource["asset"]["origin"]
         if existing_origin != new_origin:
-            logger.info(f"Existing painted resource for asset {asset_id} has different existing origin {existing_origin} and new origin {new_origin}, so set reingest:true")
+            logger.debug("Existing painted resource for asset %s has different existing origin %s and new origin %s, so set reingest:true",
+                         asset_id, existing_origin, new_origin)
             new_painted_resource["reingest"] = True
+            changes.origin_changed.append(asset_id)
+        else:
+            changes.unchanged.append(asset_id)
+
+    changes.removed = [asset_id for asset_id in existing_by_asset_id if asset_id not in seen_ids]
+    logger.debug("Assets added: %d, removed: %d, origin changed: %d, unchanged: %d",
+                 len(changes.added), len(changes.removed), len(changes.origin_changed), len(changes.unchanged))
+    return changes
@@ -0,0 +1,251 @@
+import asyncio
+import collections
+import hashlib
+import json
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+
+from aiohttp import web
+
+from app.mets_parser.synthetic_mets import get_synthetic_file_paths, write_synthetic_mets
+
+SERVICES = ("preservation", "identity", "catalogue", "iiif_cs")
+
+# The prefix the simulated identity service puts on public manifest URIs
+# (the builder's REWRITTEN_PUBLIC_IIIF_PRESENTATION_PREFIX)
+PUBLIC_PRESENTATION_PREFIX = "https://iiif.loadtest.example/presentation/"
+CONTAINER = "loadtest"
+
+
+class SimulatorConfig:
+    """
+    What the simulated services serve, and how they behave.
+    latency and error_rate are per service (see SERVICES): each response is delayed by between half and
+    one and a half times its service's latency (seconds), and error_rate of them are 503s instead.
+    """
+    def __init__(self,
+                 activity_count:int=1000,
+                 archival_group_count:int=200,
+                 package_sizes:list[int]=None,
+                 package_depth:int=1,
+                 page_size:int=100,
+                 arrival_rate:float=0,
+                 latency:dict[str, float]=None,
+                 error_rate:dict[str, float]=None,
+                 seed:int=1):
+        self.activity_count = activity_count
+        self.archival_group_count = max(1, archival_group_count)
+        self.package_sizes = package_sizes or [10, 100, 1000]
+        self.package_depth = package_depth
+        self.page_size = max(1, page_size)
+        # activities per second appearing in the stream; 0 means they are all there from the start
+        self.arrival_rate = arrival_rate
+        self.latency = latency or {}
+        self.error_rate = error_rate or {}
+        self.seed = seed
+
+
+class Simulator:
+    """
+    Local stand-ins for Preservation API (a paged activity stream, archival groups with a storageMap,
+    and their METS), the identity service, the catalogue API and IIIF-CS (Manifests with ETags, and
+    If-Match on PUT). Everything is generated from the config, so two runs with the same config
+    serve the same content. Counts of the requests each service received are served at /_stats.
+    """
+    def __init__(self, config:SimulatorConfig, base_url:str):
+        self.config = config
+        self.base_url = base_url.rstrip('/')
+        self.random = random.Random(config.seed)
+        self.started = time.time()
+        # Activities end just after the simulator starts, so they are newer than anything already in the DB
+        self.first_end_time = datetime.now(tz=timezone.utc)
+        self.package_sizes = [self.random.choice(config.package_sizes) for _ in range(config.archival_group_count)]
+        self.archival_group_order = [self.random.randrange(config.archival_group_count) for _ in range(config.activity_count)]
+        self.mets_cache:collections.OrderedDict[int, bytes] = collections.OrderedDict()
+        self.manifests:dict[str, tuple[str, bytes]] = {}
+        self.requests = collections.Counter()
+
+
+    def get_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.simulate])
+        app.router.add_get("/_stats", self.handle_stats)
+        app.router.add_get("/activity/collection", self.handle_collection)
+        app.router.add_get("/activity/pages/{page}", self.handle_page)
+        app.router.add_get(f"/repository/{CONTAINER}/{{ag}}", self.handle_archival_group)
+        app.router.add_get("/id/ids", self.handle_ids)
+        app.router.add_get("/catalogue/{pid}", self.handle_catalogue)
+        app.router.add_get("/iiif-cs/{customer}/manifests/{pid}", self.handle_get_manifest)
+        app.router.add_put("/iiif-cs/{customer}/manifests/{pid}", self.handle_put_manifest)
+        return app
+
+
+    @web.middleware
+    async def simulate(self, request:web.Request, handler):
+        service = get_service(request.path)
+        if service is None:
+            return await handler(request)
+        latency = self.config.latency.get(service, 0)
+        if latency > 0:
+            await asyncio.sleep(latency * self.random.uniform(0.5, 1.5))
+        if self.random.random() < self.config.error_rate.get(service, 0):
+            self.requests[f"{service} 503"] += 1
+            return web.Response(status=503)
+        response = await handler(request)
+        self.requests[f"{service} {response.status}"] += 1
+        return response
+
+
+    def get_visible_count(self) -> int:
+        if self.config.arrival_rate <= 0:
+            return self.config.activity_count
+        return min(self.config.activity_count, int((time.time() - self.started) * self.config.arrival_rate))
+
+
+    def get_archival_group_uri(self, index:int) -> str:
+        return f"{self.base_url}/repository/{CONTAINER}/ag_{index:06d}"
+
+
+    def get_pid(self, index:int) -> str:
+        return f"loadtest_{index:06d}"
+
+
+    async def handle_stats(self, request:web.Request) -> web.Response:
+        return web.json_response({"requests": dict(self.requests), "visible_activities": self.get_visible_count()})
+
+
+    async def handle_collection(self, request:web.Request) -> web.Response:
+        visible = self.get_visible_count()
+        etag = f'"{visible}"'
+        if request.headers.get("If-None-Match", None) == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        collection = {"type": "OrderedCollection", "totalItems": visible}
+        if visible > 0:
+            page_count = (visible + self.config.page_size - 1) // self.config.page_size
+            collection["first"] = {"id": f"{self.base_url}/activity/pages/1", "type": "OrderedCollectionPage"}
+            collection["last"] = {"id": f"{self.base_url}/activity/pages/{page_count}", "type": "OrderedCollectionPage"}
+        return web.json_response(collection, headers={"ETag": etag})
+
+
+    async def handle_page(self, request:web.Request) -> web.Response:
+        page = int(request.match_info["page"])
+        start = (page - 1) * self.config.page_size
+        end = min(start + self.config.page_size, self.get_visible_count())
+        if page < 1 or start >= end:
+            return web.Response(status=404)
+        items = []
+        for i in range(start, end):
+            items.append({
+                "type": "Update" if i >= self.config.archival_group_count else "Create",
+                "object": {"id": self.get_archival_group_uri(self.archival_group_order[i]), "type": "ArchivalGroup"},
+                "endTime": (self.first_end_time + timedelta(microseconds=i)).isoformat()
+            })
+        return web.json_response({"type": "OrderedCollectionPage", "orderedItems": items})
+
+
+    async def handle_archival_group(self, request:web.Request) -> web.Response:
+        index = int(request.match_info["ag"].removeprefix("ag_"))
+        if index >= self.config.archival_group_count:
+            return web.Response(status=404)
+        if request.query.get("view", None) == "mets":
+            return web.Response(body=self.get_mets(self.package_sizes[index]), content_type="application/xml")
+        paths = get_synthetic_file_paths(self.package_sizes[index], self.config.package_depth)
+        archival_group = {
+            "id": self.get_archival_group_uri(index),
+            "type": "ArchivalGroup",
+            "origin": f"s3://loadtest-bucket/ag_{index:06d}",
+            "storageMap": {"files": {path: {"fullPath": f"v1/content/{path}"} for path in paths}}
+        }
+        return web.json_response(archival_group)
+
+
+    def get_mets(self, file_count:int) -> bytes:
+        # Packages of the same size have the same METS; only the most recently used are kept
+        mets = self.mets_cache.get(file_count, None)
+        if mets is None:
+            f = BytesIO()
+            write_synthetic_mets(f, file_count, self.config.package_depth)
+            mets = f.getvalue()
+            self.mets_cache[file_count] = mets
+            while len(self.mets_cache) > 8:
+                self.mets_cache.popitem(last=False)
+        self.mets_cache.move_to_end(file_count)
+        return mets
+
+
+    async def handle_ids(self, request:web.Request) -> web.Response:
+        archival_group_uri = request.query.get("q", "")
+        prefix = f"{self.base_url}/repository/{CONTAINER}/ag_"
+        if not archival_group_uri.startswith(prefix):
+            return web.json_response({"results": []})
+        index = int(archival_group_uri.removeprefix(prefix))
+        pid = self.get_pid(index)
+        etag = f'"{pid}"'
+        if request.headers.get("If-None-Match", None) == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        result = {
+            "id": pid,
+            "manifesturi": f"{PUBLIC_PRESENTATION_PREFIX}{CONTAINER}/{pid}",
+            "catalogueapiuri": f"{self.base_url}/catalogue/{pid}",
+            "catirn": str(index)
+        }
+        return web.json_response({"results": [result]}, headers={"ETag": etag})
+
+
+    async def handle_catalogue(self, request:web.Request) -> web.Response:
+        pid = request.match_info["pid"]
+        etag = f'"{pid}"'
+        if request.headers.get("If-None-Match", None) == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        data = {
+            "Title": f"Load test package {pid}",
+            "Identifier": pid,
+            "Date": "2025",
+            "Description": [f"Generated by the iiif-builder load test simulator for {pid}"],
+            "Rights": ["http://rightsstatements.org/vocab/InC/1.0/"]
+        }
+        return web.json_response({"data": data}, headers={"ETag": etag})
+
+
+    async def handle_get_manifest(self, request:web.Request) -> web.Response:
+        stored = self.manifests.get(request.match_info["pid"], None)
+        if stored is None:
+            return web.Response(status=404)
+        etag, body = stored
+        return web.Response(body=body, content_type="application/json", headers={"ETag": etag})
+
+
+    async def handle_put_manifest(self, request:web.Request) -> web.Response:
+        pid = request.match_info["pid"]
+        stored = self.manifests.get(pid, None)
+        if_match = request.headers.get("If-Match", None)
+        if stored is not None and if_match != stored[0]:
+            return web.Response(status=412)
+        body = await request.read()
+        # the builder's reingest flags aren't part of what IIIF-CS keeps
+        manifest = json.loads(body)
+        for painted_resource in manifest.get("paintedResources", []):
+            painted_resource.pop("reingest", None)
+        body = json.dumps(manifest).encode("utf-8")
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        self.manifests[pid] = (etag, body)
+        return web.Response(body=body, content_type="application/json", headers={"ETag": etag})
+
+
+def get_service(path:str) -> str | None:
+    if path.startswith("/activity/") or path.startswith("/repository/"):
+        return "preservation"
+    if path.startswith("/id/"):
+        return "identity"
+    if path.startswith("/catalogue/"):
+        return "catalogue"
+    if path.startswith("/iiif-cs/"):
+        return "iiif_cs"
+    return None
+
+
+def run_simulator(config:SimulatorConfig, host:str, port:int):
+    """Serve the simulator until the process is stopped (the driver runs this in its own process)"""
+    simulator = Simulator(config, f"http://{host}:{port}")
+    web.run_app(simulator.get_app(), host=host, port=port, print=None, access_log=None)
@@ -0,0 +1,125 @@
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from logzero import logger
+
+from app import metrics
+from app.db import LookupCacheRow
+
+
+class CacheEntry:
+    """A cached lookup result, with the validators the upstream service sent with it (if any)"""
+    __slots__ = ("value", "etag", "last_modified", "stored")
+
+    def __init__(self, value, etag:str=None, last_modified:str=None, stored:float=None):
+        self.value = value
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored = stored if stored is not None else time.time()
+
+
+    def get_conditional_headers(self) -> dict:
+        """Headers for revalidating this entry with the upstream service"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class LookupCache:
+    """
+    Caches results from remote lookup services. Entries live in an in-process LRU of up to
+    max_entries, and are fresh for ttl seconds after they were stored (or last revalidated).
+    A stale entry is still returned by get, so the caller can revalidate it with a conditional
+    request rather than fetching it again. If persistent, entries are also written to the
+    lookup_cache table so a restarted builder starts warm; the table is read on an in-process miss.
+    Hits, misses, revalidations and the number of entries are exported as Prometheus metrics, labelled with name.
+    """
+    def __init__(self, name:str, ttl:float, max_entries:int, persistent:bool=False):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.persistent = persistent
+        self._entries:OrderedDict[str, CacheEntry] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        metrics.track_cache_entries(name, self._entries.__len__)
+
+
+    def is_fresh(self, entry:CacheEntry) -> bool:
+        return time.time() - entry.stored < self.ttl
+
+
+    async def get(self, key:str) -> CacheEntry | None:
+        """
+        The entry for key, fresh or stale, or None. Only a fresh entry counts as a hit.
+        """
+        entry = self._entries.get(key, None)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        elif self.persistent:
+            entry = await self._load(key)
+            if entry is not None:
+                self._remember(key, entry)
+
+        hit = entry is not None and self.is_fresh(entry)
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        metrics.observe_cache_lookup(self.name, hit)
+        return entry
+
+
+    async def set(self, key:str, entry:CacheEntry):
+        self._remember(key, entry)
+        if self.persistent:
+            await self._store(key, entry)
+
+
+    async def revalidated(self, key:str, entry:CacheEntry):
+        """The upstream service confirmed that entry is still current (e.g. HTTP 304)"""
+        self.revalidations += 1
+        metrics.observe_cache_revalidation(self.name)
+        entry.stored = time.time()
+        await self.set(key, entry)
+
+
+    def get_stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations
+        }
+
+
+    def _remember(self, key:str, entry:CacheEntry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+    async def _load(self, key:str) -> CacheEntry | None:
+        try:
+            row = await LookupCacheRow.get(self.name, key)
+        except Exception as e:
+            logger.warning(f"Unable to read {self.name} cache entry for {key}: {repr(e)}")
+            return None
+        if row is None:
+            return None
+        value, etag, last_modified, stored = row
+        return CacheEntry(value, etag, last_modified, stored.timestamp())
+
+
+    async def _store(self, key:str, entry:CacheEntry):
+        try:
+            await LookupCacheRow.set(self.name, key, entry.value, entry.etag, entry.last_modified,
+                                     datetime.fromtimestamp(entry.stored, tz=timezone.utc))
+        except Exception as e:
+            logger.warning(f"Unable to write {self.name} cache entry for {key}: {repr(e)}")
@@ -1,10 +1,12 @@
 import collections
+import logging
+import re
 
 from logzero import logger
 
 from app import settings
 from app.mets_parser.mets_wrapper import MetsWrapper
-from app.mets_parser.working_filesystem import WorkingDirectory
+from app.mets_parser.working_filesystem import WorkingDirectory, WorkingFile
 from app.result import Result
 
 
@@ -82,20 +84,46 @@ def add_metadata_label_and_value(manifest, data_dict, key, lang="en"):
     })
 
 
-def add_painted_resources(manifest, archival_group, mets:MetsWrapper, canvas_id_prefix, asset_prefix) -> Result:
+# How the files in an archival group are put in canvas order (CANVAS_ORDER)
+CANVAS_ORDER_FILES_FIRST = "files-first"   # folder by folder, each folder's files (in structMap order) before its sub-folders
+CANVAS_ORDER_STRUCTMAP = "structmap"        # exactly as the METS physical structMap lists them, files and folders interleaved
+CANVAS_ORDER_PATH = "path"                  # by path, folder by folder
+CANVAS_ORDER_NATURAL = "natural"            # by path, with runs of digits compared as numbers (page2 before page10)
+CANVAS_ORDERS = (CANVAS_ORDER_FILES_FIRST, CANVAS_ORDER_STRUCTMAP, CANVAS_ORDER_PATH, CANVAS_ORDER_NATURAL)
+
+class StorageMapError(Exception):
+    """A file in the METS has no entry in the archival group's storageMap"""
+
+
+# The storageMap escapes '#' in paths
+STORAGE_MAP_HASH_ESCAPE = '-_-percent-23-_-'
+_digits = re.compile(r'(\d+)')
+
+
+def add_painted_resources(manifest, archival_group, mets:MetsWrapper, canvas_id_prefix, asset_prefix,
+                          canvas_order:str=None) -> Result:
 
     # Note that there is no items[] in our manifest.
     # For IIIF-Builder MVP we are going to do EVERYTHING with paintedResources.
     if "items" in manifest:
         del manifest["items"]
-    manifest["paintedResources"] = []
-    working_dir = mets.physical_structure
-    if add_painted_resources_from_working_dir(manifest["paintedResources"], working_dir, archival_group, canvas_id_prefix, asset_prefix, canvas_index=0):
-        return Result(manifest)
-    return Result(False, f"Could not turn METS file information into painted resources: (error message)")
+    canvas_order = canvas_order or settings.CANVAS_ORDER
+    if canvas_order not in CANVAS_ORDERS:
+        return Result(False, f"Unknown canvas order {canvas_order}; expected one of {', '.join(CANVAS_ORDERS)}")
+    if canvas_order == CANVAS_ORDER_STRUCTMAP:
+        # The parser lists the files in the order it met them walking the structMap
+        files = mets.files
+    else:
+        files = iter_files(mets.physical_structure, canvas_order)
+    try:
+        manifest["paintedResources"] = list(iter_painted_resources(
+            files, archival_group, canvas_id_prefix, asset_prefix))
+    except StorageMapError as e:
+        return Result(False, f"Could not turn METS file information into painted resources: {e}")
+    return Result.success(manifest)
 
 
-def add_painted_resources_from_working_dir(painted_resources, working_dir:WorkingDirectory, archival_group, canvas_id_prefix, asset_prefix, canvas_index):
+def iter_painted_resources(files:collections.abc.Iterable[WorkingFile], archival_group, canvas_id_prefix, asset_prefix):
     """
         In our initial iiif-builder flow, we will ONLY use `paintedResources` and never send
         the Manifest with an `items` property. This means that IIIF-CS will generate and manage
@@ -111,35 +139,43 @@ def add_painted_resources_from_working_dir(painted_resources, working_dir:Workin
         that we want to re-process (most likely because the file at a particular relative path changed in
         an update to an archival group).
 
-        This recursively walks the folder structure.
+        files are the archival group's files in canvas order (see iter_files); a painted resource
+        is yielded for each image, numbered by a single canvasOrder counter across the whole tree.
+        Raises StorageMapError for a file that isn't in the archival group's storageMap.
         In a later iteration, we can add IIIF Ranges to the Manifest here, to reflect the folder
         structure.
     """
-    logger.info(f"adding painted resources from working dir: {working_dir.local_path}")
-    logger.info(f"{working_dir.local_path} has {len(working_dir.files)} files and {len(working_dir.directories)} directories")
-
-    for f in working_dir.files:
-
-        # You can also obtain the origin by traversing the ArchivalGroup Container hierarchy, following
-        # the path given by f.local_path. This gives you the S3 URI directly (the origin property
-        # of the binary at the end of the path) but is more code otherwise.
-        hash_replace = f.local_path.replace('#', '-_-percent-23-_-')
-        origin = f"{archival_group["origin"]}/{archival_group["storageMap"]["files"][hash_replace]["fullPath"]}"
-        logger.info(f"file {f.local_path} has origin {origin}")
-        logger.info(f"file {f.local_path} has content type {f.content_type}")
-
+    # Per-file detail is only wanted when debugging; checked once here rather than for every file.
+    # The activity summary logged by run_job gives the totals.
+    debug = logger.isEnabledFor(logging.DEBUG)
+    # You can also obtain the origin by traversing the ArchivalGroup Container hierarchy, following
+    # the path given by f.local_path. This gives you the S3 URI directly (the origin property
+    # of the binary at the end of the path) but is more code otherwise.
+    origin_prefix = f"{archival_group["origin"]}/"
+    storage_map_files = archival_group["storageMap"]["files"]
+    space = settings.IIIF_CS_ASSET_SPACE_ID
+    canvas_index = 0
+
+    for f in files:
         # do we want to do this for starters?
         if not f.content_type.startswith("image"):
-            logger.info(f"skipping file {f.local_path} because it is not an image")
+            if debug:
+                logger.debug("skipping file %s because it is not an image", f.local_path)
             continue
 
-        single_path_file_id = hash_replace.replace('/', '_')
+        storage_map_key = f.local_path.replace('#', STORAGE_MAP_HASH_ESCAPE)
+        storage_map_entry = storage_map_files.get(storage_map_key, None)
+        if storage_map_entry is None:
+            raise StorageMapError(f"{storage_map_key} is not in the archival group's storageMap")
+        origin = f"{origin_prefix}{storage_map_entry["fullPath"]}"
         # TODO: this is too dangerous to use as the DLCS ID.
         # Need to make it DLCS-safe in a predictable way.
         # Strip non-ascii chars and append digest?
-        single_path_file_id = single_path_file_id.replace(' ', '_')
-        logger.info(f"file {f.local_path} will use iiif-cs id {single_path_file_id}")
-        painted_resource = {
+        single_path_file_id = storage_map_key.replace('/', '_').replace(' ', '_')
+        if debug:
+            logger.debug("file %s has origin %s, content type %s and iiif-cs id %s",
+                         f.local_path, origin, f.content_type, single_path_file_id)
+        yield {
             "canvasPainting": {
                 # canvasId is optional but gives iiif-b more control. IIIF-CS will mint its own otherwise.
                 "canvasId": f"{canvas_id_prefix}{single_path_file_id}",
@@ -149,21 +185,42 @@ def add_painted_resources_from_working_dir(painted_resources, working_dir:Workin
             "asset": {
                 "id": f"{asset_prefix}{single_path_file_id}", # use the file path as the ID. Use pid to scope to the manifest,
                 "mediaType": f.content_type, #                            because all in same space
-                "space": settings.IIIF_CS_ASSET_SPACE_ID,
+                "space": space,
                 "origin": origin
             }
         }
-        logger.info(f"appending painted resource with canvasId: {painted_resource['canvasPainting']['canvasId']}, asset.id: {painted_resource['asset']['id']}")
-        painted_resources.append(painted_resource)
+        canvas_index += 1
+
+
+def iter_files(working_dir:WorkingDirectory, canvas_order:str=CANVAS_ORDER_FILES_FIRST):
+    """
+    Every file below working_dir, depth first, in canvas_order (any but structmap, which the folder
+    structure doesn't record). Walks the folders without recursion, so there is no limit on their depth.
+    """
+    stack = [iter(get_ordered_children(working_dir, canvas_order))]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+        elif child.type == WorkingDirectory.type:
+            stack.append(iter(get_ordered_children(child, canvas_order)))
+        else:
+            yield child
 
-        canvas_index = canvas_index + 1
 
-    for d in working_dir.directories:
-        logger.info(f"recursing into directory {d.local_path}")
-        if not add_painted_resources_from_working_dir(painted_resources, d, archival_group, canvas_id_prefix, asset_prefix, canvas_index):
-            return False
+def get_ordered_children(working_dir:WorkingDirectory, canvas_order:str) -> list:
+    if canvas_order == CANVAS_ORDER_FILES_FIRST:
+        return working_dir.files + working_dir.directories
+    key = get_natural_sort_key if canvas_order == CANVAS_ORDER_NATURAL else get_path_sort_key
+    return sorted(working_dir.files + working_dir.directories, key=key)
 
-    return True
 
+def get_path_sort_key(item):
+    return item.get_slug()
 
 
+def get_natural_sort_key(item):
+    slug = item.get_slug()
+    # split() puts text at even positions and digits at odd ones, so the parts always compare like with like
+    parts = _digits.split(slug.casefold())
+    return [int(part) if index % 2 else part for index, part in enumerate(parts)], slug
@@ -0,0 +1,128 @@
+import asyncio
+import math
+import time
+from datetime import datetime
+
+from aiohttp import web
+from logzero import logger
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+from app import settings
+from app.db import ArchivalGroupActivity, STATUS_QUEUED, STATUS_RUNNING, STATUS_FAILED
+
+# From tens of milliseconds (a cached lookup) to several minutes (a very large METS or Manifest)
+STAGE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+stage_duration = Histogram("iiif_builder_stage_duration_seconds",
+                           "Time taken by each stage of processing an activity", ["stage"], buckets=STAGE_BUCKETS)
+activity_duration = Histogram("iiif_builder_activity_duration_seconds",
+                              "Time taken to process an activity, end to end", buckets=STAGE_BUCKETS)
+activities = Counter("iiif_builder_activities",
+                     "Activities processed, by the status they finished with (succeeded, skipped, failed, dead)", ["status"])
+backlog = Gauge("iiif_builder_backlog_jobs",
+                "Unfinished jobs in the DB (queued, running, or failed and waiting to be retried)", ["status"])
+pending_work = Gauge("iiif_builder_pending_work",
+                     "Activities submitted to this builder's worker pool that haven't finished")
+stream_lag = Gauge("iiif_builder_stream_lag_seconds",
+                   "Now minus the activity_end_time of the latest activity read from the stream")
+cache_hits = Counter("iiif_builder_cache_hits",
+                     "Lookup cache gets that found a fresh entry, by cache (identity, catalogue)", ["cache"])
+cache_misses = Counter("iiif_builder_cache_misses",
+                       "Lookup cache gets that found no entry, or only a stale one, by cache", ["cache"])
+cache_revalidations = Counter("iiif_builder_cache_revalidations",
+                              "Stale lookup cache entries the upstream service confirmed were still current, by cache", ["cache"])
+partition_queued = Gauge("iiif_builder_partition_queued_jobs",
+                         "Queued jobs in each partition (coordinated mode; exported by the leader)", ["partition"])
+partition_oldest_queued = Gauge("iiif_builder_partition_oldest_queued_seconds",
+                                "How long the oldest queued job in each partition has been waiting (exported by the leader)",
+                                ["partition"])
+cache_entries = Gauge("iiif_builder_cache_entries", "Entries in each in-process lookup cache", ["cache"])
+
+_last_end_time:float | None = None
+stream_lag.set_function(lambda: time.time() - _last_end_time if _last_end_time is not None else math.nan)
+
+
+def record_stream_position(activity_end_time:datetime):
+    """The latest activity_end_time read (or about to be read from) the activity stream"""
+    global _last_end_time
+    _last_end_time = activity_end_time.timestamp()
+
+
+def observe_stage(stage:str, seconds:float):
+    stage_duration.labels(stage).observe(seconds)
+
+
+def observe_activity(status:str, seconds:float):
+    activities.labels(status).inc()
+    activity_duration.observe(seconds)
+
+
+def record_queued_partitions(queued:dict[int, tuple[int, datetime]], now:datetime):
+    """queued is from ArchivalGroupActivity.get_queued_by_partition; partitions with nothing queued are set to 0"""
+    for partition in range(settings.BUILDER_REPLICA_COUNT):
+        count, oldest = queued.get(partition, (0, None))
+        partition_queued.labels(str(partition)).set(count)
+        partition_oldest_queued.labels(str(partition)).set((now - oldest).total_seconds() if oldest is not None else 0)
+
+
+def observe_cache_lookup(cache:str, hit:bool):
+    (cache_hits if hit else cache_misses).labels(cache).inc()
+
+
+def observe_cache_revalidation(cache:str):
+    cache_revalidations.labels(cache).inc()
+
+
+def track_cache_entries(cache:str, count_entries):
+    """count_entries is called for the value each time the metrics are read"""
+    cache_entries.labels(cache).set_function(count_entries)
+
+
+async def handle_metrics(request:web.Request) -> web.Response:
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+class MetricsServer:
+    """
+    Serves GET /metrics in the Prometheus text format on METRICS_PORT, on the same event loop
+    as read_stream, and keeps the backlog gauges up to date (every METRICS_BACKLOG_INTERVAL seconds).
+    """
+    def __init__(self, worker_pool=None):
+        self._runner:web.AppRunner | None = None
+        self._task:asyncio.Task | None = None
+        if worker_pool is not None:
+            pending_work.set_function(worker_pool.pending_count)
+
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, settings.METRICS_HOST, settings.METRICS_PORT).start()
+        self._task = asyncio.create_task(self._update_backlog())
+        logger.info(f"Serving metrics on http://{settings.METRICS_HOST}:{settings.METRICS_PORT}/metrics")
+
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+    async def _update_backlog(self):
+        while True:
+            try:
+                counts = await ArchivalGroupActivity.count_backlog()
+                for status in (STATUS_QUEUED, STATUS_RUNNING, STATUS_FAILED):
+                    backlog.labels(status).set(counts.get(status, 0))
+            except Exception as e:
+                logger.warning(f"Unable to count the job backlog: {repr(e)}")
+            await asyncio.sleep(settings.METRICS_BACKLOG_INTERVAL)
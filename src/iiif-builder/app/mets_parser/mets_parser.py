@@ -1,8 +1,10 @@
 from datetime import datetime, timezone
+from io import BytesIO
 
 import lxml.etree as etree
+from app.mets_parser.mets_records import AdmRecord, AdmRecordMap, DivRecord, FileRecord, get_sha256_digest
 from app.mets_parser.mets_wrapper import MetsWrapper
-from app.mets_parser.util import get_parent, get_slug
+from app.mets_parser.util import find_value, get_parent, get_slug
 from app.mets_parser.working_filesystem import WorkingDirectory, WorkingFile
 from app.mets_parser.vocab import *
 
@@ -19,7 +21,32 @@ def get_mets_wrapper_from_string(xml_string)->MetsWrapper:
     return mets_wrapper
 
 
-def build_mets_wrapper(root)->MetsWrapper:
+def get_mets_wrapper_from_bytes(xml_bytes:bytes)->MetsWrapper:
+    root = etree.fromstring(xml_bytes)
+    mets_wrapper = build_mets_wrapper(root)
+    return mets_wrapper
+
+
+def get_mets_wrapper_streaming(file_path_or_object)->MetsWrapper:
+    """
+    Builds the same MetsWrapper as get_mets_wrapper_from_file_like_object, in a single iterparse
+    pass that never holds the whole document. Use for large METS files.
+    """
+    mets_wrapper = new_mets_wrapper()
+    physical_struct_map = read_records_streaming(mets_wrapper, file_path_or_object)
+    populate_physical_structure(mets_wrapper, physical_struct_map)
+    return mets_wrapper
+
+
+def get_mets_wrapper_from_string_streaming(xml_string)->MetsWrapper:
+    return get_mets_wrapper_streaming(BytesIO(bytes(xml_string, encoding='utf-8')))
+
+
+def get_mets_wrapper_streaming_from_bytes(xml_bytes:bytes)->MetsWrapper:
+    return get_mets_wrapper_streaming(BytesIO(xml_bytes))
+
+
+def new_mets_wrapper()->MetsWrapper:
     physical_structure = WorkingDirectory()
     physical_structure.local_path = ""
     physical_structure.name = "__ROOT"
@@ -27,6 +54,14 @@ def build_mets_wrapper(root)->MetsWrapper:
 
     mets_wrapper = MetsWrapper()
     mets_wrapper.physical_structure = physical_structure
+    return mets_wrapper
+
+
+def build_mets_wrapper(root)->MetsWrapper:
+    mets_wrapper = new_mets_wrapper()
+    # Only the records an ADMID refers to are built, when populate_physical_structure asks for them
+    mets_wrapper.amd_map = AdmRecordMap()
+    mets_wrapper.tech_map = AdmRecordMap()
     for amd_sec in root.findall(f".//{{{mets}}}amdSec[@ID]"):
         # print("mapping amd_sec with ID " + amd_sec.get("ID"))
         mets_wrapper.amd_map[amd_sec.get("ID")] = amd_sec
@@ -34,7 +69,7 @@ def build_mets_wrapper(root)->MetsWrapper:
     file_sec = root.find(f".//{{{mets}}}fileSec")
     for f in file_sec.findall(f".//{{{mets}}}file[@ID]"):
         # print("mapping file with ID " + f.get("ID"))
-        mets_wrapper.file_map[f.get("ID")] = f
+        mets_wrapper.file_map[f.get("ID")] = FileRecord.from_element(f)
 
     for tech_md in root.findall(f".//{{{mets}}}techMD[@ID]"):
         # print("mapping tech_md with ID " + tech_md.get("ID"))
@@ -73,6 +108,126 @@ def populate_from_mets(mets_wrapper:MetsWrapper, root):
     if physical_struct_map is None:
         raise Exception("METS file must have a physical structMap")
 
+    populate_physical_structure(mets_wrapper, DivRecord.from_element(physical_struct_map))
+
+
+def read_records_streaming(mets_wrapper:MetsWrapper, file_path_or_object)->DivRecord:
+    """
+    Single pass over the METS with iterparse, filling the wrapper's record maps, name and agent
+    and returning the physical structMap as DivRecords. Elements are cleared as soon as the
+    values needed from them have been taken, so memory use depends on the number of files,
+    not the size of the document.
+    """
+    amd_sec_tag = f"{{{mets}}}amdSec"
+    tech_md_tag = f"{{{mets}}}techMD"
+    file_sec_tag = f"{{{mets}}}fileSec"
+    file_tag = f"{{{mets}}}file"
+    struct_map_tag = f"{{{mets}}}structMap"
+    div_tag = f"{{{mets}}}div"
+    fptr_tag = f"{{{mets}}}fptr"
+    agent_tag = f"{{{mets}}}agent"
+    fixity_tag = f"{{{premis}}}fixity"
+    original_name_tag = f"{{{premis}}}originalName"
+    size_tag = f"{{{premis}}}size"
+    mods_title_tag = f"{{{mods}}}title"
+    mods_name_tag = f"{{{mods}}}name"
+    # These need their descendants when they end, so nothing inside them is cleared early
+    held_tags = {file_tag, agent_tag, fixity_tag}
+
+    # open amdSecs and techMDs: [record, have original name, have fixity, have size]
+    adm_collectors = []
+    file_sec_count = 0
+    mods_title = mods_name = None
+    have_mods_title = have_mods_name = have_agent = False
+    physical_struct_map = None
+    have_typed_physical = False
+    div_stack:list[DivRecord] = []
+    holding = 0
+
+    for event, el in etree.iterparse(file_path_or_object, events=("start", "end")):
+        tag = el.tag
+        if event == "start":
+            if tag in held_tags:
+                holding += 1
+            if tag == amd_sec_tag or tag == tech_md_tag:
+                record = None
+                id_ = el.get("ID", None)
+                if id_ is not None:
+                    record = AdmRecord()
+                    if tag == amd_sec_tag:
+                        mets_wrapper.amd_map[id_] = record
+                    else:
+                        mets_wrapper.tech_map[id_] = record
+                adm_collectors.append([record, False, False, False])
+            elif tag == file_sec_tag:
+                file_sec_count += 1
+            elif tag == struct_map_tag:
+                type_attr = (el.get("TYPE", None) or "").lower()
+                if not have_typed_physical and type_attr != "logical" and (type_attr == "physical" or physical_struct_map is None):
+                    # Same choice as populate_from_mets: the first PHYSICAL structMap,
+                    # otherwise the first one that isn't LOGICAL
+                    physical_struct_map = DivRecord.from_attributes(el)
+                    have_typed_physical = type_attr == "physical"
+                    div_stack = [physical_struct_map]
+            elif tag == div_tag and len(div_stack) > 0:
+                div = DivRecord.from_attributes(el)
+                div_stack[-1].divs.append(div)
+                div_stack.append(div)
+            elif tag == fptr_tag and len(div_stack) > 0:
+                div_stack[-1].file_ids.append(el.get("FILEID", None))
+            continue
+
+        if tag == original_name_tag or tag == size_tag:
+            index = 1 if tag == original_name_tag else 3
+            for collector in adm_collectors:
+                if collector[0] is not None and not collector[index]:
+                    collector[index] = True
+                    if tag == original_name_tag:
+                        collector[0].original_name = el.text
+                    else:
+                        collector[0].size = el.text
+        elif tag == fixity_tag:
+            digest = get_sha256_digest(el)
+            for collector in adm_collectors:
+                if collector[0] is not None and not collector[2]:
+                    collector[2] = True
+                    collector[0].digest = digest
+        elif tag == amd_sec_tag or tag == tech_md_tag:
+            adm_collectors.pop()
+        elif tag == file_tag:
+            id_ = el.get("ID", None)
+            if id_ is not None and file_sec_count == 1:
+                mets_wrapper.file_map[id_] = FileRecord.from_element(el)
+        elif tag == mods_title_tag and not have_mods_title:
+            have_mods_title = True
+            mods_title = el.text
+        elif tag == mods_name_tag and not have_mods_name:
+            have_mods_name = True
+            mods_name = el.text
+        elif tag == agent_tag and not have_agent:
+            have_agent = True
+            mets_wrapper.agent = find_value(el, f".//{{{mets}}}name")
+        elif tag == div_tag and len(div_stack) > 0:
+            div_stack.pop()
+        elif tag == struct_map_tag:
+            div_stack = []
+
+        if tag in held_tags:
+            holding -= 1
+        if holding == 0:
+            el.clear(keep_tail=True)
+            parent = el.getparent()
+            if parent is not None:
+                while el.getprevious() is not None:
+                    del parent[0]
+
+    mets_wrapper.name = mods_title or mods_name
+    if physical_struct_map is None:
+        raise Exception("METS file must have a physical structMap")
+    return physical_struct_map
+
+
+def populate_physical_structure(mets_wrapper:MetsWrapper, physical_struct_map:DivRecord):
     """
     // Now walk down the structMap
     // Each div either contains 1 (or sometimes more) mets:fptr, or it contains child DIVs.
@@ -86,20 +241,20 @@ def populate_from_mets(mets_wrapper:MetsWrapper, root):
     // Not sure how to be formal about that.
     """
 
-    parent = sm
-
     # This relies on all directories having labels not just some
     directory_labels = []
-    process_child_struct_divs(mets_wrapper, root, parent, directory_labels)
+    process_child_struct_divs(mets_wrapper, physical_struct_map, directory_labels)
 
     for file in mets_wrapper.files:
         folder = mets_wrapper.physical_structure.find_directory(get_parent(file.local_path), False)
         if folder is None:
             raise Exception("Our folder logic is wrong")
-        folder.files.append(file)
+        folder.add_file(file)
+
+    mets_wrapper.release_records()
 
 
-def process_child_struct_divs(mets_wrapper:MetsWrapper, root, parent, directory_labels):
+def process_child_struct_divs(mets_wrapper:MetsWrapper, parent:DivRecord, directory_labels):
     """
     // We want to create MetsFileWrapper::PhysicalStructure (WorkingDirectories and WorkingFiles).
     // We can traverse the physical structmap, finding div type=Directory and div type=File
@@ -107,47 +262,39 @@ def process_child_struct_divs(mets_wrapper:MetsWrapper, root, parent, directory_
     // directory. If it has grandchildren we can eventually populate it. But if not we will have
     // to rely on the AMD premis:originalName as the local path.
     """
-    # print("entering process_child_struct_divs with parent " + str(parent.tag))
-    # print(parent.attrib.keys)
-    # print("loop through child divs of " + str(parent.tag))
-    child_divs = (el for el in parent if el.tag == f"{{{mets}}}div")
-    for div in child_divs:
-        type_ = div.get("TYPE", "").lower()
-        label = div.get("LABEL", "").lower()
+    for div in parent.divs:
+        type_ = div.type_
+        label = div.label
         if type_ == "directory":
             if not label:
                 raise Exception("If a mets:div has type Directory, it must have a label")
             directory_labels.append(label)
-            adm_id = div.get("ADMID", None)
+            adm_id = div.adm_id
             if adm_id:
                 amd = mets_wrapper.amd_map.get(adm_id, None)
                 if amd is not None:
-                    original_name = amd.find(f".//{{{premis}}}originalName")
+                    original_name = amd.original_name
                     if original_name is not None:
                         # Only in this scenario can we create a directory
-                        working_directory = mets_wrapper.physical_structure.find_directory(original_name.text, True)
+                        working_directory = mets_wrapper.physical_structure.find_directory(original_name, True)
                         if not working_directory.name:
-                            name_from_path = get_slug(original_name.text)
+                            name_from_path = get_slug(original_name)
                             name_from_label = None
                             if len(directory_labels) > 0:
                                 name_from_label = directory_labels.pop()
                             working_directory.name = name_from_label or name_from_path
-                            working_directory.local_path = original_name.text
+                            working_directory.local_path = original_name
 
         have_used_adm_id_already = False
-        # print("loop through child fptr of " + str(div.tag))
-        child_fptrs = (el for el in div if el.tag == f"{{{mets}}}fptr")
-        for fptr in child_fptrs:
-            # print("starting fptr " + str(fptr.tag))
-            adm_id = div.get("ADMID", None)
+        for file_id in div.file_ids:
+            adm_id = div.adm_id
             # Goobi METS has the ADMID on the mets:div. But that means we can use it only once!
             # Going to make an assumption for now that the first encountered mets:fptr is the one that gets the ADMID
-            file_id = fptr.get("FILEID", None)
-            file_el = mets_wrapper.file_map.get(file_id)
-            mime_type = file_el.get("MIMETYPE", None)
-            flocat = file_el.find(f".//{{{mets}}}FLocat").get(f"{{{xlink}}}href")
+            file_record = mets_wrapper.file_map.get(file_id)
+            mime_type = file_record.mime_type
+            flocat = file_record.flocat
             if adm_id is None:
-                adm_id = file_el.get("ADMID", None)
+                adm_id = file_record.adm_id
                 have_used_adm_id_already = False
             digest = None
             size = 0
@@ -155,16 +302,9 @@ def process_child_struct_divs(mets_wrapper:MetsWrapper, root, parent, directory_
                 tech_md = mets_wrapper.tech_map.get(adm_id, None)
                 if tech_md is None:
                     tech_md = mets_wrapper.amd_map[adm_id]
-                fixity = tech_md.find(f".//{{{premis}}}fixity")
-                if fixity is not None:
-                    algorithm_el = fixity.find(f".//{{{premis}}}messageDigestAlgorithm")
-                    if algorithm_el is not None:
-                        algorithm = algorithm_el.text.lower().replace("-", "")
-                        if algorithm == "sha256":
-                            digest = fixity.find(f".//{{{premis}}}messageDigest").text
-                size_el = tech_md.find(f".//{{{premis}}}size")
-                if size_el is not None:
-                    size = int(size_el.text)
+                digest = tech_md.digest
+                if tech_md.size is not None:
+                    size = int(tech_md.size)
                 have_used_adm_id_already = True
 
             parts = flocat.split('/')
@@ -191,17 +331,5 @@ def process_child_struct_divs(mets_wrapper:MetsWrapper, root, parent, directory_
                         working_directory.name = name_from_label or name_from_path
                         working_directory.local_path = parent_directory
                     walk_back = walk_back - 1
-            # print("finished fptr " + str(div.tag))
-
-        process_child_struct_divs(mets_wrapper, root, div, directory_labels)
-
-
-
-def find_value(element, expr):
-    found = element.find(expr)
-    if found is None:
-        return None
-    return found.text
-
-
 
+        process_child_struct_divs(mets_wrapper, div, directory_labels)
@@ -0,0 +1,104 @@
+from app.mets_parser.util import find_value
+from app.mets_parser.vocab import *
+
+
+class AdmRecord:
+    """
+    The values the parser needs from a mets:amdSec or mets:techMD, without the element itself.
+    Each value comes from the first matching descendant, as element.find(".//...") would give.
+    """
+    __slots__ = ("original_name", "digest", "size")
+
+    def __init__(self, original_name:str=None, digest:str=None, size:str=None):
+        self.original_name = original_name
+        self.digest = digest    # only set if the first premis:fixity is sha256
+        self.size = size        # as text, converted when used
+
+    @staticmethod
+    def from_element(element) -> 'AdmRecord':
+        return AdmRecord(
+            original_name=find_value(element, f".//{{{premis}}}originalName"),
+            digest=get_sha256_digest(element.find(f".//{{{premis}}}fixity")),
+            size=find_value(element, f".//{{{premis}}}size")
+        )
+
+
+class AdmRecordMap(dict):
+    """
+    amdSec or techMD ID -> AdmRecord, for a parsed tree. Holds the elements, and builds the AdmRecord
+    for one the first time it is asked for. A techMD is mapped both as itself and through the amdSec
+    that contains it, but an ADMID only ever resolves to one of them, so most are never asked for.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, id_:str) -> AdmRecord:
+        value = dict.__getitem__(self, id_)
+        if type(value) is not AdmRecord:
+            value = AdmRecord.from_element(value)
+            dict.__setitem__(self, id_, value)
+        return value
+
+    def get(self, id_:str, default=None) -> AdmRecord | None:
+        if id_ not in self:
+            return default
+        return self[id_]
+
+
+class FileRecord:
+    """The values the parser needs from a mets:file in the fileSec"""
+    __slots__ = ("mime_type", "flocat", "adm_id")
+
+    def __init__(self, mime_type:str=None, flocat:str=None, adm_id:str=None):
+        self.mime_type = mime_type
+        self.flocat = flocat
+        self.adm_id = adm_id
+
+    @staticmethod
+    def from_element(element) -> 'FileRecord':
+        return FileRecord(
+            mime_type=element.get("MIMETYPE", None),
+            flocat=element.find(f".//{{{mets}}}FLocat").get(f"{{{xlink}}}href"),
+            adm_id=element.get("ADMID", None)
+        )
+
+
+class DivRecord:
+    """A mets:div in the physical structMap (or the structMap itself), with its fptr FILEIDs and child divs"""
+    __slots__ = ("type_", "label", "adm_id", "file_ids", "divs")
+
+    def __init__(self, type_:str="", label:str="", adm_id:str=None):
+        self.type_ = type_
+        self.label = label
+        self.adm_id = adm_id
+        self.file_ids:list[str] = []
+        self.divs:list[DivRecord] = []
+
+    @staticmethod
+    def from_attributes(element) -> 'DivRecord':
+        return DivRecord(
+            type_=element.get("TYPE", "").lower(),
+            label=element.get("LABEL", "").lower(),
+            adm_id=element.get("ADMID", None)
+        )
+
+    @staticmethod
+    def from_element(element) -> 'DivRecord':
+        record = DivRecord.from_attributes(element)
+        for child in element:
+            if child.tag == f"{{{mets}}}fptr":
+                record.file_ids.append(child.get("FILEID", None))
+            elif child.tag == f"{{{mets}}}div":
+                record.divs.append(DivRecord.from_element(child))
+        return record
+
+
+def get_sha256_digest(fixity) -> str | None:
+    if fixity is None:
+        return None
+    algorithm_el = fixity.find(f".//{{{premis}}}messageDigestAlgorithm")
+    if algorithm_el is None or algorithm_el.text is None:
+        return None
+    if algorithm_el.text.lower().replace("-", "") != "sha256":
+        return None
+    return find_value(fixity, f".//{{{premis}}}messageDigest")
+
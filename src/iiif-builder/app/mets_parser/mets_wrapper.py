@@ -1,13 +1,24 @@
+from app.mets_parser.mets_records import AdmRecord, FileRecord
 from app.mets_parser.working_filesystem import WorkingDirectory, WorkingFile
 
 class MetsWrapper:
+    __slots__ = ("name", "agent", "physical_structure", "files", "amd_map", "file_map", "tech_map")
+
     def __init__(self):
-        self.name:str
-        self.agent:str
+        self.name:str=None
+        self.agent:str=None
         self.physical_structure:WorkingDirectory
         self.files:list[WorkingFile]=[]
-        self.amd_map:dict={}
-        self.file_map:dict={}
-        self.tech_map:dict={}
+        self.amd_map:dict[str, AdmRecord]={}
+        self.file_map:dict[str, FileRecord]={}
+        self.tech_map:dict[str, AdmRecord]={}
 
+    def release_records(self):
+        """
+        The record maps are only needed while the physical structure is being built;
+        drop them once it has been, so a parsed wrapper holds just the working filesystem.
+        """
+        self.amd_map = {}
+        self.file_map = {}
+        self.tech_map = {}
 
@@ -0,0 +1,107 @@
+import hashlib
+from io import BytesIO
+from xml.sax.saxutils import quoteattr, escape
+
+from app.mets_parser.vocab import *
+
+
+def get_synthetic_file_paths(file_count:int, depth:int=0, branching:int=10, files_per_directory:int=None) -> list[str]:
+    """
+    Paths for file_count images under objects/. With depth 0 every file is in the one folder;
+    otherwise files are spread files_per_directory at a time over folders nested depth deep,
+    branching folders per level.
+    """
+    if depth == 0:
+        return [f"objects/image_{i:06d}.jpg" for i in range(file_count)]
+    if files_per_directory is None:
+        files_per_directory = max(1, file_count // (branching ** depth))
+    paths = []
+    for i in range(file_count):
+        leaf = i // files_per_directory
+        folders = []
+        for _ in range(depth):
+            folders.append(f"folder_{leaf % branching:03d}")
+            leaf = leaf // branching
+        paths.append(f"objects/{'/'.join(reversed(folders))}/image_{i:06d}.jpg")
+    return paths
+
+
+class _ChunkWriter:
+    """Collects strings and writes them to a binary file in chunks, so the document is never held whole"""
+    def __init__(self, f, chunk_size:int=4096):
+        self.f = f
+        self.chunk_size = chunk_size
+        self._parts = []
+
+    def append(self, part:str):
+        self._parts.append(part)
+        if len(self._parts) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        self.f.write(''.join(self._parts).encode("utf-8"))
+        self._parts = []
+
+
+def generate_synthetic_mets(file_count:int, depth:int=0, branching:int=10, files_per_directory:int=None) -> bytes:
+    """
+    An Archivematica-shaped METS document (amdSec/techMD with PREMIS fixity, size and originalName
+    per file, a fileSec, and a physical structMap of Directory divs) for benchmarking.
+    """
+    f = BytesIO()
+    write_synthetic_mets(f, file_count, depth, branching, files_per_directory)
+    return f.getvalue()
+
+
+def write_synthetic_mets(f, file_count:int, depth:int=0, branching:int=10, files_per_directory:int=None):
+    """
+    Write the document generate_synthetic_mets returns to the binary file f as it is generated;
+    use for METS of 100k files and more.
+    """
+    paths = get_synthetic_file_paths(file_count, depth, branching, files_per_directory)
+    out = _ChunkWriter(f)
+    out.append('<?xml version="1.0" encoding="UTF-8"?>\n')
+    out.append(f'<mets:mets xmlns:mets="{mets}" xmlns:mods="{mods}" xmlns:premis="{premis}" xmlns:xlink="{xlink}">')
+    out.append('<mets:metsHdr><mets:agent ROLE="CREATOR" TYPE="OTHER"><mets:name>synthetic_mets</mets:name></mets:agent></mets:metsHdr>')
+    out.append('<mets:dmdSec ID="dmdSec_1"><mets:mdWrap MDTYPE="MODS"><mets:xmlData><mods:mods>')
+    out.append(f'<mods:titleInfo><mods:title>Synthetic METS with {file_count} files</mods:title></mods:titleInfo>')
+    out.append('</mods:mods></mets:xmlData></mets:mdWrap></mets:dmdSec>')
+    for i, path in enumerate(paths):
+        digest = hashlib.sha256(path.encode("utf-8")).hexdigest()
+        out.append(
+            f'<mets:amdSec ID="amdSec_{i}"><mets:techMD ID="techMD_{i}"><mets:mdWrap MDTYPE="PREMIS:OBJECT"><mets:xmlData>'
+            '<premis:object><premis:objectCharacteristics><premis:compositionLevel>0</premis:compositionLevel>'
+            '<premis:fixity><premis:messageDigestAlgorithm>sha256</premis:messageDigestAlgorithm>'
+            f'<premis:messageDigest>{digest}</premis:messageDigest></premis:fixity>'
+            f'<premis:size>{100000 + i}</premis:size>'
+            '<premis:format><premis:formatDesignation><premis:formatName>JPEG</premis:formatName></premis:formatDesignation></premis:format>'
+            f'</premis:objectCharacteristics><premis:originalName>{escape(path)}</premis:originalName></premis:object>'
+            '</mets:xmlData></mets:mdWrap></mets:techMD></mets:amdSec>')
+    out.append('<mets:fileSec><mets:fileGrp USE="original">')
+    for i, path in enumerate(paths):
+        out.append(f'<mets:file ID="file_{i}" MIMETYPE="image/jpeg" ADMID="amdSec_{i}">'
+                   f'<mets:FLocat LOCTYPE="URL" xlink:href={quoteattr(path)}/></mets:file>')
+    out.append('</mets:fileGrp></mets:fileSec>')
+
+    # nested dict of folder name -> (sub folders, [file indexes])
+    tree = ({}, [])
+    for i, path in enumerate(paths):
+        node = tree
+        for folder in path.split('/')[:-1]:
+            node = node[0].setdefault(folder, ({}, []))
+        node[1].append(i)
+
+    out.append('<mets:structMap TYPE="physical" ID="structMap_1">')
+    stack = [(name, node, False) for name, node in reversed(tree[0].items())]
+    while stack:
+        name, node, closing = stack.pop()
+        if closing:
+            out.append('</mets:div>')
+            continue
+        out.append(f'<mets:div TYPE="Directory" LABEL={quoteattr(name)}>')
+        for i in node[1]:
+            out.append(f'<mets:div TYPE="Item" LABEL="image_{i:06d}.jpg"><mets:fptr FILEID="file_{i}"/></mets:div>')
+        stack.append((name, node, True))
+        stack.extend((child_name, child, False) for child_name, child in reversed(node[0].items()))
+    out.append('</mets:structMap></mets:mets>')
+    out.flush()
@@ -1,11 +1,48 @@
-from app.mets_parser.mets_parser import get_mets_wrapper_from_file_like_object
+from pathlib import Path
+
+import pytest
+
+from app.mets_parser.mets_parser import (get_mets_wrapper_from_bytes, get_mets_wrapper_from_file_like_object,
+                                         get_mets_wrapper_from_string, get_mets_wrapper_streaming,
+                                         get_mets_wrapper_streaming_from_bytes)
+from app.mets_parser.working_filesystem import WorkingDirectory
+
+FIXTURES = Path(__file__).parent / "test_fixtures"
+FIXTURE_PATHS = sorted(FIXTURES.rglob("*.xml"))
+
+
+def describe(directory:WorkingDirectory) -> list:
+    """Everything the Manifest is built from, for directory and everything below it, in order"""
+    description = [("dir", directory.local_path, directory.name, directory.access_condition, directory.rights)]
+    for file in directory.files:
+        description.append(("file", file.local_path, file.name, file.content_type, file.digest, file.size,
+                            file.modified, file.access_condition, file.rights))
+    for child in directory.directories:
+        description.extend(describe(child))
+    return description
+
+
+def describe_wrapper(wrapper) -> tuple:
+    # wrapper.files is in structMap order, which the structmap canvas order relies on
+    return wrapper.name, wrapper.agent, describe(wrapper.physical_structure), [file.local_path for file in wrapper.files]
+
+
+@pytest.mark.parametrize("path", FIXTURE_PATHS, ids=lambda path: str(path.relative_to(FIXTURES)))
+def test_streaming_parser_matches_tree_parser(path):
+    expected = describe_wrapper(get_mets_wrapper_from_file_like_object(str(path)))
+    assert len(expected[2]) > 1
+    assert describe_wrapper(get_mets_wrapper_streaming(str(path))) == expected
+    assert describe_wrapper(get_mets_wrapper_streaming_from_bytes(path.read_bytes())) == expected
+
+
+@pytest.mark.parametrize("path", FIXTURE_PATHS, ids=lambda path: str(path.relative_to(FIXTURES)))
+def test_parsing_from_bytes_or_string_matches_parsing_from_file(path):
+    expected = describe_wrapper(get_mets_wrapper_from_file_like_object(str(path)))
+    assert describe_wrapper(get_mets_wrapper_from_bytes(path.read_bytes())) == expected
+    assert describe_wrapper(get_mets_wrapper_from_string(path.read_text(encoding="utf-8"))) == expected
+
 
 if __name__ == '__main__':
-    wrapper_1 = get_mets_wrapper_from_file_like_object("test_fixtures/eprints/10315.METS.xml")
-    print(wrapper_1.physical_structure)
-    wrapper_2 = get_mets_wrapper_from_file_like_object("test_fixtures/dlip/mets.xml")
-    print(wrapper_2.physical_structure)
-    wrapper_3 = get_mets_wrapper_from_file_like_object("test_fixtures/wc-goobi/b29356350.xml")
-    print(wrapper_3.physical_structure)
-    wrapper_4 = get_mets_wrapper_from_file_like_object("test_fixtures/wc-archivematica/METS.299eb16f-1e62-4bf6-b259-c82146153711.xml")
-    print(wrapper_4.physical_structure)
+    for fixture_path in FIXTURE_PATHS:
+        print(fixture_path.relative_to(FIXTURES))
+        print(get_mets_wrapper_from_file_like_object(str(fixture_path)).physical_structure)
@@ -16,3 +16,9 @@ def get_slug(path:str)->str:
         path = path.rstrip('/')
     return path.split('/')[-1];
 
+
+def find_value(element, expr):
+    found = element.find(expr)
+    if found is None:
+        return None
+    return found.text
@@ -5,8 +5,14 @@ from app.mets_parser.util import get_parent, get_slug
 
 
 class WorkingBase:
+    """
+    Archival groups can hold tens of thousands of files, so the working filesystem
+    classes use __slots__ rather than a __dict__ per instance.
+    """
+    __slots__ = ("local_path", "name", "modified", "access_condition", "rights")
+    type:str = None
+
     def __init__(self):
-        self.type:str=None
         self.local_path:str=None
         self.name:str=None
         self.modified:datetime=None
@@ -18,10 +24,11 @@ class WorkingBase:
 
 
 class WorkingFile(WorkingBase):
+    __slots__ = ("content_type", "digest", "size")
+    type = "WorkingFile"
 
     def __init__(self):
         super().__init__()
-        self.type = "WorkingFile"
         self.content_type:str=None
         self.digest:str=None
         self.size:int=None
@@ -29,46 +36,88 @@ class WorkingFile(WorkingBase):
 
 
 class WorkingDirectory(WorkingBase):
+    """
+    Children are kept in order in `files` and `directories`, and indexed by slug so that
+    finding a child costs the same however many siblings it has. Add children with
+    add_file and add_directory; anything appended to the lists directly is picked up
+    (by re-indexing) on the next lookup.
+    """
+    __slots__ = ("files", "directories", "_files_by_slug", "_directories_by_slug",
+                 "_indexed_file_count", "_indexed_directory_count", "_path_index")
+    type = "WorkingDirectory"
 
     def __init__(self):
         super().__init__()
-        self.type = "WorkingDirectory"
         self.files:list[WorkingFile] = []
         self.directories:list[WorkingDirectory] = []
+        self._files_by_slug:dict[str, WorkingFile] = {}
+        self._directories_by_slug:dict[str, WorkingDirectory] = {}
+        self._indexed_file_count = 0
+        self._indexed_directory_count = 0
+        # Every directory found or created below this one, keyed by normalised relative path.
+        # Only really used on the root, which all lookups during METS parsing start from.
+        self._path_index:dict[str, WorkingDirectory] = {}
+
+
+    def add_file(self, file:WorkingFile):
+        self._get_files_by_slug().setdefault(file.get_slug(), file)
+        self.files.append(file)
+        self._indexed_file_count += 1
+
+
+    def add_directory(self, directory:'WorkingDirectory'):
+        self._get_directories_by_slug().setdefault(directory.get_slug(), directory)
+        self.directories.append(directory)
+        self._indexed_directory_count += 1
 
 
     def find_file(self, path:str):
         parent = self.find_directory(get_parent(path))
         if parent is None:
             return None
-        slug = get_slug(path)
-        matches = list(filter(lambda f: f.get_slug() == slug, self.files))
-        if len(matches) > 0:
-            return matches[0]
-        return None
-
+        return parent._get_files_by_slug().get(get_slug(path), None)
 
 
     def find_directory(self, path:str, create:bool=False)-> 'WorkingDirectory':
         if path is None or path == '' or path.strip() == '' or path == "/":
             return self
         parts = list(filter(None, path.split('/')))
+        key = '/'.join(parts)
+        directory = self._path_index.get(key, None)
+        if directory is not None:
+            return directory
+
         directory = self
         for index, part in enumerate(parts):
-            matches = list(filter(lambda d: d.get_slug() == part, directory.directories))
-            potential_directory = None
-            if len(matches) > 0:
-                potential_directory = matches[0]
+            potential_directory = directory._get_directories_by_slug().get(part, None)
             if create:
                 if potential_directory is None:
                     potential_directory = WorkingDirectory()
                     potential_directory.local_path = '/'.join(list(islice(parts, index + 1)))
-                    directory.directories.append(potential_directory)
+                    directory.add_directory(potential_directory)
             else:
                 if potential_directory is None:
                     return None
 
             directory = potential_directory
 
+        self._path_index[key] = directory
         return directory
 
+
+    def _get_files_by_slug(self) -> dict[str, WorkingFile]:
+        if self._indexed_file_count != len(self.files):
+            self._files_by_slug = {}
+            for f in self.files:
+                self._files_by_slug.setdefault(f.get_slug(), f)
+            self._indexed_file_count = len(self.files)
+        return self._files_by_slug
+
+
+    def _get_directories_by_slug(self) -> dict[str, 'WorkingDirectory']:
+        if self._indexed_directory_count != len(self.directories):
+            self._directories_by_slug = {}
+            for d in self.directories:
+                self._directories_by_slug.setdefault(d.get_slug(), d)
+            self._indexed_directory_count = len(self.directories)
+        return self._directories_by_slug
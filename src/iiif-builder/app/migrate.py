@@ -0,0 +1,53 @@
+import asyncio
+from pathlib import Path
+
+from logzero import logger
+
+from app.db import get_pool, open_pool, close_pool, MIGRATION_LOCK_KEY
+
+MIGRATIONS_DIR = Path(__file__).parent / "migrations"
+
+
+def get_migrations() -> list[Path]:
+    """The migration files, in the order they are applied (by their numeric prefix)"""
+    return sorted(MIGRATIONS_DIR.glob("[0-9][0-9][0-9][0-9]_*.sql"))
+
+
+async def apply_migrations():
+    """
+    Apply any migrations in app/migrations that haven't been applied to the iiif-builder DB yet.
+    Each one is applied in its own transaction, together with its schema_migrations row.
+    Builders starting at the same time take it in turns, so each migration is only applied once.
+    """
+    async with get_pool().connection() as conn:
+        await conn.set_autocommit(True)
+        await conn.execute("SELECT pg_advisory_lock(%s)", [MIGRATION_LOCK_KEY])
+        try:
+            await conn.execute("CREATE TABLE IF NOT EXISTS schema_migrations "
+                               "(name text not null primary key, applied timestamp with time zone not null default now())")
+            cur = await conn.execute("SELECT name FROM schema_migrations")
+            applied = {row[0] for row in await cur.fetchall()}
+            for migration in get_migrations():
+                if migration.name in applied:
+                    continue
+                logger.info(f"Applying migration {migration.name}")
+                async with conn.transaction():
+                    await conn.execute(migration.read_text(encoding="utf-8"))
+                    await conn.execute("INSERT INTO schema_migrations (name) VALUES (%s)", [migration.name])
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock(%s)", [MIGRATION_LOCK_KEY])
+            await conn.set_autocommit(False)
+
+
+async def migrate():
+    await open_pool()
+    try:
+        await apply_migrations()
+    finally:
+        await close_pool()
+
+
+if __name__ == "__main__":
+    # From the iiif-builder directory:
+    # python -m app.migrate
+    asyncio.run(migrate())
@@ -0,0 +1,17 @@
+-- The original table, as created by hand before migrations were introduced
+create table if not exists archival_group_activity
+(
+    id                           serial
+        primary key,
+    activity_end_time            timestamp with time zone not null,
+    archival_group_uri           text                     not null,
+    activity_type                text                     not null,
+    id_service_pid               text,
+    catalogue_api_uri            text,
+    public_manifest_uri          text,
+    internal_public_manifest_uri text,
+    internal_api_manifest_uri    text,
+    started                      timestamp with time zone not null,
+    finished                     timestamp with time zone,
+    error_message                text
+);
@@ -0,0 +1,13 @@
+-- Job status, attempts and next attempt (retry time or lease end) for the retry queue
+alter table archival_group_activity
+    add column if not exists status text not null default 'running',
+    add column if not exists attempts integer not null default 1,
+    add column if not exists next_attempt timestamp with time zone;
+
+-- Rows from before the queue existed have the column defaults and no lease
+update archival_group_activity set status = 'succeeded'
+    where status = 'running' and next_attempt is null and finished is not null and error_message is null;
+update archival_group_activity set status = 'skipped'
+    where status = 'running' and next_attempt is null and finished is not null and error_message is not null;
+update archival_group_activity set status = 'dead'
+    where status = 'running' and next_attempt is null and finished is null;
@@ -0,0 +1,18 @@
+create table if not exists manifest_fingerprint
+(
+    id_service_pid               text                     not null
+        primary key,
+    fingerprint                  text                     not null,
+    updated                      timestamp with time zone not null
+);
+
+create table if not exists lookup_cache
+(
+    cache_name                   text                     not null,
+    cache_key                    text                     not null,
+    value                        jsonb                    not null,
+    etag                         text,
+    last_modified                text,
+    stored                       timestamp with time zone not null,
+    primary key (cache_name, cache_key)
+);
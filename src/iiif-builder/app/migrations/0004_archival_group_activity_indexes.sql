@@ -0,0 +1,15 @@
+-- The high-water mark, and retention by age
+create index if not exists archival_group_activity_end_time_idx
+    on archival_group_activity (activity_end_time);
+
+-- Jobs for an archival group, in order (superseded retries, requeue by prefix)
+create index if not exists archival_group_activity_ag_uri_idx
+    on archival_group_activity (archival_group_uri, id);
+
+create index if not exists archival_group_activity_pid_idx
+    on archival_group_activity (id_service_pid);
+
+-- Only the unfinished jobs, which is all the claim queries look at
+create index if not exists archival_group_activity_unfinished_idx
+    on archival_group_activity (status, next_attempt, id)
+    where status in ('queued', 'running', 'failed');
@@ -0,0 +1,13 @@
+-- The high-water mark: the end time of the latest activity read from the stream.
+-- Kept in its own single row so that it survives old activity rows being archived.
+create table if not exists activity_stream_checkpoint
+(
+    id                           integer                  not null
+        primary key
+        check (id = 1),
+    last_end_time                timestamp with time zone not null
+);
+
+insert into activity_stream_checkpoint (id, last_end_time)
+    select 1, max(activity_end_time) from archival_group_activity having max(activity_end_time) is not null
+on conflict (id) do nothing;
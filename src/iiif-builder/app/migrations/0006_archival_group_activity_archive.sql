@@ -0,0 +1,8 @@
+-- Finished jobs older than ACTIVITY_RETENTION_DAYS are moved here by python -m app.retention
+create table if not exists archival_group_activity_archive
+(
+    like archival_group_activity including defaults
+);
+
+create index if not exists archival_group_activity_archive_ag_uri_idx
+    on archival_group_activity_archive (archival_group_uri, id);
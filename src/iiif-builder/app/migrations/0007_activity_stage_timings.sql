@@ -0,0 +1,21 @@
+-- How long each stage of the latest attempt took (see ACTIVITY_STAGES in app/db.py)
+alter table archival_group_activity
+    add column if not exists ag_load_seconds double precision,
+    add column if not exists mets_fetch_seconds double precision,
+    add column if not exists mets_parse_seconds double precision,
+    add column if not exists identity_lookup_seconds double precision,
+    add column if not exists catalogue_read_seconds double precision,
+    add column if not exists manifest_build_seconds double precision,
+    add column if not exists iiifcs_get_seconds double precision,
+    add column if not exists iiifcs_put_seconds double precision;
+
+-- The archive has the same columns, so archived rows keep their timings
+alter table archival_group_activity_archive
+    add column if not exists ag_load_seconds double precision,
+    add column if not exists mets_fetch_seconds double precision,
+    add column if not exists mets_parse_seconds double precision,
+    add column if not exists identity_lookup_seconds double precision,
+    add column if not exists catalogue_read_seconds double precision,
+    add column if not exists manifest_build_seconds double precision,
+    add column if not exists iiifcs_get_seconds double precision,
+    add column if not exists iiifcs_put_seconds double precision;
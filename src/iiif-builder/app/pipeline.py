@@ -0,0 +1,27 @@
+import asyncio
+
+from app.result import Result
+
+
+async def gather_results(*coroutines) -> Result:
+    """
+    Runs coroutines that each return a Result concurrently.
+    As soon as one of them fails, the others are cancelled and that failure is returned;
+    otherwise returns a successful Result whose value is the list of values, in argument order.
+    An exception raised by any of them also cancels the others, then propagates.
+    """
+    tasks = [asyncio.create_task(coroutine) for coroutine in coroutines]
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # check in argument order so that simultaneous failures resolve the same way every time
+            for task in tasks:
+                if task in done and task.result().failure:
+                    return task.result()
+        return Result.success([task.result().value for task in tasks])
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
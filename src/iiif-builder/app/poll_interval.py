@@ -0,0 +1,25 @@
+class AdaptivePollInterval:
+    """
+    Decides how long to wait before reading the activity stream again.
+    While reads keep turning up new activities the stream is read again straight away;
+    once it goes quiet the wait starts at min_interval and doubles on each idle read,
+    up to max_interval. After a failed read it waits max_interval.
+    """
+    def __init__(self, min_interval:float, max_interval:float):
+        self.min_interval = min(min_interval, max_interval)
+        self.max_interval = max_interval
+        self._idle_interval = self.min_interval
+
+
+    def next_interval(self, found_activities:bool) -> float:
+        if found_activities:
+            self._idle_interval = self.min_interval
+            return 0
+        interval = self._idle_interval
+        self._idle_interval = min(max(self._idle_interval * 2, self.min_interval), self.max_interval)
+        return interval
+
+
+    def failed_interval(self) -> float:
+        self._idle_interval = self.min_interval
+        return self.max_interval
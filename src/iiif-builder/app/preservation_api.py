@@ -1,5 +1,12 @@
+import asyncio
+import collections
 import datetime
+import re
+import time
 import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import aclosing
+from multiprocessing import get_context
 
 import msal
 
@@ -7,75 +14,349 @@ from aiohttp import ClientSession
 from logzero import logger
 
 from app import settings
-from app.mets_parser.mets_parser import get_mets_wrapper_from_file_like_object, get_mets_wrapper_from_string
+from app.activity_summary import timed_stage
+from app.mets_parser.mets_parser import get_mets_wrapper_from_bytes, get_mets_wrapper_streaming_from_bytes
+from app.resilience import resilient_request
 from app.result import Result
 
 
-preservation_confidential_client = msal.ConfidentialClientApplication(
-    client_id=settings.PRESERVATION_CLIENT_ID,
-    client_credential=settings.PRESERVATION_CLIENT_SECRET,
-    authority=settings.PRESERVATION_AUTHORITY_URL
+def create_preservation_client():
+    # Constructing the client calls AAD (authority discovery), so this happens on first use, off the event loop
+    return msal.ConfidentialClientApplication(
+        client_id=settings.PRESERVATION_CLIENT_ID,
+        client_credential=settings.PRESERVATION_CLIENT_SECRET,
+        authority=settings.PRESERVATION_AUTHORITY_URL
+    )
+
+
+page_number_pattern = re.compile(r"^(.*\D)(\d+)$")
+
+_mets_parse_executor: ProcessPoolExecutor | None = None
+
+
+def open_mets_parse_pool():
+    """
+    Start the worker processes that parse large METS documents. Until this is called
+    (or if METS_PARSE_PROCESS_COUNT is 0) every METS is parsed on the event loop.
+    """
+    global _mets_parse_executor
+    if _mets_parse_executor is None and settings.METS_PARSE_PROCESS_COUNT > 0:
+        _mets_parse_executor = ProcessPoolExecutor(max_workers=settings.METS_PARSE_PROCESS_COUNT,
+                                                   mp_context=get_context("spawn"))
+        logger.info(f"Started {settings.METS_PARSE_PROCESS_COUNT} METS parser process(es) "
+                    f"for METS of {settings.METS_PARSE_OFFLOAD_THRESHOLD} bytes or more")
+
+
+def close_mets_parse_pool():
+    global _mets_parse_executor
+    if _mets_parse_executor is not None:
+        _mets_parse_executor.shutdown(wait=True, cancel_futures=True)
+        _mets_parse_executor = None
+
+
+class PreservationTokenProvider:
+    """
+    Supplies the headers for calling Preservation API. MSAL is synchronous and may make an
+    HTTPS call to AAD, so it runs in the default executor rather than on the event loop.
+    The headers are kept in memory; once started, a background task refreshes them
+    refresh_margin seconds before the token expires, so requests don't normally wait for AAD.
+    Concurrent callers that do need a token share a single in-flight refresh.
+    The MSAL client is made by client_factory when the first token is needed; or set client_application
+    to anything with MSAL's acquire_token_silent and acquire_token_for_client.
+    """
+    def __init__(self, client_factory, scope:str, refresh_margin:float, retry_interval:float):
+        self.client_factory = client_factory
+        self.client_application = None
+        self.scope = scope
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self._headers:dict | None = None
+        self._expires_at = 0.0
+        self._refresh_task:asyncio.Task | None = None
+        self._background_task:asyncio.Task | None = None
+
+
+    async def get_headers(self) -> dict | None:
+        if self._headers is None or time.monotonic() >= self._expires_at:
+            await self.refresh()
+        return self._headers
+
+
+    async def refresh(self):
+        """Refresh the token, or wait for the refresh already in progress"""
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh())
+            self._refresh_task.add_done_callback(self._on_refreshed)
+        # shielded so that a cancelled caller doesn't cancel the refresh for everyone else
+        await asyncio.shield(self._refresh_task)
+
+
+    def start(self):
+        if self._background_task is None:
+            self._background_task = asyncio.create_task(self._run())
+
+
+    async def stop(self):
+        if self._background_task is not None:
+            self._background_task.cancel()
+            await asyncio.gather(self._background_task, return_exceptions=True)
+            self._background_task = None
+
+
+    async def _run(self):
+        while True:
+            delay = self.retry_interval
+            if self._headers is not None:
+                # MSAL may hand back its cached token until that is nearly expired, so never spin
+                delay = max(self._expires_at - self.refresh_margin - time.monotonic(), self.retry_interval)
+            await asyncio.sleep(delay)
+            await self.refresh()
+
+
+    async def _refresh(self):
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(None, self._acquire_token)
+        except Exception as e:
+            logger.error(f"Error obtaining access token from AAD: {repr(e)}")
+            result = None
+
+        if result and "access_token" in result:
+            self._headers = {
+                "Authorization": f"Bearer {result['access_token']}",
+                settings.PRESERVATION_CLIENT_IDENTITY_HEADER: settings.IIIF_BUILDER_IDENTITY
+            }
+            self._expires_at = time.monotonic() + float(result.get("expires_in", 0))
+            logger.debug(f"Preservation auth token expires in {result.get('expires_in', 0)}s")
+            return
+
+        logger.error("No access token obtained from AAD.")
+        if time.monotonic() >= self._expires_at:
+            self._headers = None
+
+
+    def _acquire_token(self):
+        if self.client_application is None:
+            self.client_application = self.client_factory()
+        result = self.client_application.acquire_token_silent(self.scope, account=None)
+        if not result:
+            logger.info("No Preservation auth token exists in cache, fetching a new one from AAD.")
+            result = self.client_application.acquire_token_for_client(scopes=[self.scope])
+        return result
+
+
+    def _on_refreshed(self, task:asyncio.Task):
+        self._refresh_task = None
+
+
+preservation_token_provider = PreservationTokenProvider(
+    create_preservation_client,
+    settings.PRESERVATION_SCOPE,
+    settings.PRESERVATION_TOKEN_REFRESH_MARGIN,
+    settings.PRESERVATION_TOKEN_RETRY_INTERVAL
 )
 
 
-def get_preservation_headers():
-    result = preservation_confidential_client.acquire_token_silent(settings.PRESERVATION_SCOPE, account=None)
-    if not result:
-        logger.info("No Preservation auth token exists in cache, fetching a new one from AAD.")
-        result = preservation_confidential_client.acquire_token_for_client(scopes=[settings.PRESERVATION_SCOPE])
+class PreservationTokenError(Exception):
+    """No access token for Preservation API could be obtained from AAD"""
 
-    if "access_token" in result:
-        return {
-            "Authorization": f"Bearer {result['access_token']}",
-            settings.PRESERVATION_CLIENT_IDENTITY_HEADER: settings.IIIF_BUILDER_IDENTITY
-        }
 
-    logger.error("No access token obtained from AAD.")
-    return None
+async def get_preservation_headers() -> dict:
+    """The headers for calling Preservation API. Raises PreservationTokenError if there is no token."""
+    headers = await preservation_token_provider.get_headers()
+    if headers is None:
+        raise PreservationTokenError("No access token could be obtained for Preservation API")
+    return headers
 
 
 def get_verify_ssl(uri):
     return not uri.startswith("https://localhost:")
 
 
-async def get_activities(stream_uri: str, session: ClientSession, last_event_time: datetime.datetime) -> Result:
+class ActivityStreamError(Exception):
+    """The activity stream couldn't be read, or not all the way to the end"""
+
+
+class ActivityStreamState:
+    """
+    What get_activities remembers between reads of the stream.
+    """
+    def __init__(self):
+        # ETag of the collection document, once all the activities it described have been read
+        self.collection_etag:str = None
 
+
+async def get_activities(stream_uri: str, session: ClientSession, last_event_time: datetime.datetime,
+                         stream_state: ActivityStreamState = None):
+    """
+    Async generator of the activities in the stream that ended after last_event_time,
+    oldest first. Activities are yielded as soon as the page they are on arrives.
+    When the collection's page URIs are numbered (as Preservation API's are), the page to start
+    from is found without walking every page, and the following pages are prefetched
+    concurrently while earlier activities are being processed.
+    If a stream_state is supplied, the collection is requested conditionally; an unchanged
+    collection (304) yields nothing.
+    Raises ActivityStreamError if the stream can't be read, after yielding whatever had been read
+    (so a failed read can be told apart from an idle stream).
+    """
     verify_ssl = get_verify_ssl(stream_uri)
     try:
-        activities = []
-        headers = get_preservation_headers()
-        coll_response = await session.get(stream_uri, headers=headers, verify_ssl=verify_ssl)
-        coll = await coll_response.json()
-        page_uri = coll.get("last", {}).get("id", None)
-        while page_uri is not None:
-            page_response = await session.get(page_uri, headers=headers, verify_ssl=verify_ssl)
-            page = await page_response.json()
-            ordered_items = page.get("orderedItems", [])
-            for activity in reversed(ordered_items):
-                end_time = activity.get("endTime", None)
-                if end_time is None: continue
-                end_time_date = datetime.datetime.fromisoformat(end_time)
-                if end_time_date > last_event_time:
-                    activities.append(activity)
-                else:
-                    return Result.success(activities)
-            page_uri = page.get("prev", {}).get("id", None)
+        headers = await get_preservation_headers()
+        coll_headers = headers
+        if stream_state is not None and stream_state.collection_etag is not None:
+            coll_headers = headers.copy()
+            coll_headers["If-None-Match"] = stream_state.collection_etag
+        async with resilient_request(session, "GET", stream_uri, headers=coll_headers, ssl=verify_ssl) as coll_response:
+            if coll_response.status == 304:
+                logger.debug(f"Activity stream {stream_uri} has not changed")
+                return
+            coll_response.raise_for_status()
+            coll_etag = coll_response.headers.get("ETag", None)
+            coll = await coll_response.json()
+        first_page_uri = coll.get("first", {}).get("id", None)
+        last_page_uri = coll.get("last", {}).get("id", None)
+        if last_page_uri is None:
+            if stream_state is not None:
+                stream_state.collection_etag = coll_etag
+            return
+
+        page_numbering = get_page_numbering(first_page_uri, last_page_uri)
+        if page_numbering is None:
+            logger.debug(f"Page URIs in {stream_uri} are not numbered, walking back through prev links")
+            pages = walk_back_to(session, last_page_uri, headers, verify_ssl, last_event_time)
+        else:
+            prefix, first_page, last_page = page_numbering
+            pages = read_forward_from(session, prefix, first_page, last_page, headers, verify_ssl, last_event_time)
 
-        return Result.success(activities)
+        async with aclosing(pages):
+            async for page in pages:
+                for activity in page.get("orderedItems", []):
+                    end_time = activity.get("endTime", None)
+                    if end_time is None: continue
+                    if datetime.datetime.fromisoformat(end_time) > last_event_time:
+                        yield activity
+
+        # Only now has everything this version of the collection describes been read
+        if stream_state is not None:
+            stream_state.collection_etag = coll_etag
 
     except Exception as e:
         et = traceback.format_exc()
         logger.error(f"Error getting activities (traceback): {et}")
-        logger.error(f"Error getting activities: {repr(e)}")
-        return Result(False, "Unable to get activities")
+        raise ActivityStreamError(f"Unable to get activities from {stream_uri}: {repr(e)}") from e
+
+
+def get_page_numbering(first_page_uri: str, last_page_uri: str):
+    """
+    If both page URIs end with a page number after the same prefix, returns (prefix, first, last)
+    """
+    if first_page_uri is None or last_page_uri is None:
+        return None
+    first_match = page_number_pattern.match(first_page_uri)
+    last_match = page_number_pattern.match(last_page_uri)
+    if first_match is None or last_match is None or first_match.group(1) != last_match.group(1):
+        return None
+    return first_match.group(1), int(first_match.group(2)), int(last_match.group(2))
+
+
+def get_latest_end_time(page):
+    end_times = [datetime.datetime.fromisoformat(activity["endTime"])
+                 for activity in page.get("orderedItems", []) if activity.get("endTime", None) is not None]
+    if len(end_times) == 0:
+        return None
+    return max(end_times)
+
+
+async def read_forward_from(session: ClientSession, prefix: str, first_page: int, last_page: int,
+                            headers, verify_ssl, last_event_time: datetime.datetime):
+    """
+    Yields the pages that contain activities after last_event_time, in order,
+    keeping up to ACTIVITY_PAGE_PREFETCH page requests in flight.
+    """
+    fetched = {}
+
+    async def is_new(page_number) -> bool:
+        page = await get_json(session, f"{prefix}{page_number}", headers, verify_ssl)
+        fetched[page_number] = page
+        latest = get_latest_end_time(page)
+        return latest is not None and latest > last_event_time
+
+    if last_page < first_page or not await is_new(last_page):
+        return
+
+    # Gallop back from the last page - normally the start is on the last page or the one before -
+    # then binary search for the first page that has anything new on it.
+    newest_old_page, oldest_new_page = first_page - 1, last_page
+    step = 1
+    while last_page - step >= first_page:
+        probe = last_page - step
+        if await is_new(probe):
+            oldest_new_page = probe
+            step *= 2
+        else:
+            newest_old_page = probe
+            break
+    while oldest_new_page - newest_old_page > 1:
+        middle = (oldest_new_page + newest_old_page) // 2
+        if await is_new(middle):
+            oldest_new_page = middle
+        else:
+            newest_old_page = middle
+
+    logger.debug(f"Reading activity pages {oldest_new_page} to {last_page}")
+    in_flight = collections.deque()
+    next_page = oldest_new_page
+    try:
+        while len(in_flight) > 0 or next_page <= last_page:
+            while next_page <= last_page and len(in_flight) < max(1, settings.ACTIVITY_PAGE_PREFETCH):
+                if next_page in fetched:
+                    future = asyncio.get_running_loop().create_future()
+                    future.set_result(fetched.pop(next_page))
+                else:
+                    future = asyncio.create_task(get_json(session, f"{prefix}{next_page}", headers, verify_ssl))
+                in_flight.append(future)
+                next_page += 1
+            yield await in_flight.popleft()
+    finally:
+        for future in in_flight:
+            future.cancel()
+        # Wait for the cancelled requests, so that nothing they raised goes unretrieved
+        await asyncio.gather(*in_flight, return_exceptions=True)
+
+
+async def walk_back_to(session: ClientSession, page_uri: str, headers, verify_ssl, last_event_time: datetime.datetime):
+    """
+    Fallback for streams whose page URIs can't be predicted; follows prev links until it
+    reaches activities at or before last_event_time, then yields those pages oldest first.
+    """
+    pages = []
+    while page_uri is not None:
+        page = await get_json(session, page_uri, headers, verify_ssl)
+        pages.append(page)
+        ordered_items = page.get("orderedItems", [])
+        if len(ordered_items) > 0 and any(
+                datetime.datetime.fromisoformat(activity["endTime"]) <= last_event_time
+                for activity in ordered_items if activity.get("endTime", None) is not None):
+            break
+        page_uri = page.get("prev", {}).get("id", None)
+
+    for page in reversed(pages):
+        yield page
+
+
+async def get_json(session: ClientSession, uri: str, headers, verify_ssl):
+    async with resilient_request(session, "GET", uri, headers=headers, ssl=verify_ssl) as response:
+        response.raise_for_status()
+        return await response.json()
 
 
 async def load_archival_group(session: ClientSession, archival_group_uri: str) -> Result:
 
     verify_ssl = get_verify_ssl(archival_group_uri)
     try:
-        ag_response = await session.get(archival_group_uri, headers=get_preservation_headers(), verify_ssl=verify_ssl)
-        ag = await ag_response.json()
+        async with resilient_request(session, "GET", archival_group_uri, headers=await get_preservation_headers(), ssl=verify_ssl) as ag_response:
+            ag_response.raise_for_status()
+            ag = await ag_response.json()
         return Result.success(ag)
     except Exception as e:
         logger.error(f"Error getting archival group: {repr(e)}")
@@ -86,12 +367,27 @@ async def load_mets(session: ClientSession, archival_group_uri:str) -> Result:
 
     verify_ssl = get_verify_ssl(archival_group_uri)
     try:
-        mets_response = await session.get(f"{archival_group_uri}?view=mets", headers=get_preservation_headers(), verify_ssl=verify_ssl)
-        # mets_wrapper = get_mets_wrapper_from_file_like_object(mets_response.content)
-        mets_str = await mets_response.text()
-        mets_wrapper = get_mets_wrapper_from_string(mets_str)
+        with timed_stage("mets_fetch"):
+            async with resilient_request(session, "GET", f"{archival_group_uri}?view=mets", headers=await get_preservation_headers(), ssl=verify_ssl) as mets_response:
+                mets_response.raise_for_status()
+                mets_bytes = await mets_response.read()
+        with timed_stage("mets_parse"):
+            mets_wrapper = await parse_mets(mets_bytes)
         return Result.success(mets_wrapper)
 
     except Exception as e:
         logger.error(f"Error getting mets: {repr(e)}")
-        return Result(False, "Unable to load Mets")
\ No newline at end of file
+        return Result(False, "Unable to load Mets")
+
+
+async def parse_mets(mets_bytes: bytes):
+    """
+    Small METS are parsed in place. Large ones would hold up every other request on the loop, so they
+    go to a worker process, which parses in a single streaming pass and sends back the MetsWrapper
+    (plain slotted objects, with the parser's record maps already released) rather than any lxml tree.
+    """
+    if _mets_parse_executor is None or len(mets_bytes) < settings.METS_PARSE_OFFLOAD_THRESHOLD:
+        return get_mets_wrapper_from_bytes(mets_bytes)
+    logger.debug(f"Parsing {len(mets_bytes)} bytes of METS in a worker process")
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_mets_parse_executor, get_mets_wrapper_streaming_from_bytes, mets_bytes)
@@ -0,0 +1,37 @@
+import argparse
+import asyncio
+from datetime import datetime
+
+from logzero import logger
+
+from app.db import ArchivalGroupActivity, open_pool, close_pool
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Queue archival group activity jobs to be processed again by the next builder that claims them. "
+                    "Their Manifests are rebuilt and saved to IIIF-CS even if they haven't changed.")
+    parser.add_argument("--prefix", help="only jobs for archival group URIs that start with this")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="only activities that ended at or after this timestamp")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="only activities that ended before this timestamp")
+    parser.add_argument("--include-finished", action="store_true",
+                        help="requeue succeeded and skipped jobs too, not just failed and dead ones")
+    parsed = parser.parse_args(args)
+    if parsed.prefix is None and parsed.since is None and parsed.until is None:
+        parser.error("give at least one of --prefix, --since or --until")
+    return parsed
+
+
+async def requeue(args):
+    await open_pool()
+    try:
+        count = await ArchivalGroupActivity.requeue(args.prefix, args.since, args.until, args.include_finished)
+        logger.info(f"Requeued {count} job(s)")
+    finally:
+        await close_pool()
+
+
+if __name__ == "__main__":
+    # From the iiif-builder directory, e.g.
+    # python -m app.requeue --prefix https://preservation.example/repository/cc/ --since 2025-05-01T00:00:00Z
+    asyncio.run(requeue(parse_args()))
@@ -0,0 +1,203 @@
+import asyncio
+import random
+import time
+import urllib.parse
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+from logzero import logger
+
+from app import settings
+
+# Worth trying again; the request itself was fine
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+# A sign that the service is unwell (429 just means slow down, so isn't counted)
+BREAKER_FAILURE_STATUSES = {500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+# A request with one of these is only applied if the resource hasn't changed. If the first attempt
+# was applied but its response was lost, a retry fails the precondition, so they are never retried.
+CONDITIONAL_HEADERS = {"if-match", "if-unmodified-since"}
+
+
+class CircuitOpenError(Exception):
+    """A host has failed too often recently, and didn't recover within the time we were prepared to wait"""
+
+
+class CircuitBreaker:
+    """
+    Tracks consecutive failures of calls to one host. After failure_threshold of them the circuit
+    opens for reset_timeout seconds, during which requests wait (up to max_wait) instead of being
+    sent. Once it has elapsed the circuit is half open: a single request is let through as a probe
+    while the rest keep waiting. If the probe succeeds the circuit closes and they all go ahead;
+    if it fails the circuit opens for a further reset_timeout.
+    Waiting rather than failing means a dependency that is down pauses the workers that need it,
+    rather than failing every activity in the backlog; and when it recovers, it isn't hit by the
+    whole backlog at once until it has shown it can cope.
+    """
+    def __init__(self, host:str, failure_threshold:int, reset_timeout:float, max_wait:float):
+        self.host = host
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.max_wait = max_wait
+        self._consecutive_failures = 0
+        self._open_until = 0.0
+        self._probing = False
+        self._probe_finished = asyncio.Event()
+
+
+    def is_open(self) -> bool:
+        return time.monotonic() < self._open_until
+
+
+    def is_closed(self) -> bool:
+        return self._consecutive_failures < self.failure_threshold
+
+
+    async def wait_until_closed(self) -> bool:
+        """
+        Returns once a request can be sent: True if it is to be the half-open probe, in which case
+        the caller must record its outcome, or call end_probe if it has none.
+        """
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            now = time.monotonic()
+            if now < self._open_until:
+                if self._open_until > deadline:
+                    raise CircuitOpenError(f"Circuit for {self.host} is open after {self._consecutive_failures} consecutive failures")
+                await asyncio.sleep(self._open_until - now)
+            elif self.is_closed():
+                return False
+            elif not self._probing:
+                self._probing = True
+                self._probe_finished.clear()
+                logger.info(f"Circuit for {self.host} is half open, sending a probe request")
+                return True
+            else:
+                try:
+                    await asyncio.wait_for(self._probe_finished.wait(), deadline - now)
+                except TimeoutError:
+                    raise CircuitOpenError(f"Circuit for {self.host} is still half open after waiting {self.max_wait}s for a probe request")
+
+
+    def record_success(self):
+        if not self.is_closed():
+            logger.info(f"Circuit for {self.host} closed")
+        self._consecutive_failures = 0
+        self.end_probe()
+
+
+    def record_failure(self):
+        self._consecutive_failures += 1
+        if not self.is_closed():
+            if not self.is_open():
+                logger.warning(f"Circuit for {self.host} opened for {self.reset_timeout}s after {self._consecutive_failures} consecutive failures")
+            self._open_until = time.monotonic() + self.reset_timeout
+        self.end_probe()
+
+
+    def end_probe(self):
+        """Wake the requests waiting on a probe, to go ahead, wait again, or (if it had no outcome) send another"""
+        self._probing = False
+        self._probe_finished.set()
+
+
+_breakers:dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(url:str) -> CircuitBreaker:
+    host = urllib.parse.urlparse(url).netloc
+    breaker = _breakers.get(host, None)
+    if breaker is None:
+        breaker = CircuitBreaker(host, settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+                                 settings.CIRCUIT_BREAKER_RESET_TIMEOUT, settings.CIRCUIT_BREAKER_MAX_WAIT)
+        _breakers[host] = breaker
+    return breaker
+
+
+def get_backoff_delay(attempt:int) -> float:
+    """Full-jitter exponential backoff for the given retry (1 for the first)"""
+    ceiling = min(settings.HTTP_RETRY_MAX_DELAY, settings.HTTP_RETRY_BASE_DELAY * (2 ** (attempt - 1)))
+    return random.uniform(0, ceiling)
+
+
+def get_retry_after(response:aiohttp.ClientResponse) -> float | None:
+    """Seconds to wait according to a Retry-After header (delta-seconds or HTTP-date), if there is one"""
+    value = response.headers.get("Retry-After", None)
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(method:str, headers) -> bool:
+    if method.upper() not in IDEMPOTENT_METHODS:
+        return False
+    if method.upper() in ("GET", "HEAD", "OPTIONS") or not headers:
+        return True
+    return not any(name.lower() in CONDITIONAL_HEADERS for name in headers)
+
+
+@asynccontextmanager
+async def resilient_request(session:aiohttp.ClientSession, method:str, url:str, **kwargs):
+    """
+    Use in place of `async with session.request(method, url, ...)`.
+    Idempotent, unconditional requests that fail to connect, time out, or get a retryable status are retried up to
+    HTTP_RETRY_ATTEMPTS times in all, with jittered exponential backoff (or as long as Retry-After asks,
+    up to HTTP_RETRY_MAX_DELAY). Every request waits while the host's circuit breaker is open.
+    The response for the last attempt is yielded whatever its status, and released afterwards;
+    callers must check it (an exhausted retry yields the final 5xx response).
+    """
+    breaker = get_circuit_breaker(url)
+    max_attempts = max(1, settings.HTTP_RETRY_ATTEMPTS) if is_retryable(method, kwargs.get("headers", None)) else 1
+    attempt = 0
+    while True:
+        attempt += 1
+        is_probe = await breaker.wait_until_closed()
+        try:
+            response = await session.request(method, url, **kwargs)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            breaker.record_failure()
+            if attempt >= max_attempts:
+                raise
+            delay = get_backoff_delay(attempt)
+            logger.warning(f"{method} {url} failed ({repr(e)}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            # e.g. cancelled; the host's health is no better known than before
+            if is_probe:
+                breaker.end_probe()
+            raise
+
+        if response.status in BREAKER_FAILURE_STATUSES:
+            breaker.record_failure()
+        elif response.status in RETRYABLE_STATUSES:
+            # 408 and 429 say nothing about the host's health either way
+            if is_probe:
+                breaker.end_probe()
+        else:
+            breaker.record_success()
+
+        if response.status in RETRYABLE_STATUSES and attempt < max_attempts:
+            delay = get_retry_after(response)
+            if delay is None:
+                delay = get_backoff_delay(attempt)
+            delay = min(delay, settings.HTTP_RETRY_MAX_DELAY)
+            response.release()
+            logger.warning(f"{method} {url} returned {response.status}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+
+        try:
+            yield response
+        finally:
+            response.release()
+        return
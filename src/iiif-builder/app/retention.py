@@ -0,0 +1,41 @@
+import argparse
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from logzero import logger
+
+from app import settings
+from app.db import ArchivalGroupActivity, open_pool, close_pool
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Move old succeeded and skipped archival group activity jobs to archival_group_activity_archive.")
+    parser.add_argument("--days", type=float, default=settings.ACTIVITY_RETENTION_DAYS,
+                        help="archive jobs for activities that ended more than this many days ago "
+                             f"(default {settings.ACTIVITY_RETENTION_DAYS:g})")
+    parser.add_argument("--batch-size", type=int, default=settings.ACTIVITY_ARCHIVE_BATCH_SIZE,
+                        help=f"rows moved per transaction (default {settings.ACTIVITY_ARCHIVE_BATCH_SIZE})")
+    return parser.parse_args(args)
+
+
+async def archive(args):
+    before = datetime.now(tz=timezone.utc) - timedelta(days=args.days)
+    await open_pool()
+    try:
+        total = 0
+        # Small batches keep each transaction (and the locks it holds) short, so a running builder isn't held up
+        while True:
+            moved = await ArchivalGroupActivity.archive_finished(before, args.batch_size)
+            total += moved
+            if moved < args.batch_size:
+                break
+        logger.info(f"Archived {total} job(s) for activities that ended before {before.isoformat()}")
+    finally:
+        await close_pool()
+
+
+if __name__ == "__main__":
+    # From the iiif-builder directory, e.g. daily from cron:
+    # python -m app.retention --days 90
+    asyncio.run(archive(parse_args()))
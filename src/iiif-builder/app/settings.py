@@ -3,11 +3,93 @@ from dotenv import load_dotenv
 
 load_dotenv()  # take environment variables from .env file; to then be superseded by the below
 
+# DEBUG adds per-file and per-asset detail; at INFO each activity gets a single summary record
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+# 'text' (human readable) or 'json' (one object per line, with the job id and archival group URI)
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+
+# Prometheus metrics are served at http://METRICS_HOST:METRICS_PORT/metrics (0 turns this off)
+METRICS_HOST = os.environ.get('METRICS_HOST', '0.0.0.0')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9100'))
+# How often (seconds) the backlog gauges are refreshed from the DB
+METRICS_BACKLOG_INTERVAL = float(os.environ.get('METRICS_BACKLOG_INTERVAL', '15'))
+
 # IIIF-Builder's dedicated DB for recording activity
 POSTGRES_CONNECTION = os.environ.get('POSTGRES_CONNECTION')
+POSTGRES_POOL_MIN_SIZE = int(os.environ.get('POSTGRES_POOL_MIN_SIZE', '2'))
+POSTGRES_POOL_MAX_SIZE = int(os.environ.get('POSTGRES_POOL_MAX_SIZE', '10'))
+# Apply any new migrations (app/migrations) when the builder starts; otherwise run python -m app.migrate first
+APPLY_MIGRATIONS_ON_STARTUP = os.environ.get('APPLY_MIGRATIONS_ON_STARTUP', 'true').lower() == 'true'
+# Succeeded and skipped jobs for activities older than this many days are moved to
+# archival_group_activity_archive by python -m app.retention, this many rows per transaction
+ACTIVITY_RETENTION_DAYS = float(os.environ.get('ACTIVITY_RETENTION_DAYS', '90'))
+ACTIVITY_ARCHIVE_BATCH_SIZE = int(os.environ.get('ACTIVITY_ARCHIVE_BATCH_SIZE', '5000'))
+# Job state changes are buffered and written in batches, at least this often (seconds)...
+JOB_STATE_FLUSH_INTERVAL = float(os.environ.get('JOB_STATE_FLUSH_INTERVAL', '2.0'))
+# ...or as soon as this many jobs have unsaved changes
+JOB_STATE_FLUSH_BATCH_SIZE = int(os.environ.get('JOB_STATE_FLUSH_BATCH_SIZE', '100'))
+# A job whose state can't be written on its own (e.g. a value the column won't take) is retried
+# in this many flushes, then its state change is dropped
+JOB_STATE_MAX_WRITE_ATTEMPTS = int(os.environ.get('JOB_STATE_MAX_WRITE_ATTEMPTS', '3'))
+# The longest wait between reads of an idle activity stream; a busy stream is read again immediately
 ACTIVITY_STREAM_READ_INTERVAL = float(os.environ.get('ACTIVITY_STREAM_READ_INTERVAL', '60.0'))
+# The first wait once the stream goes idle, doubling on each idle read up to ACTIVITY_STREAM_READ_INTERVAL
+ACTIVITY_STREAM_MIN_READ_INTERVAL = float(os.environ.get('ACTIVITY_STREAM_MIN_READ_INTERVAL', '2.0'))
 PRESERVATION_ACTIVITY_STREAM = os.environ.get('PRESERVATION_ACTIVITY_STREAM')
+# How many activity stream pages to fetch ahead of the one being processed
+ACTIVITY_PAGE_PREFETCH = int(os.environ.get('ACTIVITY_PAGE_PREFETCH', '4'))
 ACTIVITY_CUTOFF_DATE = os.environ.get('ACTIVITY_CUTOFF_DATE', None) # or a parseable timestamp, or None.  Example '2011-11-04T00:05:23Z'
+# How many activities (for different archival groups) are processed at once
+ACTIVITY_WORKER_COUNT = int(os.environ.get('ACTIVITY_WORKER_COUNT', '8'))
+# How many activities can be queued up (running or waiting) before the stream reader pauses
+ACTIVITY_WORKER_MAX_PENDING = int(os.environ.get('ACTIVITY_WORKER_MAX_PENDING', '200'))
+# A failed job is retried after JOB_RETRY_BASE_DELAY seconds, doubling each time up to JOB_RETRY_MAX_DELAY,
+# until it has been tried JOB_MAX_ATTEMPTS times; after that it needs requeueing by hand (python -m app.requeue)
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '5'))
+JOB_RETRY_BASE_DELAY = float(os.environ.get('JOB_RETRY_BASE_DELAY', '60'))
+JOB_RETRY_MAX_DELAY = float(os.environ.get('JOB_RETRY_MAX_DELAY', '3600'))
+# How many due retries are claimed after each read of the stream
+JOB_RETRY_BATCH_SIZE = int(os.environ.get('JOB_RETRY_BATCH_SIZE', '50'))
+# A running job's lease; it is renewed every third of this while the job is being processed, so a job whose
+# lease expires is assumed lost (e.g. its builder died) and retried
+JOB_LEASE_DURATION = float(os.environ.get('JOB_LEASE_DURATION', '1800'))
+# 'single': this builder reads the stream and processes every activity itself.
+# 'coordinated': any number of builders share the DB; one of them (the leader) reads the stream into
+# queued jobs, and each processes the jobs in its own partition of archival groups.
+BUILDER_MODE = os.environ.get('BUILDER_MODE', 'single')
+# In coordinated mode, how many builders there are, and which one (from 0) this is. Each index must be used once.
+BUILDER_REPLICA_COUNT = int(os.environ.get('BUILDER_REPLICA_COUNT', '1'))
+BUILDER_REPLICA_INDEX = int(os.environ.get('BUILDER_REPLICA_INDEX', '0'))
+# How often (seconds) a builder that isn't the leader, or can't get its partition, tries again
+BUILDER_LOCK_RETRY_INTERVAL = float(os.environ.get('BUILDER_LOCK_RETRY_INTERVAL', '15'))
+# How often (seconds) the leader checks the queued jobs in each partition, and how long (seconds) the oldest
+# can have been waiting before it warns that the partition's builder may not be running
+BUILDER_PARTITION_CHECK_INTERVAL = float(os.environ.get('BUILDER_PARTITION_CHECK_INTERVAL', '60'))
+BUILDER_PARTITION_STALL_AGE = float(os.environ.get('BUILDER_PARTITION_STALL_AGE', '900'))
+# Outbound HTTP: connections open at once in total, and to any one host
+HTTP_CONNECTION_LIMIT = int(os.environ.get('HTTP_CONNECTION_LIMIT', '100'))
+HTTP_CONNECTIONS_PER_HOST = int(os.environ.get('HTTP_CONNECTIONS_PER_HOST', '20'))
+# How long (seconds) resolved host names and idle keep-alive connections are kept
+HTTP_DNS_CACHE_TTL = int(os.environ.get('HTTP_DNS_CACHE_TTL', '300'))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get('HTTP_KEEPALIVE_TIMEOUT', '30'))
+# Timeouts (seconds) for a whole request, for connecting, and between reads of the response
+HTTP_TOTAL_TIMEOUT = float(os.environ.get('HTTP_TOTAL_TIMEOUT', '300'))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '10'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '60'))
+# Idempotent requests that fail transiently are tried this many times in all, backing off exponentially
+# (with jitter) from HTTP_RETRY_BASE_DELAY seconds; no wait, even one asked for by Retry-After, exceeds HTTP_RETRY_MAX_DELAY
+HTTP_RETRY_ATTEMPTS = int(os.environ.get('HTTP_RETRY_ATTEMPTS', '4'))
+HTTP_RETRY_BASE_DELAY = float(os.environ.get('HTTP_RETRY_BASE_DELAY', '0.5'))
+HTTP_RETRY_MAX_DELAY = float(os.environ.get('HTTP_RETRY_MAX_DELAY', '30'))
+# After this many consecutive failures calling a host, stop calling it for CIRCUIT_BREAKER_RESET_TIMEOUT seconds;
+# requests wait for the circuit to close for up to CIRCUIT_BREAKER_MAX_WAIT seconds before failing
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_BREAKER_FAILURE_THRESHOLD', '5'))
+CIRCUIT_BREAKER_RESET_TIMEOUT = float(os.environ.get('CIRCUIT_BREAKER_RESET_TIMEOUT', '30'))
+CIRCUIT_BREAKER_MAX_WAIT = float(os.environ.get('CIRCUIT_BREAKER_MAX_WAIT', '300'))
+# METS documents at least this big (bytes) are parsed in a worker process, off the event loop
+METS_PARSE_OFFLOAD_THRESHOLD = int(os.environ.get('METS_PARSE_OFFLOAD_THRESHOLD', '1048576'))
+# How many worker processes parse large METS documents; 0 parses everything on the event loop
+METS_PARSE_PROCESS_COUNT = int(os.environ.get('METS_PARSE_PROCESS_COUNT', '2'))
 
 # The header that iiif-builder passes to Preservation API as X-Client-Identity
 PRESERVATION_CLIENT_IDENTITY_HEADER = os.environ.get('PRESERVATION_CLIENT_IDENTITY_HEADER', "X-Client-Identity")
@@ -22,6 +104,10 @@ PRESERVATION_CLIENT_SECRET = os.environ.get('PRESERVATION_CLIENT_SECRET')
 PRESERVATION_TENANT_ID = os.environ.get('PRESERVATION_TENANT_ID')
 PRESERVATION_SCOPE = f"api://{PRESERVATION_CLIENT_ID}/.default"
 PRESERVATION_AUTHORITY_URL = f"https://login.microsoftonline.com/{PRESERVATION_TENANT_ID}" # /oauth2/token"
+# The Preservation API token is refreshed in the background this many seconds before it expires...
+PRESERVATION_TOKEN_REFRESH_MARGIN = float(os.environ.get('PRESERVATION_TOKEN_REFRESH_MARGIN', '300'))
+# ...or, if no token could be obtained, retried after this many seconds
+PRESERVATION_TOKEN_RETRY_INTERVAL = float(os.environ.get('PRESERVATION_TOKEN_RETRY_INTERVAL', '30'))
 
 # Details for calling Leeds Identity Service
 IDENTITY_SERVICE_BASE_URL = os.environ.get('IDENTITY_SERVICE_BASE_URL', 'https://dev-id.library.leeds.ac.uk/api/v1')
@@ -34,6 +120,10 @@ IIIF_CS_CUSTOMER_ID = os.environ.get('IIIF_CS_CUSTOMER_ID', 2)
 IIIF_CS_ASSET_SPACE_ID = os.environ.get('IIIF_CS_ASSET_SPACE_ID', 5)
 IIIF_CS_PRESENTATION_HOST = os.environ.get('IIIF_CS_PRESENTATION_HOST', 'https://dev-iiif.leeds.ac.uk/presentation/')
 IIIF_CS_BASIC_CREDENTIALS = os.environ.get('IIIF_CS_BASIC_CREDENTIALS')
+# The order of the canvases made from an archival group's images: 'files-first' (folder by folder, each folder's
+# files in structMap order before its sub-folders), 'structmap' (exactly as the METS structMap lists them),
+# 'path' (sorted by path) or 'natural' (sorted by path, with numbers in names compared as numbers)
+CANVAS_ORDER = os.environ.get('CANVAS_ORDER', 'files-first')
 
 # Catalogue API details (MVP version)
 CONSTRUCT_CATALOGUE_API_URI = os.environ.get('CONSTRUCT_CATALOGUE_API_URI', False)
@@ -43,3 +133,11 @@ MVP_CATALOGUE_API_KEY_VALUE = os.environ.get('MVP_CATALOGUE_API_KEY_VALUE')
 # This value is on the wiki page
 # https://dev.azure.com/universityofleeds/Library/_wiki/wikis/Library.wiki/4864/Present-IIIF(new)-manifests-to-Website
 
+# Caching of identity service and catalogue API lookups
+# How long (seconds) a cached lookup is used without asking the service again; after that it is revalidated
+IDENTITY_CACHE_TTL = float(os.environ.get('IDENTITY_CACHE_TTL', '86400'))
+CATALOGUE_CACHE_TTL = float(os.environ.get('CATALOGUE_CACHE_TTL', '3600'))
+# How many lookups each cache holds in memory
+LOOKUP_CACHE_MAX_ENTRIES = int(os.environ.get('LOOKUP_CACHE_MAX_ENTRIES', '10000'))
+# Also keep cached lookups in the lookup_cache table, so they survive a restart
+LOOKUP_CACHE_PERSISTENT = os.environ.get('LOOKUP_CACHE_PERSISTENT', 'false').lower() == 'true'
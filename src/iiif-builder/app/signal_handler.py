@@ -16,6 +16,10 @@ class SignalHandler:
         """
         return self._cancellation_requested
 
+    def request_cancellation(self):
+        """Stop as if a signal had been caught, e.g. when the builder is run by another program"""
+        self._cancellation_requested = True
+
     def _signal_handler(self, signum, frame):
         logger.info(f"Caught signal {signum}")
         self._cancellation_requested = True
@@ -0,0 +1,77 @@
+import json
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+import logzero
+from logzero import logger
+
+from app import settings
+
+# The job being processed by the current task, if any. Tasks started while processing it
+# (e.g. the fetches in gather_results) inherit it.
+_job_context:ContextVar[dict | None] = ContextVar("job_context", default=None)
+
+TEXT_FORMAT = "%(color)s[%(levelname)1.1s %(asctime)s %(module)s:%(lineno)d]%(end_color)s %(job_prefix)s%(message)s"
+
+
+@contextmanager
+def job_log_context(job_id:int, archival_group_uri:str):
+    """Tag every record logged in this block (and by tasks started in it) with the job"""
+    token = _job_context.set({"job_id": job_id, "archival_group_uri": archival_group_uri})
+    try:
+        yield
+    finally:
+        _job_context.reset(token)
+
+
+class JobContextFilter(logging.Filter):
+    """Adds the current job (job_id, archival_group_uri and, for the text format, job_prefix) to each record"""
+    def filter(self, record:logging.LogRecord) -> bool:
+        context = _job_context.get()
+        if context is None:
+            record.job_id = None
+            record.archival_group_uri = None
+            record.job_prefix = ""
+        else:
+            record.job_id = context["job_id"]
+            record.archival_group_uri = context["archival_group_uri"]
+            record.job_prefix = f"[job {record.job_id}] "
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record. Anything passed as extra={"fields": {...}} is included
+    under "fields", for records (such as the activity summary) that are meant to be queried.
+    """
+    def format(self, record:logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "module": record.module,
+            "line": record.lineno,
+            "message": record.getMessage()
+        }
+        job_id = getattr(record, "job_id", None)
+        if job_id is not None:
+            entry["job_id"] = job_id
+            entry["archival_group_uri"] = record.archival_group_uri
+        fields = getattr(record, "fields", None)
+        if fields is not None:
+            entry["fields"] = fields
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging():
+    """Set the level and format (LOG_LEVEL, LOG_FORMAT) of the logzero logger used throughout the builder"""
+    logzero.loglevel(logging.getLevelName(settings.LOG_LEVEL.upper()))
+    if settings.LOG_FORMAT == "json":
+        logzero.formatter(JsonFormatter())
+    else:
+        logzero.formatter(logzero.LogFormatter(fmt=TEXT_FORMAT))
+    if not any(isinstance(f, JobContextFilter) for f in logger.filters):
+        logger.addFilter(JobContextFilter())
@@ -0,0 +1,369 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
+import aiohttp
+import psycopg
+import pytest
+
+from app import db, preservation_api, resilience, settings
+from app.manifest_decorator import (CANVAS_ORDER_FILES_FIRST, CANVAS_ORDER_NATURAL, CANVAS_ORDER_PATH,
+                                    CANVAS_ORDER_STRUCTMAP, add_painted_resources, iter_files)
+from app.mets_parser.mets_parser import new_mets_wrapper
+from app.mets_parser.working_filesystem import WorkingFile
+from app.worker_pool import ActivityWorkerPool
+
+
+def test_worker_pool_runs_work_for_the_same_key_in_submission_order():
+    async def run():
+        pool = ActivityWorkerPool(worker_count=4, max_pending=10)
+        finished = []
+        def work(label, delay):
+            async def do():
+                await asyncio.sleep(delay)
+                finished.append(label)
+            return do
+        # the earlier work is the slowest, so it would finish last if it weren't waited for
+        await pool.submit("ag", work("first", 0.03))
+        await pool.submit("ag", work("second", 0.01))
+        await pool.submit("ag", work("third", 0))
+        await pool.drain()
+        return finished
+    assert asyncio.run(run()) == ["first", "second", "third"]
+
+
+def test_worker_pool_runs_different_keys_concurrently_up_to_worker_count():
+    async def run():
+        pool = ActivityWorkerPool(worker_count=3, max_pending=20)
+        running = 0
+        peak = 0
+        async def work():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+        for index in range(10):
+            await pool.submit(f"ag_{index}", work)
+        await pool.drain()
+        return peak
+    assert asyncio.run(run()) == 3
+
+
+def test_worker_pool_carries_on_with_a_key_after_its_work_fails():
+    async def run():
+        pool = ActivityWorkerPool(worker_count=2, max_pending=10)
+        finished = []
+        async def fails():
+            raise ValueError("broken")
+        async def succeeds():
+            finished.append("after")
+        await pool.submit("ag", fails)
+        await pool.submit("ag", succeeds)
+        await pool.drain()
+        return finished, pool.pending_count()
+    assert asyncio.run(run()) == (["after"], 0)
+
+
+def test_worker_pool_submit_waits_while_max_pending_work_is_unfinished():
+    async def run():
+        pool = ActivityWorkerPool(worker_count=1, max_pending=2)
+        release = asyncio.Event()
+        async def blocked():
+            await release.wait()
+        await pool.submit("a", blocked)
+        await pool.submit("b", blocked)
+        third = asyncio.create_task(pool.submit("c", blocked))
+        await asyncio.sleep(0.01)
+        waited = not third.done()
+        release.set()
+        await third
+        await pool.drain()
+        return waited
+    assert asyncio.run(run())
+
+
+class FakeConnection:
+    """Stands in for a pooled psycopg connection; rows whose error_message is 'bad' can't be written"""
+    def __init__(self, written:list, connection_lost:bool):
+        self.written = written
+        self.connection_lost = connection_lost
+
+    def _write(self, rows):
+        if self.connection_lost:
+            raise psycopg.OperationalError("connection lost")
+        # all or nothing, like the transaction the batch is written in
+        if any(values[6] == "bad" for values in rows):
+            raise psycopg.DataError("bad row")
+        self.written.extend(values[-1] for values in rows)
+
+    @asynccontextmanager
+    async def cursor(self):
+        conn = self
+        class Cursor:
+            async def executemany(self, sql, rows):
+                conn._write(rows)
+        yield Cursor()
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def execute(self, sql, values):
+        self._write([values])
+
+
+class FakePool:
+    def __init__(self):
+        self.written = []
+        self.connection_lost = False
+
+    @asynccontextmanager
+    async def connection(self):
+        yield FakeConnection(self.written, self.connection_lost)
+
+
+def make_job(id_, error_message=None):
+    return db.ArchivalGroupActivity(id_=id_, status=db.STATUS_FAILED, error_message=error_message, stage_timings={})
+
+
+def test_job_state_writer_writes_the_latest_state_of_each_job_in_one_batch(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(db, "get_pool", lambda: pool)
+    writer = db.JobStateWriter(batch_size=10, flush_interval=60, max_attempts=3)
+    job = make_job(1)
+    writer.save(job)
+    job.status = db.STATUS_SUCCEEDED
+    writer.save(job)
+    writer.save(make_job(2))
+    asyncio.run(writer.flush())
+    assert pool.written == [1, 2]
+    assert writer._pending == {}
+
+
+def test_job_state_writer_keeps_the_batch_when_postgres_cannot_be_reached(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(db, "get_pool", lambda: pool)
+    writer = db.JobStateWriter(batch_size=10, flush_interval=60, max_attempts=3)
+    writer.save(make_job(1))
+    writer.save(make_job(2))
+    pool.connection_lost = True
+    asyncio.run(writer.flush())
+    assert pool.written == []
+    assert sorted(writer._pending) == [1, 2]
+    pool.connection_lost = False
+    asyncio.run(writer.flush())
+    assert pool.written == [1, 2]
+
+
+def test_job_state_writer_writes_rows_one_at_a_time_and_drops_a_bad_row_after_max_attempts(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(db, "get_pool", lambda: pool)
+    writer = db.JobStateWriter(batch_size=10, flush_interval=60, max_attempts=2)
+    writer.save(make_job(1))
+    writer.save(make_job(2, error_message="bad"))
+    writer.save(make_job(3))
+    asyncio.run(writer.flush())
+    # the good rows are written despite the bad one, which is kept for another try
+    assert pool.written == [1, 3]
+    assert list(writer._pending) == [2]
+    asyncio.run(writer.flush())
+    assert writer._pending == {}
+    assert pool.written == [1, 3]
+
+
+def test_activity_stream_read_fails_clearly_without_a_preservation_token(monkeypatch):
+    async def no_headers():
+        return None
+    monkeypatch.setattr(preservation_api.preservation_token_provider, "get_headers", no_headers)
+    async def run():
+        activities = preservation_api.get_activities("https://preservation.example/activity", None,
+                                                     datetime.now(tz=timezone.utc))
+        async for _ in activities:
+            pass
+    with pytest.raises(preservation_api.ActivityStreamError) as raised:
+        asyncio.run(run())
+    assert isinstance(raised.value.__cause__, preservation_api.PreservationTokenError)
+
+
+class FakeResponse:
+    def __init__(self, status:int):
+        self.status = status
+        self.headers = {}
+
+    def release(self):
+        pass
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(None, (), status=self.status)
+
+    async def json(self):
+        return {"status": self.status}
+
+
+class FakeSession:
+    """Answers requests with the given statuses in turn, then 200s"""
+    def __init__(self, *statuses:int):
+        self.statuses = list(statuses)
+        self.requests = []
+
+    async def request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        return FakeResponse(self.statuses.pop(0) if self.statuses else 200)
+
+
+@pytest.fixture
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(settings, "HTTP_RETRY_ATTEMPTS", 3)
+    monkeypatch.setattr(settings, "HTTP_RETRY_BASE_DELAY", 0)
+    monkeypatch.setattr(settings, "HTTP_RETRY_MAX_DELAY", 0)
+    monkeypatch.setattr(resilience, "_breakers", {})
+
+
+def request_statuses(session, method, url, **kwargs) -> list[int]:
+    async def run():
+        async with resilience.resilient_request(session, method, url, **kwargs) as response:
+            return response.status
+    return asyncio.run(run())
+
+
+def test_resilient_request_retries_a_get_until_it_succeeds(no_retry_delay):
+    session = FakeSession(503, 502)
+    assert request_statuses(session, "GET", "https://host.example/a") == 200
+    assert len(session.requests) == 3
+
+
+def test_resilient_request_does_not_retry_a_conditional_put(no_retry_delay):
+    session = FakeSession(503)
+    assert request_statuses(session, "PUT", "https://host.example/a", headers={"If-Match": "etag"}) == 503
+    assert len(session.requests) == 1
+
+
+def test_preservation_get_json_raises_once_retries_are_exhausted(no_retry_delay):
+    session = FakeSession(503, 503, 503)
+    with pytest.raises(aiohttp.ClientResponseError):
+        asyncio.run(preservation_api.get_json(session, "https://host.example/a", {}, True))
+    assert len(session.requests) == 3
+
+
+def test_too_many_requests_leaves_the_circuit_breaker_alone(no_retry_delay, monkeypatch):
+    monkeypatch.setattr(settings, "HTTP_RETRY_ATTEMPTS", 1)
+    breaker = resilience.get_circuit_breaker("https://host.example/")
+    breaker.failure_threshold = 3
+    request_statuses(FakeSession(503), "GET", "https://host.example/a")
+    request_statuses(FakeSession(429), "GET", "https://host.example/a")
+    request_statuses(FakeSession(408), "GET", "https://host.example/a")
+    request_statuses(FakeSession(503), "GET", "https://host.example/a")
+    assert breaker._consecutive_failures == 2
+
+
+def test_half_open_circuit_breaker_lets_a_single_probe_through():
+    async def run():
+        breaker = resilience.CircuitBreaker("host.example", failure_threshold=1, reset_timeout=0.01, max_wait=5)
+        breaker.record_failure()
+        await asyncio.sleep(0.02)
+        probe = await breaker.wait_until_closed()
+        waiting = asyncio.create_task(breaker.wait_until_closed())
+        await asyncio.sleep(0.01)
+        waited_for_probe = not waiting.done()
+        breaker.record_success()
+        return probe, waited_for_probe, await waiting
+    # the waiting request goes ahead once the probe succeeds, and isn't a probe itself
+    assert asyncio.run(run()) == (True, True, False)
+
+
+def test_circuit_breaker_reopens_when_the_probe_fails():
+    async def run():
+        breaker = resilience.CircuitBreaker("host.example", failure_threshold=1, reset_timeout=0.05, max_wait=0.01)
+        breaker.record_failure()
+        await asyncio.sleep(0.06)
+        assert await breaker.wait_until_closed()
+        breaker.record_failure()
+        await breaker.wait_until_closed()
+    with pytest.raises(resilience.CircuitOpenError):
+        asyncio.run(run())
+
+
+@pytest.fixture
+def job_state_writer(monkeypatch):
+    """A writer that is never flushed, so jobs can be saved without a database"""
+    writer = db.JobStateWriter(batch_size=1000, flush_interval=60, max_attempts=3)
+    monkeypatch.setattr(db, "job_state_writer", writer)
+    return writer
+
+
+def test_failed_job_is_retried_with_exponential_backoff(job_state_writer, monkeypatch):
+    monkeypatch.setattr(settings, "JOB_MAX_ATTEMPTS", 5)
+    monkeypatch.setattr(settings, "JOB_RETRY_BASE_DELAY", 60)
+    monkeypatch.setattr(settings, "JOB_RETRY_MAX_DELAY", 300)
+    delays = []
+    for attempts in (1, 2, 3, 4):
+        job = db.ArchivalGroupActivity(id_=attempts, attempts=attempts)
+        before = datetime.now(timezone.utc)
+        job.fail("broken")
+        assert job.status == db.STATUS_FAILED
+        delays.append(round((job.next_attempt - before).total_seconds()))
+    assert delays == [60, 120, 240, 300]
+    assert job_state_writer._pending[4][7] == db.STATUS_FAILED
+
+
+def test_job_that_fails_on_its_last_attempt_is_dead(job_state_writer, monkeypatch):
+    monkeypatch.setattr(settings, "JOB_MAX_ATTEMPTS", 3)
+    job = db.ArchivalGroupActivity(id_=1, attempts=3)
+    job.fail("broken")
+    assert (job.status, job.next_attempt, job.error_message) == (db.STATUS_DEAD, None, "broken")
+
+
+def test_lease_is_renewed_until_the_job_finishes(job_state_writer, monkeypatch):
+    monkeypatch.setattr(settings, "JOB_LEASE_DURATION", 0.03)
+    async def run():
+        job = db.ArchivalGroupActivity(id_=1, next_attempt=datetime.now(timezone.utc) - timedelta(seconds=1))
+        renewal = asyncio.create_task(job.hold_lease())
+        await asyncio.sleep(0.025)
+        renewed = job.next_attempt > datetime.now(timezone.utc)
+        job.succeed()
+        await asyncio.wait_for(renewal, 1)
+        return renewed, job.next_attempt
+    assert asyncio.run(run()) == (True, None)
+
+
+def make_mets_wrapper(*structmap_paths:str):
+    """A wrapper holding an image at each path, as if the structMap listed them in that order"""
+    wrapper = new_mets_wrapper()
+    for path in structmap_paths:
+        file = WorkingFile()
+        file.local_path = path
+        file.name = path.split("/")[-1]
+        file.content_type = "image/jpeg"
+        wrapper.files.append(file)
+        wrapper.physical_structure.find_directory("/".join(path.split("/")[:-1]), True).add_file(file)
+    return wrapper
+
+
+# page10 is listed before page2, and sub-folder a/ between two of the top-level files
+STRUCTMAP_PATHS = ("cover.jpg", "a/page10.jpg", "a/page2.jpg", "back.jpg")
+
+
+@pytest.mark.parametrize("canvas_order, expected", [
+    (CANVAS_ORDER_FILES_FIRST, ["cover.jpg", "back.jpg", "a/page10.jpg", "a/page2.jpg"]),
+    (CANVAS_ORDER_PATH, ["a/page10.jpg", "a/page2.jpg", "back.jpg", "cover.jpg"]),
+    (CANVAS_ORDER_NATURAL, ["a/page2.jpg", "a/page10.jpg", "back.jpg", "cover.jpg"]),
+])
+def test_iter_files_walks_the_folders_in_canvas_order(canvas_order, expected):
+    wrapper = make_mets_wrapper(*STRUCTMAP_PATHS)
+    assert [file.local_path for file in iter_files(wrapper.physical_structure, canvas_order)] == expected
+
+
+@pytest.mark.parametrize("canvas_order, expected", [
+    (CANVAS_ORDER_STRUCTMAP, list(STRUCTMAP_PATHS)),
+    (CANVAS_ORDER_FILES_FIRST, ["cover.jpg", "back.jpg", "a/page10.jpg", "a/page2.jpg"]),
+])
+def test_painted_resources_are_numbered_in_canvas_order(canvas_order, expected):
+    wrapper = make_mets_wrapper(*STRUCTMAP_PATHS)
+    archival_group = {"origin": "s3://bucket/ag", "storageMap": {"files": {path: {"fullPath": path} for path in STRUCTMAP_PATHS}}}
+    result = add_painted_resources({}, archival_group, wrapper, "canvas_", "asset_", canvas_order)
+    assert result.success
+    painted_resources = result.value["paintedResources"]
+    assert [pr["asset"]["origin"] for pr in painted_resources] == [f"s3://bucket/ag/{path}" for path in expected]
+    assert [pr["canvasPainting"]["canvasOrder"] for pr in painted_resources] == [0, 1, 2, 3]
@@ -0,0 +1,64 @@
+import asyncio
+
+from logzero import logger
+
+
+class ActivityWorkerPool:
+    """
+    Runs activity processing concurrently, up to worker_count at a time.
+    Work submitted with the same key (the archival group URI) runs strictly in
+    submission order, so two events for the same archival group never race;
+    work for different keys runs in parallel.
+    """
+    def __init__(self, worker_count:int, max_pending:int):
+        self._workers = asyncio.Semaphore(max(1, worker_count))
+        self._pending = asyncio.Semaphore(max(1, max_pending))
+        self._tails:dict[str, asyncio.Task] = {}
+        self._tasks:set[asyncio.Task] = set()
+
+
+    async def submit(self, key:str, work):
+        """
+        Schedule the coroutine function `work` to run after any earlier work for `key`.
+        Waits (applying back pressure to the stream reader) while too much work is pending.
+        """
+        await self._pending.acquire()
+        predecessor = self._tails.get(key, None)
+        task = asyncio.create_task(self._run(key, work, predecessor))
+        self._tails[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(self._on_done)
+
+
+    async def drain(self):
+        """Wait for all submitted work to finish"""
+        while True:
+            # A finished task stays in _tasks until its done callback has run, and gathering only
+            # finished tasks never yields to the loop, so waiting on those would spin forever
+            unfinished = [task for task in self._tasks if not task.done()]
+            if len(unfinished) == 0:
+                return
+            await asyncio.gather(*unfinished, return_exceptions=True)
+
+
+    def pending_count(self) -> int:
+        return sum(1 for task in self._tasks if not task.done())
+
+
+    async def _run(self, key:str, work, predecessor:asyncio.Task | None):
+        try:
+            if predecessor is not None:
+                # exceptions are handled (and logged) in the predecessor's own _run
+                await asyncio.gather(predecessor, return_exceptions=True)
+            async with self._workers:
+                await work()
+        except Exception as e:
+            logger.error(f"Unhandled error processing work for {key}: {repr(e)}")
+        finally:
+            if self._tails.get(key, None) is asyncio.current_task():
+                del self._tails[key]
+
+
+    def _on_done(self, task:asyncio.Task):
+        self._tasks.discard(task)
+        self._pending.release()